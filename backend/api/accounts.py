@@ -0,0 +1,64 @@
+import re
+import logging
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, models, transaction
+from django.db.models import Max
+from django.db.models.functions import Cast, Substr
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+# Attempts before giving up on a username that keeps getting taken
+# by concurrent sign-ups
+PROVISION_ATTEMPTS = 5
+
+def base_username(email):
+    """
+    Username to start from for a new account: the email's local part, cut
+    short enough to leave room for a numeric suffix.
+    """
+    max_length = User._meta.get_field('username').max_length
+    return email.split('@')[0][:max_length - 11]
+
+def unique_username(base):
+    """
+    First free username of the form base, base_1, base_2, ...: base if it's
+    free, else one past the highest numeric suffix in use, worked out by the
+    database so no usernames are loaded however many share the base. A
+    concurrent sign-up may still take it first, so callers rely on the
+    unique constraint (see provision_user).
+    """
+    if not User.objects.filter(username=base).exists():
+        return base
+    highest = (
+        User.objects.filter(username__startswith=f'{base}_', username__regex=rf'^{re.escape(base)}_[0-9]+$')
+        .annotate(suffix=Cast(Substr('username', len(base) + 2), models.BigIntegerField()))
+        .aggregate(highest=Max('suffix'))['highest']
+    )
+    return f"{base}_{(highest or 0) + 1}"
+
+def provision_user(email, **fields):
+    """
+    Create a passwordless user for an externally authenticated email
+    (Firebase), with a unique username derived from it.
+    """
+    base = base_username(email)
+    for attempt in range(PROVISION_ATTEMPTS):
+        username = unique_username(base)
+        try:
+            with transaction.atomic():
+                # No password, since auth is handled by Firebase
+                return User.objects.create_user(username=username, email=email, password=None, **fields)
+        except IntegrityError:
+            logger.info(f"Username {username} was taken concurrently, retrying")
+    raise IntegrityError(f"Could not provision a unique username for {email}")
+
+def get_or_provision_user(email, **fields):
+    """
+    The user with this email, provisioned if there isn't one yet.
+    """
+    try:
+        return User.objects.get(email=email)
+    except User.DoesNotExist:
+        return provision_user(email, **fields)
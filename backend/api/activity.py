@@ -0,0 +1,163 @@
+"""
+Activity log: who uploaded, downloaded, deleted what and when they logged in.
+
+Events are queued in-process and written to MongoDB in batches by a
+background thread, so logging never waits on Mongo. When the queue is full
+(Mongo down or too slow) new events are dropped and counted rather than
+slowing requests down.
+"""
+import os
+import queue
+import atexit
+import logging
+import threading
+import time
+import datetime
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from pymongo import ASCENDING, DESCENDING
+from .db import get_collection_handle
+
+logger = logging.getLogger(__name__)
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+DELETE = 'delete'
+LOGIN = 'login'
+
+class ActivityLogWriter:
+    """
+    Queue plus flusher thread. A batch is written once
+    ACTIVITY_LOG_BATCH_SIZE events are waiting or ACTIVITY_LOG_FLUSH_INTERVAL
+    seconds have passed since the first of them arrived.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {'logged': 0, 'written': 0, 'dropped': 0, 'failed': 0}
+        self._reset()
+
+    def _reset(self):
+        self._queue = queue.Queue(maxsize=settings.ACTIVITY_LOG_QUEUE_SIZE)
+        self._thread = None
+        self._pid = os.getpid()
+        self._indexed = False
+
+    def _count(self, name, delta=1):
+        with self._lock:
+            self._counters[name] += delta
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, queued=self._queue.qsize())
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: the parent's queue and thread don't exist here
+                self._reset()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='activity-log-writer', daemon=True)
+                self._thread.start()
+
+    def log(self, event):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._count('dropped')
+            return
+        self._count('logged')
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + settings.ACTIVITY_LOG_FLUSH_INTERVAL
+            while len(batch) < settings.ACTIVITY_LOG_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            collection, client = get_collection_handle(settings.ACTIVITY_LOG_COLLECTION)
+            if not self._indexed:
+                collection.create_index([('user_id', ASCENDING), ('ts', DESCENDING)])
+                self._indexed = True
+            collection.insert_many(batch, ordered=False)
+            self._count('written', len(batch))
+        except Exception as e:
+            self._count('failed', len(batch))
+            logger.error(f"Error writing {len(batch)} activity events: {str(e)}")
+
+    def flush(self):
+        """
+        Write whatever is queued right now, in the calling thread.
+        """
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= settings.ACTIVITY_LOG_BATCH_SIZE:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+writer = ActivityLogWriter()
+atexit.register(writer.flush)
+
+def _event(user_id, action, request=None, **details):
+    event = {'user_id': user_id, 'action': action, 'ts': timezone.now()}
+    if request is not None:
+        event['ip'] = request.META.get('REMOTE_ADDR')
+    event.update(details)
+    return event
+
+def log(user_id, action, request=None, **details):
+    """
+    Record one event, e.g. log(user.id, activity.UPLOAD, file_id=f.id).
+    Inside a transaction the event is only queued once it commits, so a
+    rolled back upload or delete never shows up. Never blocks and never
+    raises.
+    """
+    if settings.ACTIVITY_LOG_ENABLED:
+        event = _event(user_id, action, request, **details)
+        transaction.on_commit(lambda: writer.log(event))
+
+def log_file(action, uploaded_file, request=None):
+    log(uploaded_file.user_id, action, request,
+        file_id=uploaded_file.pk, filename=uploaded_file.filename, file_size=uploaded_file.file_size)
+
+def user_activity(user_id, limit=50, before=None, action=None):
+    """
+    A user's most recent events, newest first, served by the
+    (user_id, ts) index. Pass the last event's ts as before to page back.
+    """
+    collection, client = get_collection_handle(settings.ACTIVITY_LOG_COLLECTION)
+    query = {'user_id': user_id}
+    if before is not None:
+        query['ts'] = {'$lt': before}
+    if action:
+        query['action'] = action
+    events = list(collection.find(query, {'_id': 0}).sort('ts', DESCENDING).limit(limit))
+    for event in events:
+        # Mongo hands back naive UTC datetimes
+        if timezone.is_naive(event['ts']):
+            event['ts'] = timezone.make_aware(event['ts'], datetime.timezone.utc)
+    return events
+
+def activity_stats():
+    """
+    Counters of this process: events logged, written, dropped because the
+    queue was full, failed to write, and currently queued.
+    """
+    return writer.stats()
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import User, Address, UploadedFile
+from .models import User, Address, UploadedFile, UploadSession, UserQuota
 
 class CustomUserAdmin(UserAdmin):
     model = User
@@ -23,6 +23,20 @@ class UploadedFileAdmin(admin.ModelAdmin):
     search_fields = ['user__username', 'filename']
     readonly_fields = ['file_type', 'upload_date']
 
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ['user', 'filename', 'status', 'total_size', 'created_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['user__username', 'filename']
+    readonly_fields = ['key', 'upload_id', 'created_at', 'updated_at']
+
+class UserQuotaAdmin(admin.ModelAdmin):
+    list_display = ['user', 'used_bytes', 'max_bytes', 'used_files', 'max_files', 'updated_at']
+    search_fields = ['user__username', 'user__email']
+    # Usage is maintained by uploads and deletes (and reconcile_quotas)
+    readonly_fields = ['used_bytes', 'used_files', 'updated_at']
+
 admin.site.register(User, CustomUserAdmin)
 admin.site.register(Address, AddressAdmin)
 admin.site.register(UploadedFile, UploadedFileAdmin)
+admin.site.register(UploadSession, UploadSessionAdmin)
+admin.site.register(UserQuota, UserQuotaAdmin)
@@ -0,0 +1,107 @@
+import asyncio
+import mimetypes
+import logging
+import weakref
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.storage import default_storage
+from .s3_storage import get_s3_client, get_object_key
+
+try:
+    from aiobotocore.session import get_session
+except ImportError:  # In requirements.txt; if missing, S3 calls run in a thread pool
+    get_session = None
+
+logger = logging.getLogger(__name__)
+
+class _ThreadedClient:
+    """
+    Stand-in for an aiobotocore client when aiobotocore isn't installed:
+    runs the regular boto3 client's calls in worker threads.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return sync_to_async(getattr(self._client, name), thread_sensitive=False)
+
+# One aiobotocore client per event loop (in practice, per ASGI worker
+# process), so its connection pool is shared by every request on that loop
+_clients = weakref.WeakKeyDictionary()
+
+async def client():
+    """
+    Async S3 client for the bucket behind default_storage, created on first
+    use in the running event loop and reused after that.
+    """
+    loop = asyncio.get_running_loop()
+    s3 = _clients.get(loop)
+    if s3 is not None:
+        return s3
+
+    if get_session is None:
+        s3 = _ThreadedClient(get_s3_client())
+    else:
+        s3 = await get_session().create_client(
+            's3',
+            region_name=settings.AWS_S3_REGION_NAME,
+            endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID or None,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY or None,
+        ).__aenter__()
+    # Another task on this loop may have got here first while we awaited
+    shared = _clients.setdefault(loop, s3)
+    if shared is not s3 and get_session is not None:
+        await s3.__aexit__(None, None, None)
+    return shared
+
+def _object_parameters(name):
+    params = dict(getattr(settings, 'AWS_S3_OBJECT_PARAMETERS', {}))
+    content_type = mimetypes.guess_type(name)[0]
+    if content_type:
+        params.setdefault('ContentType', content_type)
+    return params
+
+async def upload_file(name, file_obj):
+    """
+    Write an uploaded file to storage under name, as a single PUT or, for
+    files over FILE_UPLOAD_STREAM_PART_SIZE, a multipart upload.
+    """
+    bucket = default_storage.bucket_name
+    key = get_object_key(name)
+    params = _object_parameters(name)
+    part_size = settings.FILE_UPLOAD_STREAM_PART_SIZE
+    file_obj.seek(0)
+    s3 = await client()
+
+    # Uploads over FILE_UPLOAD_MAX_MEMORY_SIZE are spooled to disk, so reads
+    # go to a thread to keep them off the event loop
+    if file_obj.size <= part_size:
+        body = await asyncio.to_thread(file_obj.read)
+        await s3.put_object(Bucket=bucket, Key=key, Body=body, **params)
+        return name
+
+    upload = await s3.create_multipart_upload(Bucket=bucket, Key=key, **params)
+    upload_id = upload['UploadId']
+    try:
+        parts = []
+        part_number = 1
+        while True:
+            data = await asyncio.to_thread(file_obj.read, part_size)
+            if not data:
+                break
+            response = await s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                            PartNumber=part_number, Body=data)
+            parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+            part_number += 1
+        await s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                           MultipartUpload={'Parts': parts})
+    except Exception:
+        await s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    return name
+
+async def delete_file(name):
+    s3 = await client()
+    await s3.delete_object(Bucket=default_storage.bucket_name, Key=get_object_key(name))
@@ -0,0 +1,201 @@
+"""
+Async versions of the file list, detail, upload and delete endpoints, for
+deployment under an ASGI server (e.g. `uvicorn backend.asgi:application`).
+
+DRF views are synchronous, so these are plain Django async views speaking
+the same JSON. Queries use the async ORM and S3 calls go through
+api.async_s3, so a worker isn't tied up while a client or S3 is slow. Work
+that needs a transaction (blob reference counts, file statistics) still
+runs through sync_to_async, since Django's transactions are sync-only.
+"""
+import base64
+import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from django.db.models import Q
+from rest_framework import exceptions, status
+from .authentication import CachedTokenAuthentication
+from .filters import FilterError, filter_files
+from .models import Blob, QuotaExceeded, UploadedFile, UserQuota
+from .signals import batched_file_deletes
+from .serializers import UploadedFileSerializer, UploadedFileValuesSerializer, requested_fields
+from . import async_s3, uploads
+
+logger = logging.getLogger(__name__)
+
+async def _authenticate(request):
+    """
+    The authenticated user, or None.
+    """
+    try:
+        result = await CachedTokenAuthentication().aauthenticate(request)
+    except exceptions.AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+def _unauthorized():
+    return JsonResponse({'detail': 'Authentication credentials were not provided.'},
+                        status=status.HTTP_401_UNAUTHORIZED)
+
+def _encode_cursor(row):
+    position = f"{row['upload_date'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+
+def _decode_cursor(cursor):
+    try:
+        upload_date, pk = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split('|')
+        return parse_datetime(upload_date), int(pk)
+    except (ValueError, UnicodeError):
+        return None
+
+def _page_size(request):
+    try:
+        size = int(request.GET.get('page_size', settings.FILE_LIST_PAGE_SIZE))
+    except ValueError:
+        size = settings.FILE_LIST_PAGE_SIZE
+    return max(1, min(size, settings.FILE_LIST_MAX_PAGE_SIZE))
+
+async def _list_files(request, user):
+    """
+    Same rows (and filters) as the sync list, newest first. Pages are
+    keyset-based like FileCursorPagination, but the cursor is only valid
+    for this endpoint.
+    """
+    values_serializer = UploadedFileValuesSerializer(requested_fields(request))
+    try:
+        queryset = filter_files(UploadedFile.objects.filter(user=user), request.GET)
+    except FilterError as e:
+        return JsonResponse({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    queryset = queryset.order_by('-upload_date', '-id').values(*values_serializer.columns())
+
+    paginate = not settings.FILE_LIST_COMPAT_MODE or 'cursor' in request.GET or 'page_size' in request.GET
+    if not paginate:
+        rows = [row async for row in queryset]
+        data = await sync_to_async(values_serializer.to_representation)(rows)
+        return JsonResponse(data, safe=False)
+
+    cursor = request.GET.get('cursor')
+    if cursor:
+        position = _decode_cursor(cursor)
+        if position is None:
+            return JsonResponse({'detail': 'Invalid cursor'}, status=status.HTTP_404_NOT_FOUND)
+        upload_date, pk = position
+        queryset = queryset.filter(Q(upload_date__lt=upload_date) | Q(upload_date=upload_date, id__lt=pk))
+
+    page_size = _page_size(request)
+    rows = [row async for row in queryset[:page_size + 1]]
+    next_url = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        params = request.GET.copy()
+        params['cursor'] = _encode_cursor(rows[-1])
+        next_url = request.build_absolute_uri(f"{request.path}?{params.urlencode()}")
+
+    data = await sync_to_async(values_serializer.to_representation)(rows)
+    return JsonResponse({'next': next_url, 'previous': None, 'results': data})
+
+async def _store_file(user, file_obj):
+    """
+    Async counterpart of uploads.store_file: the content goes to S3 through
+    the async client, the Blob bookkeeping runs in a thread.
+    """
+    if not settings.FILE_DEDUP_ENABLED:
+        name = await async_s3.upload_file(uploads.new_file_name(user, file_obj.name), file_obj)
+        return name, None
+
+    digest = uploads.file_sha256(file_obj)
+    blob = await sync_to_async(uploads.reference_blob)(digest, file_obj)
+    if blob is not None:
+        return blob.key, blob
+    name = await async_s3.upload_file(uploads.blob_file_name(digest, file_obj.name), file_obj)
+    blob = await sync_to_async(uploads.register_blob)(file_obj, digest, name)
+    return blob.key, blob
+
+async def _upload_file(request, user):
+    # Parsing reads the request body, which the ASGI handler has already buffered
+    files = await sync_to_async(lambda: request.FILES)()
+    file_obj = files.get('file')
+    if not file_obj:
+        return JsonResponse({'file': ['No file was submitted.']}, status=status.HTTP_400_BAD_REQUEST)
+
+    logger.info(f"Received async file upload: {file_obj.name}, size: {file_obj.size} bytes")
+    original_name = file_obj.name
+    file_type = request.POST.get('file_type', 'other')
+    if not file_type or file_type == 'other':
+        file_type = UploadedFile.file_type_for_name(original_name)
+
+    try:
+        # Before anything is sent to S3
+        await sync_to_async(UserQuota.check_upload)(user.pk, file_obj.size, 1)
+    except QuotaExceeded as e:
+        return JsonResponse({'detail': str(e)}, status=status.HTTP_507_INSUFFICIENT_STORAGE)
+
+    try:
+        name, blob = await _store_file(user, file_obj)
+    except Exception as e:
+        logger.error(f"Error uploading file: {str(e)}")
+        return JsonResponse([f"File upload failed: {str(e)}"], safe=False, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        instance = await UploadedFile.objects.acreate(
+            user=user,
+            file=name,
+            blob=blob,
+            filename=original_name,
+            file_size=file_obj.size,
+            file_type=file_type,
+        )
+    except Exception as e:
+        # Give back what _store_file took
+        if blob is not None:
+            await sync_to_async(Blob.release)(blob.pk)
+        else:
+            await async_s3.delete_file(name)
+        if isinstance(e, QuotaExceeded):
+            return JsonResponse({'detail': str(e)}, status=status.HTTP_507_INSUFFICIENT_STORAGE)
+        raise
+
+    logger.info(f"File saved as: {instance.file.name}")
+    instance.user = user
+    data = await sync_to_async(lambda: UploadedFileSerializer(instance, context={'request': request}).data)()
+    return JsonResponse(data, status=status.HTTP_201_CREATED)
+
+def _delete_file(request, pk):
+    # The post_delete signal releases the stored content after commit, and
+    # logs the delete with the request's client IP
+    with transaction.atomic(), batched_file_deletes(request):
+        UploadedFile.objects.filter(pk=pk).delete()
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+async def file_list(request):
+    user = await _authenticate(request)
+    if user is None:
+        return _unauthorized()
+    if request.method == 'POST':
+        return await _upload_file(request, user)
+    return await _list_files(request, user)
+
+@csrf_exempt
+@require_http_methods(['GET', 'DELETE'])
+async def file_detail(request, pk):
+    user = await _authenticate(request)
+    if user is None:
+        return _unauthorized()
+
+    try:
+        instance = await UploadedFile.objects.select_related('user').aget(pk=pk, user=user)
+    except UploadedFile.DoesNotExist:
+        return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+    if request.method == 'GET':
+        data = await sync_to_async(lambda: UploadedFileSerializer(instance, context={'request': request}).data)()
+        return JsonResponse(data)
+
+    await sync_to_async(_delete_file)(request, instance.pk)
+    return HttpResponse(status=status.HTTP_204_NO_CONTENT)
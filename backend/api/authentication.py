@@ -0,0 +1,186 @@
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+
+logger = logging.getLogger(__name__)
+
+class _LocalTokenCache:
+    """
+    Per-process LRU of token key -> token snapshot (see _snapshot). Entries
+    live for TOKEN_AUTH_CACHE_LOCAL_TTL seconds only, since other processes
+    can't reach this cache to invalidate it.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            snapshot, expires_at = entry
+            if expires_at <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return snapshot
+
+    def set(self, key, snapshot, expires_at):
+        with self._lock:
+            self._entries[key] = (snapshot, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.TOKEN_AUTH_CACHE_LOCAL_SIZE:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_local = _LocalTokenCache()
+
+_stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+def cache_stats():
+    """
+    Hit and miss counters of this process, and the share of lookups served
+    from either cache tier, as a dict.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+    stats['hit_rate'] = (stats['local_hits'] + stats['shared_hits']) / lookups if lookups else None
+    return stats
+
+def _cache_key(key):
+    # Never use the raw token as a cache key
+    return 'auth-token:' + hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+# User columns kept out of the caches
+UNCACHED_USER_FIELDS = {'password'}
+
+def _snapshot(token):
+    """
+    What the caches keep for a token: its row and its user's as plain
+    values. Each request builds its own instances from them, so a view that
+    changes request.user can't leak the change into other requests. The
+    password hash never goes into a cache; on the rare request that needs
+    it, it's deferred and loaded from the database.
+    """
+    user = token.user
+    return (
+        token._state.db,
+        [(field.attname, getattr(token, field.attname)) for field in token._meta.concrete_fields],
+        [(field.attname, getattr(user, field.attname)) for field in user._meta.concrete_fields
+         if field.attname not in UNCACHED_USER_FIELDS],
+    )
+
+def _restore(model, snapshot):
+    db, token_values, user_values = snapshot
+    user_model = model._meta.get_field('user').related_model
+    token = model.from_db(db, [name for name, value in token_values], [value for name, value in token_values])
+    token.user = user_model.from_db(db, [name for name, value in user_values], [value for name, value in user_values])
+    return token
+
+def invalidate_token(key):
+    """
+    Drop a token from both cache tiers. Other processes' local entries
+    expire on their own within TOKEN_AUTH_CACHE_LOCAL_TTL.
+    """
+    _local.delete(key)
+    cache.delete(_cache_key(key))
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Drop-in TokenAuthentication that caches the token -> user lookup, first
+    in a short-lived per-process LRU and then in the shared cache, so most
+    requests skip the Token + User query.
+    """
+
+    def authenticate_credentials(self, key):
+        now = time.time()
+        snapshot = self._cached_snapshot(key, now)
+        if snapshot is None:
+            _count('misses')
+            model = self.get_model()
+            try:
+                token = model.objects.select_related('user').get(key=key)
+            except model.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            self._remember(key, _snapshot(token), now)
+            return self._check(token)
+        return self._check(_restore(self.get_model(), snapshot))
+
+    async def aauthenticate(self, request):
+        """
+        Async counterpart of authenticate(), for plain async Django views.
+        Returns (user, token), or None when no token was sent.
+        """
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed(_('Invalid token header.'))
+        try:
+            key = auth[1].decode()
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed(_('Invalid token header. Token string should not contain invalid characters.'))
+
+        now = time.time()
+        model = self.get_model()
+        snapshot = _local.get(key, now)
+        if snapshot is not None:
+            _count('local_hits')
+            return self._check(_restore(model, snapshot))
+        snapshot = await cache.aget(_cache_key(key))
+        if snapshot is not None:
+            _count('shared_hits')
+            _local.set(key, snapshot, now + settings.TOKEN_AUTH_CACHE_LOCAL_TTL)
+            return self._check(_restore(model, snapshot))
+
+        _count('misses')
+        try:
+            token = await model.objects.select_related('user').aget(key=key)
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        snapshot = _snapshot(token)
+        await cache.aset(_cache_key(key), snapshot, settings.TOKEN_AUTH_CACHE_TTL)
+        _local.set(key, snapshot, now + settings.TOKEN_AUTH_CACHE_LOCAL_TTL)
+        return self._check(token)
+
+    def _cached_snapshot(self, key, now):
+        snapshot = _local.get(key, now)
+        if snapshot is not None:
+            _count('local_hits')
+            return snapshot
+        snapshot = cache.get(_cache_key(key))
+        if snapshot is not None:
+            _count('shared_hits')
+            _local.set(key, snapshot, now + settings.TOKEN_AUTH_CACHE_LOCAL_TTL)
+        return snapshot
+
+    def _remember(self, key, snapshot, now):
+        cache.set(_cache_key(key), snapshot, settings.TOKEN_AUTH_CACHE_TTL)
+        _local.set(key, snapshot, now + settings.TOKEN_AUTH_CACHE_LOCAL_TTL)
+
+    def _check(self, token):
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return (token.user, token)
@@ -1,11 +1,204 @@
-from pymongo import MongoClient
+import os
+import threading
+from collections import defaultdict
+from pymongo import MongoClient, monitoring
 from django.conf import settings
+from django.utils.module_loading import import_string
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:  # PyMongo < 4.10; fall back to Motor if it's installed
+    try:
+        from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+    except ImportError:
+        AsyncMongoClient = None
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Counts connection pool events per server, so pool utilization can be
+    read back with pool_stats().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._servers = defaultdict(lambda: defaultdict(int))
+
+    def _count(self, event, name, delta=1):
+        with self._lock:
+            self._servers[f'{event.address[0]}:{event.address[1]}'][name] += delta
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count(event, 'cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count(event, 'open')
+        self._count(event, 'created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count(event, 'open', -1)
+
+    def connection_check_out_started(self, event):
+        self._count(event, 'waiting')
+
+    def connection_check_out_failed(self, event):
+        self._count(event, 'waiting', -1)
+        self._count(event, 'checkout_failures')
+
+    def connection_checked_out(self, event):
+        self._count(event, 'waiting', -1)
+        self._count(event, 'in_use')
+        self._count(event, 'checkouts')
+
+    def connection_checked_in(self, event):
+        self._count(event, 'in_use', -1)
+
+    def snapshot(self):
+        with self._lock:
+            return {address: dict(counts) for address, counts in self._servers.items()}
+
+pool_metrics = PoolMetrics()
+
+class _SharedClient:
+    """
+    Hands out the process-wide client to callers of the old helpers, which
+    used to get a client of their own and may still close() it. Closing
+    would break every other user of the pool, so it's a no-op here.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def __getitem__(self, name):
+        return self._client[name]
+
+    def close(self):
+        pass
+
+_lock = threading.Lock()
+_client = None
+_async_client = None
+_pid = None
+
+def _client_options():
+    return {
+        'maxPoolSize': settings.MONGO_MAX_POOL_SIZE,
+        'minPoolSize': settings.MONGO_MIN_POOL_SIZE,
+        'maxIdleTimeMS': settings.MONGO_MAX_IDLE_TIME_MS,
+        'waitQueueTimeoutMS': settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        'connectTimeoutMS': settings.MONGO_CONNECT_TIMEOUT_MS,
+        'socketTimeoutMS': settings.MONGO_SOCKET_TIMEOUT_MS,
+        'serverSelectionTimeoutMS': settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        'event_listeners': [pool_metrics],
+    }
+
+def _check_pid():
+    """
+    Clients must not cross a fork: a child (e.g. a gunicorn worker forked
+    after the app was loaded) starts with fresh clients of its own.
+    """
+    global _client, _async_client, _pid
+    if _pid != os.getpid():
+        _client = None
+        _async_client = None
+        _pid = os.getpid()
+        pool_metrics.reset()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_check_pid)
+
+def get_client():
+    """
+    The process-wide MongoClient, created on first use. Its pool is shared
+    by all threads; don't close it.
+    """
+    global _client
+    with _lock:
+        _check_pid()
+        if _client is None:
+            client_class = import_string(settings.MONGO_CLIENT_CLASS) if settings.MONGO_CLIENT_CLASS else MongoClient
+            _client = client_class(settings.MONGO_CLIENT, **_client_options())
+        return _client
+
+def get_async_client():
+    """
+    The process-wide async client for ASGI views, created on first use.
+    Needs PyMongo 4.10+ (or Motor).
+    """
+    global _async_client
+    if AsyncMongoClient is None:
+        raise RuntimeError('An async MongoDB client needs PyMongo 4.10+ or Motor')
+    with _lock:
+        _check_pid()
+        if _async_client is None:
+            _async_client = AsyncMongoClient(settings.MONGO_CLIENT, **_client_options())
+        return _async_client
+
+def close_clients():
+    """
+    Close the shared sync client, e.g. at shutdown or between tests. The
+    next call creates a new one.
+    """
+    global _client
+    with _lock:
+        client, _client = _client, None
+    if client is not None:
+        client.close()
+    pool_metrics.reset()
+
+async def aclose_clients():
+    """
+    Close the shared async client; the next call creates a new one.
+    """
+    global _async_client
+    with _lock:
+        client, _async_client = _async_client, None
+    if client is not None:
+        result = client.close()
+        # PyMongo's close() is a coroutine, Motor's isn't
+        if hasattr(result, '__await__'):
+            await result
+
+def pool_stats():
+    """
+    Pool utilization per server: open connections, connections in use,
+    threads waiting for one, and the configured maximum.
+    """
+    return {
+        'max_pool_size': settings.MONGO_MAX_POOL_SIZE,
+        'servers': pool_metrics.snapshot(),
+    }
 
 def get_db_handle():
-    client = MongoClient(settings.MONGO_CLIENT)
-    db = client[settings.MONGO_DB]
-    return db, client
+    client = get_client()
+    return client[settings.MONGO_DB], _SharedClient(client)
 
 def get_collection_handle(collection_name):
     db, client = get_db_handle()
-    return db[collection_name], client 
\ No newline at end of file
+    return db[collection_name], client
+
+def get_async_db_handle():
+    client = get_async_client()
+    return client[settings.MONGO_DB], client
+
+def get_async_collection_handle(collection_name):
+    db, client = get_async_db_handle()
+    return db[collection_name], client
@@ -0,0 +1,254 @@
+import os
+import re
+import mimetypes
+import logging
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header, http_date
+from rest_framework.negotiation import BaseContentNegotiation
+from .s3_storage import get_s3_client, get_object_key
+
+logger = logging.getLogger(__name__)
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+class ContentMissing(Exception):
+    """
+    The file's row exists but its stored content doesn't.
+    """
+    pass
+
+class DownloadContentNegotiation(BaseContentNegotiation):
+    """
+    Downloads aren't rendered, so don't turn away players and viewers whose
+    Accept header has no JSON in it; errors still come back as JSON.
+    """
+
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return (renderers[0], renderers[0].media_type)
+
+def parse_range(header, size):
+    """
+    The (start, end) byte positions, inclusive, asked for by a single-range
+    Range header, or None to send the whole file. Multiple ranges aren't
+    supported and get the whole file, which RFC 9110 allows.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+class _RangeFile:
+    """
+    A file limited to [start, start + length), for FileResponse. Servers
+    that sendfile() (gunicorn) read from fileno() at tell() for
+    Content-Length bytes; everything else calls read().
+    """
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def close(self):
+        self.file.close()
+
+def _finish(response, uploaded_file, etag, size, byte_range, content_type, last_modified=None, inline=False):
+    response['Content-Type'] = content_type or 'application/octet-stream'
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = content_disposition_header(not inline, uploaded_file.filename)
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    if byte_range is None:
+        response['Content-Length'] = str(size)
+    else:
+        start, end = byte_range
+        response.status_code = 206
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return response
+
+def _not_modified(request, etag):
+    return bool(etag) and etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]
+
+def _wanted_range(request, etag, size):
+    # If-Range: only honour Range when the client's copy is still current
+    if_range = request.headers.get('If-Range')
+    if if_range and if_range != etag:
+        return None
+    return parse_range(request.headers.get('Range'), size)
+
+def _unsatisfiable(size):
+    response = HttpResponse(status=416)
+    response['Content-Range'] = f'bytes */{size}'
+    return response
+
+def download_response(request, uploaded_file):
+    """
+    Stream an UploadedFile's content, honouring Range (206) and
+    If-None-Match (304). Memory use doesn't depend on the file size: S3
+    bodies are passed through in FILE_DOWNLOAD_CHUNK_SIZE chunks and local
+    files go out through FileResponse, which servers can sendfile().
+    """
+    inline = request.query_params.get('inline') in ('1', 'true')
+    name = uploaded_file.file.name
+    content_type = mimetypes.guess_type(uploaded_file.filename)[0]
+    try:
+        path = default_storage.path(name)
+    except NotImplementedError:
+        path = None
+    if path is not None:
+        return _local_response(request, uploaded_file, path, content_type, inline)
+    return _s3_response(request, uploaded_file, name, content_type, inline)
+
+def _local_response(request, uploaded_file, path, content_type, inline):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError as e:
+        raise ContentMissing(str(e))
+    size = stat.st_size
+    # Deduplicated content has a content hash; otherwise fall back to mtime and size
+    etag = f'"{uploaded_file.blob.sha256}"' if uploaded_file.blob_id else f'"{int(stat.st_mtime):x}-{size:x}"'
+    if _not_modified(request, etag):
+        response = HttpResponse(status=304)
+        response['ETag'] = etag
+        return response
+    try:
+        byte_range = _wanted_range(request, etag, size)
+    except RangeNotSatisfiable:
+        return _unsatisfiable(size)
+
+    file = open(path, 'rb')
+    if byte_range is not None:
+        start, end = byte_range
+        file = _RangeFile(file, start, end - start + 1)
+    response = FileResponse(file)
+    response.block_size = settings.FILE_DOWNLOAD_CHUNK_SIZE
+    return _finish(response, uploaded_file, etag, size, byte_range, content_type, stat.st_mtime, inline)
+
+def _s3_response(request, uploaded_file, name, content_type, inline):
+    client = get_s3_client()
+    params = {'Bucket': default_storage.bucket_name, 'Key': get_object_key(name)}
+    if request.headers.get('If-None-Match'):
+        params['IfNoneMatch'] = request.headers['If-None-Match']
+    range_header = request.headers.get('Range')
+    if range_header and RANGE_RE.match(range_header.strip()):
+        # S3 applies the range itself; If-Range is checked against its ETag below
+        params['Range'] = range_header.strip()
+
+    try:
+        obj = client.get_object(**params)
+    except ClientError as e:
+        code = e.response.get('Error', {}).get('Code')
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if status == 304 or code == 'NotModified':
+            response = HttpResponse(status=304)
+            if request.headers.get('If-None-Match'):
+                response['ETag'] = request.headers['If-None-Match']
+            return response
+        if code in ('NoSuchKey', '404'):
+            raise ContentMissing(f"{name}: {code}")
+        if code == 'InvalidRange':
+            head = client.head_object(Bucket=params['Bucket'], Key=params['Key'])
+            return _unsatisfiable(head['ContentLength'])
+        raise
+
+    etag = obj.get('ETag')
+    if_range = request.headers.get('If-Range')
+    if 'Range' in params and if_range and if_range != etag:
+        # The client's partial copy is stale: send the whole object instead
+        obj['Body'].close()
+        params.pop('Range')
+        obj = client.get_object(**params)
+        etag = obj.get('ETag')
+
+    byte_range = None
+    size = obj['ContentLength']
+    content_range = obj.get('ContentRange')
+    if content_range:
+        # e.g. 'bytes 0-99/1234'
+        positions, total = content_range.split(' ', 1)[1].split('/')
+        start, end = positions.split('-')
+        byte_range = (int(start), int(end))
+        size = int(total)
+
+    body = obj['Body']
+    response = StreamingHttpResponse(_close_after(body, body.iter_chunks(settings.FILE_DOWNLOAD_CHUNK_SIZE)))
+    last_modified = obj['LastModified'].timestamp() if obj.get('LastModified') else None
+    return _finish(response, uploaded_file, etag, size, byte_range,
+                   content_type or obj.get('ContentType'), last_modified, inline)
+
+def _close_after(body, chunks):
+    try:
+        yield from chunks
+    finally:
+        body.close()
+
+def open_content(name, chunk_size=None):
+    """
+    Iterator over a stored file's bytes in chunks, for code that consumes
+    content as it arrives. The object is opened before this returns, so a
+    missing one raises ContentMissing here rather than mid-iteration.
+    """
+    chunk_size = chunk_size or settings.FILE_DOWNLOAD_CHUNK_SIZE
+    try:
+        path = default_storage.path(name)
+    except NotImplementedError:
+        path = None
+    if path is not None:
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError as e:
+            raise ContentMissing(str(e))
+        return _close_after(file, iter(lambda: file.read(chunk_size), b''))
+
+    try:
+        obj = get_s3_client().get_object(Bucket=default_storage.bucket_name, Key=get_object_key(name))
+    except ClientError as e:
+        code = e.response.get('Error', {}).get('Code')
+        if code in ('NoSuchKey', '404'):
+            raise ContentMissing(f"{name}: {code}")
+        raise
+    body = obj['Body']
+    return _close_after(body, body.iter_chunks(chunk_size))
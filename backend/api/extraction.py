@@ -0,0 +1,79 @@
+"""
+Text extraction for search indexing. Runs in the background process pool
+(see api/workers.py), so it must not touch Django: it only turns a file's
+bytes into plain text.
+"""
+import io
+import codecs
+import zipfile
+import xml.etree.ElementTree as ElementTree
+
+try:
+    import pypdf
+except ImportError:  # Optional: without it PDFs aren't indexed
+    pypdf = None
+
+TEXT_EXTENSIONS = {'txt', 'csv', 'md'}
+DOCX_EXTENSIONS = {'docx'}
+PDF_EXTENSIONS = {'pdf'}
+
+# Extensions we can extract text from with the libraries installed
+SEARCHABLE_EXTENSIONS = TEXT_EXTENSIONS | DOCX_EXTENSIONS
+if pypdf is not None:
+    SEARCHABLE_EXTENSIONS |= PDF_EXTENSIONS
+
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+def _decode(data):
+    try:
+        # Not final: data may have been cut off in the middle of a character
+        return codecs.getincrementaldecoder('utf-8-sig')().decode(data, final=False)
+    except UnicodeDecodeError:
+        return data.decode('cp1252', errors='replace')
+
+def _docx_text(data, max_length):
+    """
+    Paragraph text of a Word document, parsed as it's decompressed so a
+    huge (or hostile) document.xml is never held in memory whole.
+    """
+    parts = []
+    length = 0
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        with archive.open('word/document.xml') as document:
+            for event, element in ElementTree.iterparse(document, events=('end',)):
+                if element.tag == f'{WORD_NAMESPACE}t' and element.text:
+                    parts.append(element.text)
+                    length += len(element.text)
+                elif element.tag == f'{WORD_NAMESPACE}tab':
+                    parts.append('\t')
+                elif element.tag == f'{WORD_NAMESPACE}p':
+                    parts.append('\n')
+                    element.clear()
+                if length >= max_length:
+                    break
+    return ''.join(parts)
+
+def _pdf_text(data, max_length):
+    parts = []
+    length = 0
+    for page in pypdf.PdfReader(io.BytesIO(data)).pages:
+        text = page.extract_text() or ''
+        parts.append(text)
+        length += len(text)
+        if length >= max_length:
+            break
+    return '\n'.join(parts)
+
+def extract_text(data, extension, max_length):
+    """
+    Plain text of a text file, Word document or PDF, cut off at max_length
+    characters. Raises whatever the parser raises for content it can't read.
+    """
+    if extension in DOCX_EXTENSIONS:
+        text = _docx_text(data, max_length)
+    elif extension in PDF_EXTENSIONS:
+        text = _pdf_text(data, max_length)
+    else:
+        text = _decode(data[:max_length * 4])
+    # NUL can't be stored in PostgreSQL text columns
+    return text[:max_length].replace('\x00', '')
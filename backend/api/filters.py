@@ -0,0 +1,103 @@
+"""
+Server-side filters for the file list, shared by the sync and async views:
+
+    ?file_type=pdf,docx          one of UploadedFile.FILE_TYPES, or several
+    ?extension=png,jpg           normalized extensions
+    ?uploaded_after=2024-01-31   on or after (a date or ISO 8601 timestamp)
+    ?uploaded_before=2024-02-07  before
+    ?min_size=1024&max_size=...  bytes, inclusive
+    ?name_prefix=invoice         filename starts with, case-insensitive
+    ?name_contains=march         filename contains, case-insensitive
+
+Each is backed by an index on UploadedFile (see its Meta and, for
+PostgreSQL's filename searches, migration 0014), so filtered lists stay
+fast however many files a user has.
+"""
+import datetime
+from django.db import connections
+from django.db.models.functions import Lower
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework import exceptions
+from rest_framework.filters import BaseFilterBackend
+from .models import UploadedFile
+
+class FilterError(ValueError):
+    pass
+
+def parse_timestamp(value, name):
+    """
+    A date (midnight, in the current time zone) or ISO 8601 timestamp.
+    """
+    parsed = parse_datetime(value)
+    if parsed is None:
+        parsed_date = parse_date(value)
+        if parsed_date is None:
+            raise FilterError(f'{name} must be a date or an ISO 8601 timestamp')
+        parsed = datetime.datetime.combine(parsed_date, datetime.time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+def _parse_size(value, name):
+    try:
+        size = int(value)
+    except ValueError:
+        raise FilterError(f'{name} must be a number of bytes')
+    if size < 0:
+        raise FilterError(f'{name} must not be negative')
+    return size
+
+def _parse_list(value):
+    return [item.strip().lower() for item in value.split(',') if item.strip()]
+
+def filter_files(queryset, params):
+    """
+    Apply the filters in params (a QueryDict) to an UploadedFile queryset.
+    Raises FilterError for values that don't parse.
+    """
+    if params.get('file_type'):
+        file_types = _parse_list(params['file_type'])
+        known = {choice for choice, label in UploadedFile.FILE_TYPES}
+        unknown = sorted(set(file_types) - known)
+        if unknown:
+            raise FilterError(f"Unknown file_type {', '.join(unknown)}; use {', '.join(sorted(known))}")
+        queryset = queryset.filter(file_type__in=file_types)
+    if params.get('extension'):
+        queryset = queryset.filter(extension__in=[extension.lstrip('.') for extension in _parse_list(params['extension'])])
+    if params.get('uploaded_after'):
+        queryset = queryset.filter(upload_date__gte=parse_timestamp(params['uploaded_after'], 'uploaded_after'))
+    if params.get('uploaded_before'):
+        queryset = queryset.filter(upload_date__lt=parse_timestamp(params['uploaded_before'], 'uploaded_before'))
+    if params.get('min_size'):
+        queryset = queryset.filter(file_size__gte=_parse_size(params['min_size'], 'min_size'))
+    if params.get('max_size'):
+        queryset = queryset.filter(file_size__lte=_parse_size(params['max_size'], 'max_size'))
+    if params.get('name_prefix'):
+        queryset = _filter_name_prefix(queryset, params['name_prefix'])
+    if params.get('name_contains'):
+        queryset = queryset.filter(filename__icontains=params['name_contains'])
+    return queryset
+
+def _filter_name_prefix(queryset, prefix):
+    # PostgreSQL answers istartswith from its trigram index. Elsewhere LIKE
+    # can't use the (user, LOWER(filename)) index, but a range over the
+    # lowered names can; SQLite's LOWER() only folds ASCII, so other
+    # prefixes stay on LIKE (whose case folding is ASCII-only as well)
+    if connections[queryset.db].vendor == 'postgresql' or not prefix.isascii():
+        return queryset.filter(filename__istartswith=prefix)
+    prefix = prefix.lower()
+    return queryset.alias(lower_filename=Lower('filename')).filter(
+        lower_filename__gte=prefix, lower_filename__lt=prefix[:-1] + chr(ord(prefix[-1]) + 1),
+    )
+
+class FileFilterBackend(BaseFilterBackend):
+    """
+    filter_files as a DRF filter backend, for the file viewset's list.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        try:
+            return filter_files(queryset, request.query_params)
+        except FilterError as e:
+            raise exceptions.ValidationError({'detail': str(e)})
@@ -3,7 +3,11 @@ from firebase_admin import credentials, auth
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import BaseBackend
+from django.core.cache import cache
+from .accounts import get_or_provision_user
 import os
+import time
+import hashlib
 import logging
 
 # Set up logging
@@ -41,46 +45,73 @@ except ValueError:
         logger.error(f"Failed to initialize Firebase: {str(e)}")
         # Continue without Firebase - authentication will fail but app won't crash
 
+def _token_cache_key(token):
+    # Never use the raw token as a cache key
+    return 'firebase-token:' + hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def _uid_cache_key(uid):
+    return f'firebase-uid:{uid}'
+
+def verify_token(token):
+    """
+    Verify a Firebase ID token with the Admin SDK, caching the decoded
+    claims until the token expires so a repeated token isn't verified again.
+    """
+    key = _token_cache_key(token)
+    decoded_token = cache.get(key)
+    if decoded_token is not None:
+        return decoded_token
+
+    decoded_token = auth.verify_id_token(token, app=firebase_app)
+    ttl = int(decoded_token.get('exp', 0) - time.time())
+    if ttl > 0:
+        cache.set(key, decoded_token, ttl)
+    return decoded_token
+
 class FirebaseAuthBackend(BaseBackend):
     """
     Custom authentication backend for Firebase.
     Verifies Firebase tokens and authenticates users.
+
+    Verified tokens and the uid -> local user mapping are cached, so a
+    repeated login needs no calls to Firebase and a single query.
     """
     def authenticate(self, request, token=None, **kwargs):
         if not token or firebase_app is None:
             return None
-            
+
         try:
             # Verify the token with Firebase
-            decoded_token = auth.verify_id_token(token)
+            decoded_token = verify_token(token)
             uid = decoded_token['uid']
-            
-            # Get user info from Firebase
-            firebase_user = auth.get_user(uid)
+
+            user_id = cache.get(_uid_cache_key(uid))
+            if user_id is not None:
+                try:
+                    return User.objects.get(pk=user_id)
+                except User.DoesNotExist:
+                    cache.delete(_uid_cache_key(uid))
+
+            # The token's claims usually carry the profile; only ask Firebase
+            # for the user record when they don't
+            email = decoded_token.get('email')
+            display_name = decoded_token.get('name')
+            phone_number = decoded_token.get('phone_number')
+            if not email:
+                firebase_user = auth.get_user(uid)
+                email = firebase_user.email
+                display_name = firebase_user.display_name
+                phone_number = firebase_user.phone_number
             
             # Get or create user in our database
-            try:
-                user = User.objects.get(email=firebase_user.email)
-            except User.DoesNotExist:
-                # Create a new user
-                username = firebase_user.email.split('@')[0]
-                # Ensure username is unique
-                base_username = username
-                count = 1
-                while User.objects.filter(username=username).exists():
-                    username = f"{base_username}{count}"
-                    count += 1
-                    
-                user = User(
-                    username=username,
-                    email=firebase_user.email,
-                    first_name=firebase_user.display_name.split()[0] if firebase_user.display_name else '',
-                    last_name=' '.join(firebase_user.display_name.split()[1:]) if firebase_user.display_name and len(firebase_user.display_name.split()) > 1 else '',
-                    phone_number=firebase_user.phone_number or ''
-                )
-                user.set_unusable_password()  # No password, since auth is handled by Firebase
-                user.save()
-                
+            user = get_or_provision_user(
+                email,
+                first_name=display_name.split()[0] if display_name else '',
+                last_name=' '.join(display_name.split()[1:]) if display_name and len(display_name.split()) > 1 else '',
+                phone_number=phone_number or '',
+            )
+
+            cache.set(_uid_cache_key(uid), user.pk, settings.FIREBASE_USER_CACHE_TTL)
             return user
             
         except Exception as e:
@@ -92,4 +123,4 @@ class FirebaseAuthBackend(BaseBackend):
         try:
             return User.objects.get(pk=user_id)
         except User.DoesNotExist:
-            return None 
\ No newline at end of file
+            return None
\ No newline at end of file
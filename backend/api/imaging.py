@@ -0,0 +1,68 @@
+"""
+Thumbnail rendering. Runs in the thumbnail process pool (see
+api/thumbnails.py), so it must not touch Django: it only turns a file's
+bytes into JPEG bytes.
+"""
+import io
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # Optional: without it PDFs get no thumbnail
+    pdfium = None
+
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tif', 'tiff'}
+PDF_EXTENSIONS = {'pdf'}
+
+# Extensions we can render with the libraries installed
+THUMBNAIL_EXTENSIONS = set()
+if Image is not None:
+    THUMBNAIL_EXTENSIONS |= IMAGE_EXTENSIONS
+    if pdfium is not None:
+        THUMBNAIL_EXTENSIONS |= PDF_EXTENSIONS
+
+def _open_image(data, size):
+    image = Image.open(io.BytesIO(data))
+    # JPEGs can be decoded at a fraction of their size, much faster than
+    # decoding everything and scaling down afterwards
+    image.draft('RGB', (size, size))
+    return ImageOps.exif_transpose(image)
+
+def _render_pdf_page(data, size):
+    document = pdfium.PdfDocument(data)
+    try:
+        page = document[0]
+        width, height = page.get_size()
+        image = page.render(scale=size / max(width, height, 1)).to_pil()
+        page.close()
+        return image
+    finally:
+        document.close()
+
+def render_thumbnail(data, extension, size, quality=85):
+    """
+    JPEG bytes of a thumbnail fitting in size x size pixels, from an
+    image's content or a PDF's first page. Raises whatever the decoder
+    raises for content it can't read.
+    """
+    if extension in PDF_EXTENSIONS:
+        image = _render_pdf_page(data, size)
+    else:
+        image = _open_image(data, size)
+    image.thumbnail((size, size))
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        # JPEG has no alpha: flatten transparent images onto white
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue()
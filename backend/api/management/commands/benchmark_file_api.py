@@ -0,0 +1,92 @@
+import ssl
+import time
+import asyncio
+import statistics
+from urllib.parse import urlsplit
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    help = ('Load-test the file list on a WSGI and an ASGI deployment with many concurrent clients '
+            'and compare throughput and latency')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wsgi-url', help='Sync endpoint, e.g. http://localhost:8000/api/files/')
+        parser.add_argument('--asgi-url', help='Async endpoint, e.g. http://localhost:8001/api/async/files/')
+        parser.add_argument('--token', required=True, help='API token to authenticate with')
+        parser.add_argument('--concurrency', type=int, default=200, help='Clients in flight at once')
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per endpoint')
+        parser.add_argument('--timeout', type=float, default=60, help='Per-request timeout in seconds')
+
+    def handle(self, *args, **options):
+        targets = [(label, options[f'{label}_url']) for label in ('wsgi', 'asgi') if options[f'{label}_url']]
+        if not targets:
+            raise CommandError('Pass --wsgi-url and/or --asgi-url')
+
+        for label, url in targets:
+            result = asyncio.run(self.run_load(url, options))
+            self.report(label.upper(), url, result)
+
+    async def run_load(self, url, options):
+        """
+        Fire options['requests'] GETs at url, at most options['concurrency']
+        at a time. A raw asyncio client keeps the load generator itself from
+        becoming the bottleneck.
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise CommandError(f'Unsupported URL: {url}')
+        secure = parts.scheme == 'https'
+        host = parts.hostname
+        port = parts.port or (443 if secure else 80)
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+        request = (
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {parts.netloc}\r\n"
+            f"Authorization: Token {options['token']}\r\n"
+            f"Accept: application/json\r\n"
+            f"Connection: close\r\n\r\n"
+        ).encode('ascii')
+        ssl_context = ssl.create_default_context() if secure else None
+
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        latencies = []
+        errors = []
+
+        async def one():
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(host, port, ssl=ssl_context), options['timeout'])
+                    writer.write(request)
+                    await writer.drain()
+                    response = await asyncio.wait_for(reader.read(), options['timeout'])
+                    writer.close()
+                    status = response.split(b' ', 2)[1] if response else b'-'
+                    if status != b'200':
+                        errors.append(status.decode('ascii', 'replace'))
+                        return
+                    latencies.append(time.perf_counter() - started)
+                except (OSError, asyncio.TimeoutError) as e:
+                    errors.append(type(e).__name__)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(options['requests'])))
+        return {'elapsed': time.perf_counter() - started, 'latencies': sorted(latencies), 'errors': errors}
+
+    def report(self, label, url, result):
+        latencies = result['latencies']
+        self.stdout.write(self.style.MIGRATE_HEADING(f"{label} {url}"))
+        self.stdout.write(f"  ok: {len(latencies)}  errors: {len(result['errors'])}  "
+                          f"elapsed: {result['elapsed']:.2f}s  "
+                          f"throughput: {len(latencies) / result['elapsed']:.1f} req/s")
+        if latencies:
+            def pct(p):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+            self.stdout.write(f"  latency ms: mean {statistics.mean(latencies) * 1000:.1f}  "
+                              f"p50 {pct(0.50):.1f}  p95 {pct(0.95):.1f}  p99 {pct(0.99):.1f}")
+        if result['errors']:
+            counts = {}
+            for error in result['errors']:
+                counts[error] = counts.get(error, 0) + 1
+            self.stdout.write(f"  error breakdown: {counts}")
@@ -0,0 +1,25 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from api.models import UserFileStats
+
+User = get_user_model()
+
+class Command(BaseCommand):
+    help = 'Recompute per-user file statistics from UploadedFile, repairing any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='usernames', default=[],
+                            help='Only rebuild this user (can be repeated)')
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('pk')
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+
+        rebuilt = 0
+        for user in users.iterator(chunk_size=500):
+            stats = UserFileStats.rebuild(user.pk)
+            rebuilt += 1
+            self.stdout.write(f"{user.username}: {stats.total_files} files, {stats.total_bytes} bytes")
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt file statistics for {rebuilt} users"))
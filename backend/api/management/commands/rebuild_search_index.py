@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api import extraction, search
+from api.models import UploadedFile
+
+class Command(BaseCommand):
+    help = 'Extract the text of existing files for search in batches, e.g. for files uploaded before indexing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users', default=[],
+                            help='Only files of this user id (can be repeated)')
+        parser.add_argument('--missing', action='store_true', help="Only files that aren't indexed yet")
+        parser.add_argument('--batch-size', type=int, default=500, help='Files per batch')
+        parser.add_argument('--start-after', type=int, default=0,
+                            help='Resume: skip files with ids up to and including this one')
+
+    def handle(self, *args, **options):
+        if not settings.SEARCH_INDEX_ENABLED:
+            raise CommandError('Search indexing is disabled (SEARCH_INDEX_ENABLED)')
+
+        queryset = UploadedFile.objects.filter(
+            extension__in=extraction.SEARCHABLE_EXTENSIONS,
+            file_size__lte=settings.SEARCH_MAX_SOURCE_SIZE,
+        )
+        if options['users']:
+            queryset = queryset.filter(user_id__in=options['users'])
+        if options['missing']:
+            queryset = queryset.filter(text__isnull=True)
+
+        last_id = options['start_after']
+        total = 0
+        while True:
+            # Keyset batches: stable however many files there are
+            ids = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            extracted = search.index_files(ids, force=not options['missing'])
+            total += extracted
+            last_id = ids[-1]
+            self.stdout.write(f"up to id {last_id}: {extracted} of {len(ids)} files extracted")
+
+        search.optimize_index()
+        self.stdout.write(self.style.SUCCESS(f"Extracted text from {total} files"))
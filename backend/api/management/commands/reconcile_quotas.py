@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from api.models import User, UserQuota
+
+class Command(BaseCommand):
+    help = 'Recompute storage quota usage from UploadedFile in batches of users, repairing any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users', default=[],
+                            help='Only this user id (can be repeated)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Users per batch')
+        parser.add_argument('--start-after', type=int, default=0,
+                            help='Resume: skip users with ids up to and including this one')
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options['users']:
+            users = users.filter(id__in=options['users'])
+
+        last_id = options['start_after']
+        checked = 0
+        repaired = 0
+        while True:
+            # Keyset batches; each is recounted (and locked) in its own transaction
+            ids = list(users.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            before = {quota.user_id: (quota.used_bytes, quota.used_files)
+                      for quota in UserQuota.objects.filter(user_id__in=ids)}
+            for user_id, quota in UserQuota.recount(ids).items():
+                if before.get(user_id, (0, 0)) != (quota.used_bytes, quota.used_files):
+                    repaired += 1
+                    old_bytes, old_files = before.get(user_id, (0, 0))
+                    self.stdout.write(f"user {user_id}: {old_bytes} -> {quota.used_bytes} bytes, "
+                                      f"{old_files} -> {quota.used_files} files")
+            checked += len(ids)
+            last_id = ids[-1]
+            self.stdout.write(f"up to user {last_id}: {checked} users checked")
+
+        self.stdout.write(self.style.SUCCESS(f"Checked {checked} users, repaired {repaired}"))
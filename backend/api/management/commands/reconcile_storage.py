@@ -0,0 +1,239 @@
+import re
+import heapq
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Q
+from django.db.models.functions import Collate
+from django.utils import timezone
+from api.models import Blob, UploadedFile, UploadSession
+from api.s3_storage import get_s3_client, get_object_key, delete_objects
+
+# Keys checked per query/delete while fixing
+BATCH_SIZE = 1000
+
+class Command(BaseCommand):
+    help = ('Compare stored objects against UploadedFile/Blob rows and report (or fix) objects '
+            'without a row and rows whose object is missing')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', action='append', dest='prefixes', default=[],
+                            help='Only check this top-level prefix, e.g. user_5/ (can be repeated)')
+        parser.add_argument('--start-after', default='',
+                            help='Resume: skip prefixes up to and including this one')
+        parser.add_argument('--workers', type=int, default=4, help='Prefixes checked concurrently')
+        parser.add_argument('--min-age', type=float, default=24,
+                            help='Ignore objects younger than this many hours (uploads may be in flight)')
+        parser.add_argument('--delete-orphans', action='store_true',
+                            help='Delete stored objects that no row refers to')
+        parser.add_argument('--delete-missing', action='store_true',
+                            help='Delete rows whose stored object is gone')
+
+    def handle(self, *args, **options):
+        if not hasattr(default_storage, 'bucket_name'):
+            raise CommandError('reconcile_storage only supports S3 storage')
+
+        self.options = options
+        self.client = get_s3_client()
+        self.bucket = default_storage.bucket_name
+        self.location = get_object_key('')
+        self.cutoff = timezone.now() - datetime.timedelta(hours=options['min_age'])
+        self.output_lock = threading.Lock()
+        self.totals = {'objects': 0, 'rows': 0, 'orphans': 0, 'missing': 0}
+
+        prefixes = sorted(set(options['prefixes']) or self.discover_prefixes())
+        prefixes = [prefix for prefix in prefixes if prefix > options['start_after']]
+        self.stdout.write(f"Checking {len(prefixes)} prefixes with {options['workers']} workers")
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            for prefix, counts in zip(prefixes, pool.map(self.check_prefix_in_thread, prefixes)):
+                with self.output_lock:
+                    for key, value in counts.items():
+                        self.totals[key] += value
+                    # Results are printed in order, so the last one is safe to resume after
+                    self.stdout.write(f"done {prefix}: {counts['objects']} objects, {counts['rows']} rows, "
+                                      f"{counts['orphans']} orphans, {counts['missing']} missing")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{self.totals['objects']} objects, {self.totals['rows']} rows: "
+            f"{self.totals['orphans']} orphan objects, {self.totals['missing']} rows missing their object"
+        ))
+
+    def discover_prefixes(self):
+        """
+        Top-level prefixes to check: whatever exists in the bucket, plus
+        every user prefix the database expects (in case it's gone entirely).
+        Deduplicated content is split further by its two-character shard.
+        """
+        prefixes = set()
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.location, Delimiter='/'):
+            for common in page.get('CommonPrefixes', []):
+                prefixes.add(common['Prefix'][len(self.location):])
+        for user_id in UploadedFile.objects.values_list('user_id', flat=True).distinct():
+            prefixes.add(f'user_{user_id}/')
+
+        if 'blobs/' in prefixes:
+            prefixes.discard('blobs/')
+            prefixes.update(f'blobs/{i:02x}/' for i in range(256))
+        return prefixes
+
+    def check_prefix_in_thread(self, prefix):
+        try:
+            return self.check_prefix(prefix)
+        finally:
+            # Each worker thread gets its own connection; don't leak them
+            connections.close_all()
+
+    def check_prefix(self, prefix):
+        """
+        Sorted merge of the objects under prefix against the rows that
+        should own them. Both sides stream in key order, so memory stays
+        bounded however many files a prefix has.
+        """
+        counts = {'objects': 0, 'rows': 0, 'orphans': 0, 'missing': 0}
+        orphans = []
+        missing = []
+
+        objects = self.list_objects(prefix)
+        rows = self.expected_names(prefix)
+        obj = next(objects, None)
+        row = next(rows, None)
+        while obj is not None or row is not None:
+            if row is None or (obj is not None and obj[0] < row[0]):
+                counts['objects'] += 1
+                if obj[1] < self.cutoff:
+                    orphans.append(obj[0])
+                obj = next(objects, None)
+            elif obj is None or row[0] < obj[0]:
+                counts['rows'] += 1
+                # Like young objects, young rows may have an upload in flight
+                if row[1] < self.cutoff:
+                    missing.append(row[0])
+                row = next(rows, None)
+            else:
+                counts['objects'] += 1
+                counts['rows'] += 1
+                obj = next(objects, None)
+                row = next(rows, None)
+
+            if len(orphans) >= BATCH_SIZE:
+                counts['orphans'] += self.handle_orphans(orphans)
+                orphans = []
+            if len(missing) >= BATCH_SIZE:
+                counts['missing'] += self.handle_missing(prefix, missing)
+                missing = []
+
+        counts['orphans'] += self.handle_orphans(orphans)
+        counts['missing'] += self.handle_missing(prefix, missing)
+        return counts
+
+    def list_objects(self, prefix):
+        """
+        (storage name, last modified) for every object under prefix, one
+        ListObjectsV2 page at a time, in S3's (UTF-8 byte) key order.
+        """
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.location + prefix):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(self.location):], item['LastModified']
+
+    def referrers(self, prefix):
+        """
+        What may refer to objects under prefix, narrowed by indexed columns
+        rather than name prefixes: plain files (and their thumbnails) by
+        owner, blobs by key, and rows sharing those blobs (whose thumbnail
+        sits next to the blob) by blob.
+        """
+        blobs = Blob.objects.filter(self.key_range('key', prefix))
+        user = re.fullmatch(r'user_(\d+)/', prefix)
+        if user:
+            files = UploadedFile.objects.filter(user_id=int(user.group(1)), blob__isnull=True)
+        elif prefix.startswith('blobs/'):
+            files = UploadedFile.objects.none()
+        else:
+            files = UploadedFile.objects.filter(blob__isnull=True)
+        return files, blobs, UploadedFile.objects.filter(blob__in=blobs)
+
+    def key_range(self, field, prefix):
+        # Postgres serves startswith from the pattern index Django adds for
+        # indexed CharFields; SQLite's LIKE ignores indexes, but the
+        # equivalent range of keys doesn't
+        if connection.vendor == 'postgresql':
+            return Q(**{f'{field}__startswith': prefix})
+        return Q(**{f'{field}__gte': prefix, f'{field}__lt': prefix[:-1] + chr(ord(prefix[-1]) + 1)})
+
+    def expected_names(self, prefix):
+        """
+        (storage name, created) for every name the database refers to under
+        prefix, in the same order S3 lists keys: plain files' names merged
+        with blob keys (a blob may keep the name its first upload was
+        streamed to) and thumbnails. A name several rows refer to comes
+        once, with its newest row's time.
+        """
+        files, blobs, shared = self.referrers(prefix)
+        streams = [
+            self.sorted_names(files.filter(file__startswith=prefix), 'file', 'upload_date'),
+            self.sorted_names(blobs, 'key', 'created_at'),
+            self.sorted_names(files.filter(thumbnail__startswith=prefix), 'thumbnail', 'upload_date'),
+            self.sorted_names(shared.filter(thumbnail__startswith=prefix), 'thumbnail', 'upload_date'),
+        ]
+        previous = None
+        for name, created in heapq.merge(*streams):
+            # Several legacy rows (or rows sharing a blob's thumbnail) may share an object
+            if previous is not None and name != previous[0]:
+                yield previous
+                previous = None
+            previous = (name, max(created, previous[1]) if previous else created)
+        if previous is not None:
+            yield previous
+
+    def sorted_names(self, queryset, field, created_field):
+        # S3 orders keys bytewise; Postgres needs the C collation for that,
+        # SQLite already compares that way
+        if connection.vendor == 'postgresql':
+            queryset = queryset.order_by(Collate(field, 'C'))
+        else:
+            queryset = queryset.order_by(field)
+        return queryset.values_list(field, created_field).iterator(chunk_size=BATCH_SIZE)
+
+    def handle_orphans(self, names):
+        """
+        Report (and with --delete-orphans delete) objects nobody refers to,
+        sparing objects of upload sessions still in progress.
+        """
+        if not names:
+            return 0
+        in_progress = set(UploadSession.objects.filter(status='active', key__in=names).values_list('key', flat=True))
+        names = [name for name in names if name not in in_progress]
+        with self.output_lock:
+            for name in names:
+                self.stdout.write(f"orphan object: {name}")
+        if names and self.options['delete_orphans']:
+            failed = delete_objects(names)
+            if failed:
+                self.stderr.write(f"could not delete {len(failed)} orphan objects")
+        return len(names)
+
+    def handle_missing(self, prefix, names):
+        """
+        Report (and with --delete-missing delete) rows whose object is gone.
+        """
+        if not names:
+            return 0
+        with self.output_lock:
+            for name in names:
+                self.stdout.write(f"missing object: {name}")
+        if self.options['delete_missing']:
+            files, blobs, shared = self.referrers(prefix)
+            # Deleting the rows releases their blobs through the usual signals
+            files.filter(file__in=names).delete()
+            UploadedFile.objects.filter(blob__in=blobs.filter(key__in=names)).delete()
+            blobs.filter(key__in=names, ref_count=0).delete()
+            # A lost thumbnail only needs making again (regenerate_thumbnails --missing)
+            files.filter(thumbnail__in=names).update(thumbnail='')
+            shared.filter(thumbnail__in=names).update(thumbnail='')
+        return len(names)
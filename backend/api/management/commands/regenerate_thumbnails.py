@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api import imaging, thumbnails
+from api.models import UploadedFile
+
+class Command(BaseCommand):
+    help = 'Render thumbnails for existing images and PDFs in batches, e.g. after changing THUMBNAIL_SIZE'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users', default=[],
+                            help='Only files of this user id (can be repeated)')
+        parser.add_argument('--missing', action='store_true',
+                            help="Only files that don't have a thumbnail yet")
+        parser.add_argument('--batch-size', type=int, default=500, help='Files per batch')
+        parser.add_argument('--start-after', type=int, default=0,
+                            help='Resume: skip files with ids up to and including this one')
+
+    def handle(self, *args, **options):
+        if not imaging.THUMBNAIL_EXTENSIONS:
+            raise CommandError('Pillow is needed to render thumbnails')
+        if not settings.THUMBNAIL_ENABLED:
+            raise CommandError('Thumbnails are disabled (THUMBNAIL_ENABLED)')
+
+        queryset = UploadedFile.objects.filter(
+            extension__in=imaging.THUMBNAIL_EXTENSIONS,
+            file_size__lte=settings.THUMBNAIL_MAX_SOURCE_SIZE,
+        )
+        if options['users']:
+            queryset = queryset.filter(user_id__in=options['users'])
+        if options['missing']:
+            queryset = queryset.filter(thumbnail='')
+
+        last_id = options['start_after']
+        total = 0
+        while True:
+            # Keyset batches: stable however many files there are
+            ids = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            rendered = thumbnails.generate(ids, force=not options['missing'])
+            total += rendered
+            last_id = ids[-1]
+            self.stdout.write(f"up to id {last_id}: {rendered} of {len(ids)} files rendered")
+
+        self.stdout.write(self.style.SUCCESS(f"Rendered {total} thumbnails"))
@@ -0,0 +1,61 @@
+# Generated by Django 5.1.7 on 2026-10-18 05:26
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_uploadedfile_file_size_uploadedfile_file_url'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='address',
+            name='country',
+            field=models.CharField(default='USA', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='uploadedfile',
+            name='file_type',
+            field=models.CharField(choices=[('pdf', 'PDF'), ('excel', 'Excel'), ('txt', 'Text'), ('docx', 'Word'), ('other', 'Other')], default='other', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='phone_number',
+            field=models.CharField(blank=True, max_length=15, null=True),
+        ),
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255)),
+                ('key', models.CharField(max_length=1024)),
+                ('upload_id', models.CharField(max_length=1024)),
+                ('total_size', models.BigIntegerField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('active', 'Active'), ('completed', 'Completed'), ('aborted', 'Aborted')], default='active', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('uploaded_file', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload_session', to='api.uploadedfile')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UploadSessionPart',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('part_number', models.PositiveIntegerField()),
+                ('etag', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('uploaded_at', models.DateTimeField(auto_now=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parts', to='api.uploadsession')),
+            ],
+            options={
+                'ordering': ['part_number'],
+                'unique_together': {('session', 'part_number')},
+            },
+        ),
+    ]
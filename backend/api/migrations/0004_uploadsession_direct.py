@@ -0,0 +1,33 @@
+# Generated by Django 5.1.7 on 2026-10-18 05:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='checksum_sha256',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='content_type',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='mode',
+            field=models.CharField(choices=[('proxy', 'Proxied'), ('direct', 'Direct')], default='proxy', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='upload_id',
+            field=models.CharField(blank=True, max_length=1024),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-18 05:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_blob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['user', 'upload_date', 'id'], name='api_file_user_date_idx'),
+        ),
+    ]
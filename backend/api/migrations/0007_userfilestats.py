@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-18 05:34
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_uploadedfile_user_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserFileStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='file_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('total_files', models.BigIntegerField(default=0)),
+                ('total_bytes', models.BigIntegerField(default=0)),
+                ('extension_counts', models.JSONField(default=dict)),
+                ('type_counts', models.JSONField(default=dict)),
+                ('daily_counts', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
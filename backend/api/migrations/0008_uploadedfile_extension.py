@@ -0,0 +1,22 @@
+# Generated by Django 5.1.7 on 2026-10-18 05:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_userfilestats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='extension',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['user', 'extension'], name='api_file_user_ext_idx'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+from django.db import migrations, transaction
+
+BATCH_SIZE = 2000
+EXTENSION_MAX_LENGTH = 32
+
+
+def extension_for(name):
+    # Frozen copy of UploadedFile.extension_for
+    if not name or '.' not in name:
+        return ''
+    return name.rsplit('.', 1)[1].lower()[:EXTENSION_MAX_LENGTH]
+
+
+def backfill_extensions(apps, schema_editor):
+    """
+    Fill in `extension` for existing rows in batches. Each batch commits on
+    its own and only rows still NULL are picked up, so an interrupted run
+    simply continues where it stopped when migrated again.
+    """
+    UploadedFile = apps.get_model('api', 'UploadedFile')
+    last_pk = 0
+    while True:
+        batch = list(
+            UploadedFile.objects.filter(extension__isnull=True, pk__gt=last_pk)
+            .order_by('pk')
+            .values_list('pk', 'filename')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+
+        by_extension = {}
+        for pk, filename in batch:
+            by_extension.setdefault(extension_for(filename), []).append(pk)
+        with transaction.atomic():
+            for extension, pks in by_extension.items():
+                UploadedFile.objects.filter(pk__in=pks).update(extension=extension)
+        last_pk = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+    # Let each batch commit separately
+    atomic = False
+
+    dependencies = [
+        ('api', '0008_uploadedfile_extension'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_extensions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 05:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_backfill_uploadedfile_extension'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['email'], name='api_user_email_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 06:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_user_email_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='blob',
+            name='key',
+            field=models.CharField(db_index=True, max_length=1024),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 05:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_blob_key_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='thumbnail',
+            field=models.CharField(blank=True, default='', max_length=1024),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 5.1.7 on 2026-10-18 05:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+SQLITE_CREATE = [
+    # External content table: the index stores no copy of the text
+    "CREATE VIRTUAL TABLE api_filetext_fts USING fts5("
+    "content, content='api_filetext', content_rowid='uploaded_file_id', tokenize='porter unicode61')",
+    "CREATE TRIGGER api_filetext_fts_insert AFTER INSERT ON api_filetext BEGIN "
+    "INSERT INTO api_filetext_fts(rowid, content) VALUES (new.uploaded_file_id, new.content); END",
+    "CREATE TRIGGER api_filetext_fts_delete AFTER DELETE ON api_filetext BEGIN "
+    "INSERT INTO api_filetext_fts(api_filetext_fts, rowid, content) VALUES ('delete', old.uploaded_file_id, old.content); END",
+    "CREATE TRIGGER api_filetext_fts_update AFTER UPDATE ON api_filetext BEGIN "
+    "INSERT INTO api_filetext_fts(api_filetext_fts, rowid, content) VALUES ('delete', old.uploaded_file_id, old.content); "
+    "INSERT INTO api_filetext_fts(rowid, content) VALUES (new.uploaded_file_id, new.content); END",
+]
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS api_filetext_fts_insert",
+    "DROP TRIGGER IF EXISTS api_filetext_fts_delete",
+    "DROP TRIGGER IF EXISTS api_filetext_fts_update",
+    "DROP TABLE IF EXISTS api_filetext_fts",
+]
+POSTGRESQL_CREATE = [
+    "ALTER TABLE api_filetext ADD COLUMN search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('english', content)) STORED",
+    "CREATE INDEX api_filetext_search_idx ON api_filetext USING GIN (search_vector)",
+]
+POSTGRESQL_DROP = [
+    "DROP INDEX IF EXISTS api_filetext_search_idx",
+    "ALTER TABLE api_filetext DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def _run(schema_editor, statements):
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def create_search_index(apps, schema_editor):
+    # Other databases get no index; search falls back to a plain scan
+    _run(schema_editor, {'sqlite': SQLITE_CREATE, 'postgresql': POSTGRESQL_CREATE})
+
+
+def drop_search_index(apps, schema_editor):
+    _run(schema_editor, {'sqlite': SQLITE_DROP, 'postgresql': POSTGRESQL_DROP})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_uploadedfile_thumbnail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileText',
+            fields=[
+                ('uploaded_file', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='text', serialize=False, to='api.uploadedfile')),
+                ('content', models.TextField(blank=True)),
+                ('extracted_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
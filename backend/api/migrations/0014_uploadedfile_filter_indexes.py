@@ -0,0 +1,49 @@
+# Generated by Django 5.1.7 on 2026-10-18 05:57
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+# On PostgreSQL Django compiles istartswith/icontains to
+# UPPER(col::text) LIKE UPPER(x); a trigram index on that expression serves
+# both. pg_trgm ships with PostgreSQL, but creating the extension needs the
+# right privileges.
+TRIGRAM_INDEX = (
+    ["CREATE EXTENSION IF NOT EXISTS pg_trgm",
+     "CREATE INDEX api_file_name_trgm_idx ON api_uploadedfile USING GIN (UPPER(filename::text) gin_trgm_ops)"],
+    ["DROP INDEX IF EXISTS api_file_name_trgm_idx"],
+)
+
+
+def create_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in TRIGRAM_INDEX[0]:
+            schema_editor.execute(statement)
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in TRIGRAM_INDEX[1]:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_filetext'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['user', 'file_type', 'upload_date', 'id'], name='api_file_user_type_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['user', 'file_size'], name='api_file_user_size_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(models.F('user'), django.db.models.functions.text.Lower('filename'), name='api_file_user_name_idx'),
+        ),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.7 on 2026-10-18 05:59
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_uploadedfile_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserQuota',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='quota', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('max_bytes', models.BigIntegerField(blank=True, null=True)),
+                ('max_files', models.BigIntegerField(blank=True, null=True)),
+                ('used_bytes', models.BigIntegerField(default=0)),
+                ('used_files', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='uploadedfile',
+            name='file_size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='status',
+            field=models.CharField(choices=[('active', 'Active'), ('completed', 'Completed'), ('aborted', 'Aborted'), ('failed', 'Failed')], default='active', max_length=10),
+        ),
+    ]
@@ -1,7 +1,15 @@
 import os
-from django.db import models
+import uuid
+import logging
+import datetime
+from functools import cached_property
+from django.db import models, transaction
+from django.db.models.functions import Coalesce, Greatest, Lower, TruncDate
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
+from .s3_storage import delete_objects_on_commit
+from .imaging import THUMBNAIL_EXTENSIONS
 
 def user_directory_path(instance, filename):
     # File will be uploaded to MEDIA_ROOT/user_<id>/<filename>
@@ -11,6 +19,12 @@ class User(AbstractUser):
     phone_number = models.CharField(max_length=15, blank=True, null=True)
     # Add custom fields here
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Login and Firebase provisioning look users up by email
+            models.Index(fields=['email'], name='api_user_email_idx'),
+        ]
+
     def __str__(self):
         return self.username
 
@@ -26,6 +40,59 @@ class Address(models.Model):
     def __str__(self):
         return f"{self.street}, {self.city}, {self.state}, {self.postal_code}"
 
+class Blob(models.Model):
+    """
+    A stored object identified by the SHA-256 of its content. UploadedFile
+    rows with identical content share one Blob, so the bytes are only
+    written to storage once and only deleted when the last reference goes.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    # Indexed for reconcile_storage, which scans blobs by key prefix
+    key = models.CharField(max_length=1024, db_index=True)
+    size = models.BigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def release(cls, blob_id):
+        """
+        Drop one reference. When it was the last one the row goes, and the
+        stored object is deleted once the surrounding transaction commits.
+        """
+        cls.release_many({blob_id: 1})
+
+    @classmethod
+    def release_many(cls, counts):
+        """
+        Drop references on several blobs at once; counts maps blob id to the
+        number of references to drop. Blobs left unreferenced are deleted,
+        their objects in batches once the surrounding transaction commits.
+        """
+        if not counts:
+            return
+        with transaction.atomic():
+            blobs = list(cls.objects.select_for_update().filter(pk__in=counts))
+            gone = [blob for blob in blobs if blob.ref_count <= counts[blob.pk]]
+            kept = [blob for blob in blobs if blob.ref_count > counts[blob.pk]]
+            if kept:
+                cls.objects.filter(pk__in=[blob.pk for blob in kept]).update(
+                    ref_count=models.Case(
+                        *[models.When(pk=blob.pk, then=models.F('ref_count') - counts[blob.pk]) for blob in kept],
+                        output_field=models.PositiveIntegerField(),
+                    )
+                )
+            if gone:
+                cls.objects.filter(pk__in=[blob.pk for blob in gone]).delete()
+                # Rows sharing a blob share its thumbnail, which goes with it
+                delete_objects_on_commit(
+                    [blob.key for blob in gone]
+                    + [UploadedFile.thumbnail_name_for(blob.key) for blob in gone
+                       if UploadedFile.extension_for(blob.key) in THUMBNAIL_EXTENSIONS]
+                )
+
+    def __str__(self):
+        return self.sha256
+
 class UploadedFile(models.Model):
     FILE_TYPES = (
         ('pdf', 'PDF'),
@@ -34,14 +101,45 @@ class UploadedFile(models.Model):
         ('docx', 'Word'),
         ('other', 'Other'),
     )
+    # The one place extensions are mapped to file types
+    EXTENSION_FILE_TYPES = {
+        'pdf': 'pdf',
+        'xlsx': 'excel',
+        'xls': 'excel',
+        'txt': 'txt',
+        'doc': 'docx',
+        'docx': 'docx',
+    }
+    EXTENSION_MAX_LENGTH = 32
     
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='files')
     file = models.FileField(upload_to=user_directory_path)
     filename = models.CharField(max_length=255)
     file_type = models.CharField(max_length=10, choices=FILE_TYPES, default='other')
-    file_size = models.IntegerField(default=0)
+    file_size = models.BigIntegerField(default=0)
+    # Legacy: URLs are now derived from the storage key (see `url`)
     file_url = models.URLField(max_length=1000, blank=True, null=True)
+    # Set when the content is stored deduplicated; `file` then holds the blob's key
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, blank=True, null=True, related_name='files')
+    # Normalized extension of `filename` ('' when it has none). NULL only on
+    # rows the backfill migration hasn't reached yet.
+    extension = models.CharField(max_length=EXTENSION_MAX_LENGTH, blank=True, null=True)
+    # Storage name of the generated thumbnail ('' until one is made, see api/thumbnails.py)
+    thumbnail = models.CharField(max_length=1024, blank=True, default='')
     upload_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Backs the keyset pagination of a user's file list
+            models.Index(fields=['user', 'upload_date', 'id'], name='api_file_user_date_idx'),
+            models.Index(fields=['user', 'extension'], name='api_file_user_ext_idx'),
+            # List filters (api/filters.py). PostgreSQL also has a trigram
+            # index for filename searches (migration 0013), which Django
+            # leaves alone when it alters this table.
+            models.Index(fields=['user', 'file_type', 'upload_date', 'id'], name='api_file_user_type_date_idx'),
+            models.Index(fields=['user', 'file_size'], name='api_file_user_size_idx'),
+            models.Index(models.F('user'), Lower('filename'), name='api_file_user_name_idx'),
+        ]
     
     def save(self, *args, **kwargs):
         if not self.file_type:
@@ -50,47 +148,386 @@ class UploadedFile(models.Model):
             self.filename = os.path.basename(self.file.name)
         if self.file and not self.file_size and hasattr(self.file, 'size'):
             self.file_size = self.file.size
-        
-        # Save the model instance first
-        super().save(*args, **kwargs)
-        
-        # Update the file_url after saving
-        if self.file and not self.file_url:
+        if self.extension is None:
+            self.extension = self.extension_for(self.filename)
+
+        if self._state.adding:
+            # Count the file against the owner's quota in the same transaction
+            # as its row, so a rejected file never shows up
+            with transaction.atomic():
+                UserQuota.charge(self.user_id, self.file_size or 0, 1)
+                super().save(*args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
+
+    @cached_property
+    def url(self):
+        """
+        URL for downloading the file, derived from the storage key when it's
+        read (through the presigned URL cache). Older rows may only have the
+        URL that used to be stored.
+        """
+        if self.file:
             try:
-                self.file_url = self.file.url
-                # Use update to avoid another save cycle
-                self.__class__.objects.filter(pk=self.pk).update(file_url=self.file_url)
+                from .url_cache import get_url
+                return get_url(self.file.name)
             except Exception as e:
-                import logging
                 logger = logging.getLogger(__name__)
                 logger.error(f"Error getting file URL: {str(e)}")
-    
-    def delete(self, *args, **kwargs):
-        # Delete the file from S3 before deleting the database record
-        if self.file:
+        return self.file_url
+
+    @cached_property
+    def thumbnail_url(self):
+        """
+        URL of the thumbnail, or None when the file has none (yet).
+        """
+        if self.thumbnail:
             try:
-                self.file.delete(save=False)
+                from .url_cache import get_url
+                return get_url(self.thumbnail)
             except Exception as e:
-                # Log the error but continue with deletion
-                import logging
                 logger = logging.getLogger(__name__)
-                logger.error(f"Error deleting file from storage: {str(e)}")
-        super().delete(*args, **kwargs)
+                logger.error(f"Error getting thumbnail URL: {str(e)}")
+        return None
     
     def get_file_type(self):
         if not self.file:
             return 'other'
-        extension = os.path.splitext(self.file.name)[1].lower()
-        if extension == '.pdf':
-            return 'pdf'
-        elif extension in ['.xlsx', '.xls']:
-            return 'excel'
-        elif extension == '.txt':
-            return 'txt'
-        elif extension in ['.doc', '.docx']:
-            return 'docx'
-        else:
-            return 'other'
+        return self.file_type_for_name(self.file.name)
+
+    @classmethod
+    def extension_for(cls, name):
+        """
+        Normalized extension of a file name: lowercased, without the dot,
+        '' when there is none.
+        """
+        if not name or '.' not in name:
+            return ''
+        return name.rsplit('.', 1)[1].lower()[:cls.EXTENSION_MAX_LENGTH]
+
+    @classmethod
+    def file_type_for_extension(cls, extension):
+        return cls.EXTENSION_FILE_TYPES.get(extension, 'other')
+
+    @classmethod
+    def file_type_for_name(cls, name):
+        return cls.file_type_for_extension(cls.extension_for(name))
+
+    @staticmethod
+    def thumbnail_name_for(name):
+        """
+        Storage name of the thumbnail of the object stored under name, next
+        to it. Storage names are unique, so these are too.
+        """
+        return f'{os.path.splitext(name)[0]}.thumb.jpg'
     
     def __str__(self):
         return self.filename
+
+
+class FileText(models.Model):
+    """
+    Text extracted from a file's content for search (see api/search.py).
+    The full-text index over `content` is database specific and lives
+    outside the model: an FTS5 table kept in sync by triggers on SQLite, a
+    generated tsvector column with a GIN index on PostgreSQL.
+    """
+    uploaded_file = models.OneToOneField(UploadedFile, on_delete=models.CASCADE, primary_key=True, related_name='text')
+    content = models.TextField(blank=True)
+    extracted_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Text of {self.uploaded_file_id}"
+
+
+class QuotaExceeded(Exception):
+    """
+    Raised when a file would take a user over their storage quota.
+    """
+    pass
+
+class UserQuota(models.Model):
+    """
+    A user's storage limits and what they're using. Usage is kept with F()
+    updates in the same transaction as each upload and delete; an upload's
+    increment only applies while it stays within the limits, so concurrent
+    uploads can't overshoot. reconcile_quotas recomputes usage from
+    UploadedFile.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='quota')
+    # NULL: QUOTA_DEFAULT_MAX_BYTES / QUOTA_DEFAULT_MAX_FILES
+    max_bytes = models.BigIntegerField(blank=True, null=True)
+    max_files = models.BigIntegerField(blank=True, null=True)
+    used_bytes = models.BigIntegerField(default=0)
+    used_files = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def byte_limit(self):
+        return self.max_bytes if self.max_bytes is not None else settings.QUOTA_DEFAULT_MAX_BYTES
+
+    @property
+    def file_limit(self):
+        return self.max_files if self.max_files is not None else settings.QUOTA_DEFAULT_MAX_FILES
+
+    @classmethod
+    def for_user(cls, user_id):
+        """
+        The user's quota row, created (with usage counted from their files)
+        the first time it's needed.
+        """
+        quota = cls.objects.filter(user_id=user_id).first()
+        if quota is None:
+            quota = cls.recount([user_id])[user_id]
+        return quota
+
+    @classmethod
+    def check_upload(cls, user_id, size, files=1):
+        """
+        Raise QuotaExceeded if `files` more files totalling `size` bytes
+        would go over the user's quota. Only a check: charge() is what
+        counts, but checking declared sizes first keeps bytes that would be
+        rejected from ever being uploaded.
+        """
+        quota = cls.for_user(user_id)
+        byte_limit, file_limit = quota.byte_limit, quota.file_limit
+        if byte_limit is not None and quota.used_bytes + size > byte_limit:
+            raise QuotaExceeded(f"Storage quota exceeded: {quota.used_bytes} of {byte_limit} bytes used, "
+                                f"{size} more requested")
+        if file_limit is not None and quota.used_files + files > file_limit:
+            raise QuotaExceeded(f"File quota exceeded: {quota.used_files} of {file_limit} files used")
+
+    @staticmethod
+    def _fits(used_field, limit_field, default, amount):
+        # The limit as the database sees it, so the check and the increment are one statement
+        if amount <= 0:
+            return models.Q()
+        if default is None:
+            return (models.Q(**{f'{limit_field}__isnull': True})
+                    | models.Q(**{f'{used_field}__lte': models.F(limit_field) - amount}))
+        return models.Q(**{f'{used_field}__lte': Coalesce(models.F(limit_field), models.Value(default)) - amount})
+
+    @classmethod
+    def charge(cls, user_id, size, files=1):
+        """
+        Count files and bytes against the user's quota, raising QuotaExceeded
+        (and counting nothing) if that would go over it. Call inside the
+        transaction that stores the files, so a rollback undoes it.
+        """
+        fits = (cls._fits('used_bytes', 'max_bytes', settings.QUOTA_DEFAULT_MAX_BYTES, size)
+                & cls._fits('used_files', 'max_files', settings.QUOTA_DEFAULT_MAX_FILES, files))
+        for attempt in range(2):
+            updated = cls.objects.filter(fits, user_id=user_id).update(
+                used_bytes=models.F('used_bytes') + size,
+                used_files=models.F('used_files') + files,
+            )
+            if updated:
+                return
+            if attempt == 0 and not cls.objects.filter(user_id=user_id).exists():
+                # First upload since quotas were introduced: count, then retry
+                cls.recount([user_id])
+                continue
+            break
+        cls.check_upload(user_id, size, files)
+        raise QuotaExceeded("Storage quota exceeded")
+
+    @classmethod
+    def release(cls, user_id, size, files=1):
+        """
+        Give back what deleted files were using.
+        """
+        cls.objects.filter(user_id=user_id).update(
+            used_bytes=Greatest(models.F('used_bytes') - size, models.Value(0)),
+            used_files=Greatest(models.F('used_files') - files, models.Value(0)),
+        )
+
+    @classmethod
+    def recount(cls, user_ids):
+        """
+        Recompute usage for these users from their UploadedFile rows, creating
+        missing quota rows. The rows are locked while counting, so uploads
+        and deletes in flight are either counted or wait. Returns the quotas
+        by user id.
+        """
+        with transaction.atomic():
+            quotas = {quota.user_id: quota for quota in cls.objects.select_for_update().filter(user_id__in=user_ids)}
+            for user_id in set(user_ids) - set(quotas):
+                quota, created = cls.objects.get_or_create(user_id=user_id)
+                quotas[user_id] = cls.objects.select_for_update().get(pk=quota.pk)
+
+            usage = {
+                row['user_id']: row
+                for row in UploadedFile.objects.filter(user_id__in=user_ids).values('user_id').annotate(
+                    files=models.Count('id'), bytes=models.Sum('file_size')
+                ).order_by()
+            }
+            for user_id, quota in quotas.items():
+                row = usage.get(user_id, {})
+                used_bytes, used_files = row.get('bytes') or 0, row.get('files') or 0
+                if (quota.used_bytes, quota.used_files) != (used_bytes, used_files):
+                    quota.used_bytes, quota.used_files = used_bytes, used_files
+                    quota.save(update_fields=['used_bytes', 'used_files', 'updated_at'])
+        return quotas
+
+    def __str__(self):
+        return f"{self.user_id}: {self.used_bytes} bytes, {self.used_files} files"
+
+class UserFileStats(models.Model):
+    """
+    Running per-user totals behind the dashboard, updated in the same
+    transaction as each upload and delete so reading them is a single
+    primary-key lookup. `rebuild` recomputes them from UploadedFile.
+    """
+    # Uploads per day are kept for this many days to answer "recent files"
+    RECENT_DAYS = 30
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='file_stats')
+    total_files = models.BigIntegerField(default=0)
+    total_bytes = models.BigIntegerField(default=0)
+    extension_counts = models.JSONField(default=dict)
+    type_counts = models.JSONField(default=dict)
+    daily_counts = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def extension_key(extension):
+        # How files without an extension show up in the histogram
+        return extension or 'unknown'
+
+    @classmethod
+    def record_uploads(cls, user_id, files):
+        cls._apply(user_id, files, 1, create=True)
+
+    @classmethod
+    def record_deletes(cls, user_id, files):
+        # Never create a row on delete: the user itself may be going away
+        cls._apply(user_id, files, -1, create=False)
+
+    @classmethod
+    def _apply(cls, user_id, files, sign, create):
+        if not files:
+            return
+        with transaction.atomic():
+            stats = cls.objects.select_for_update().filter(user_id=user_id).first()
+            if stats is None:
+                if create:
+                    # First time we see this user: count everything they have,
+                    # which includes the rows just saved
+                    cls.rebuild(user_id)
+                return
+
+            for f in files:
+                stats.total_files += sign
+                stats.total_bytes += sign * (f.file_size or 0)
+                extension = f.extension if f.extension is not None else UploadedFile.extension_for(f.filename)
+                _bump(stats.extension_counts, cls.extension_key(extension), sign)
+                _bump(stats.type_counts, f.file_type or 'other', sign)
+                if f.upload_date:
+                    _bump(stats.daily_counts, timezone.localdate(f.upload_date).isoformat(), sign)
+            stats.daily_counts = stats._trimmed_daily_counts()
+            stats.save()
+
+    def _trimmed_daily_counts(self):
+        cutoff = (timezone.localdate() - datetime.timedelta(days=self.RECENT_DAYS)).isoformat()
+        return {day: count for day, count in self.daily_counts.items() if day >= cutoff}
+
+    @property
+    def recent_files(self):
+        # Day granularity: uploads from the last RECENT_DAYS calendar days
+        return sum(self._trimmed_daily_counts().values())
+
+    @classmethod
+    def rebuild(cls, user_id):
+        """
+        Recompute a user's stats from their UploadedFile rows, repairing
+        any drift. Totals and both histograms come from one GROUP BY query,
+        the recent-day buckets from a second.
+        """
+        with transaction.atomic():
+            stats, created = cls.objects.select_for_update().get_or_create(user_id=user_id)
+            stats.total_files = 0
+            stats.total_bytes = 0
+            stats.extension_counts = {}
+            stats.type_counts = {}
+            stats.daily_counts = {}
+
+            files = UploadedFile.objects.filter(user_id=user_id)
+            groups = files.values('extension', 'file_type').annotate(
+                count=models.Count('id'), bytes=models.Sum('file_size')
+            ).order_by()
+            for group in groups:
+                stats.total_files += group['count']
+                stats.total_bytes += group['bytes'] or 0
+                _bump(stats.extension_counts, cls.extension_key(group['extension']), group['count'])
+                _bump(stats.type_counts, group['file_type'] or 'other', group['count'])
+
+            cutoff = timezone.now() - datetime.timedelta(days=cls.RECENT_DAYS + 1)
+            days = files.filter(upload_date__gte=cutoff).annotate(
+                day=TruncDate('upload_date')
+            ).values('day').annotate(count=models.Count('id')).order_by()
+            for day in days:
+                _bump(stats.daily_counts, day['day'].isoformat(), day['count'])
+            stats.daily_counts = stats._trimmed_daily_counts()
+            stats.save()
+        return stats
+
+    def __str__(self):
+        return f"{self.user_id}: {self.total_files} files"
+
+def _bump(counts, key, delta):
+    counts[key] = counts.get(key, 0) + delta
+    if counts[key] <= 0:
+        del counts[key]
+
+class UploadSession(models.Model):
+    """
+    A resumable upload. In 'proxy' mode each chunk the client PUTs to us
+    becomes one part of an S3 multipart upload. In 'direct' mode the client
+    uploads straight to S3 with presigned URLs and we only verify the result.
+    Either way the UploadedFile row is only created on completion.
+    """
+    MODES = (
+        ('proxy', 'Proxied'),
+        ('direct', 'Direct'),
+    )
+    STATUSES = (
+        ('active', 'Active'),
+        ('completed', 'Completed'),
+        ('aborted', 'Aborted'),
+        # Completed in S3, but the file no longer fit the owner's quota
+        ('failed', 'Failed'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    key = models.CharField(max_length=1024)
+    # Empty for direct uploads that fit in a single presigned PUT
+    upload_id = models.CharField(max_length=1024, blank=True)
+    mode = models.CharField(max_length=10, choices=MODES, default='proxy')
+    total_size = models.BigIntegerField(blank=True, null=True)
+    content_type = models.CharField(max_length=255, blank=True)
+    checksum_sha256 = models.CharField(max_length=64, blank=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default='active')
+    uploaded_file = models.OneToOneField(
+        UploadedFile, on_delete=models.SET_NULL, blank=True, null=True, related_name='upload_session'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.status})"
+
+class UploadSessionPart(models.Model):
+    session = models.ForeignKey(UploadSession, on_delete=models.CASCADE, related_name='parts')
+    part_number = models.PositiveIntegerField()
+    etag = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    uploaded_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('session', 'part_number')
+        ordering = ['part_number']
+
+    def __str__(self):
+        return f"{self.session_id} part {self.part_number}"
@@ -0,0 +1,37 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+
+class FileCursorPagination(CursorPagination):
+    """
+    Keyset pagination over a user's files, newest first. Each page seeks on
+    the (user, upload_date, id) index, so page cost doesn't grow with depth.
+
+    While FILE_LIST_COMPAT_MODE is on, requests that send neither `cursor`
+    nor `page_size` get the old unpaginated list, so existing clients that
+    expect a bare array keep working.
+    """
+    ordering = ('-upload_date', '-id')
+    page_size_query_param = 'page_size'
+
+    def __init__(self):
+        self.page_size = settings.FILE_LIST_PAGE_SIZE
+        self.max_page_size = settings.FILE_LIST_MAX_PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if settings.FILE_LIST_COMPAT_MODE and not (
+            self.cursor_query_param in request.query_params
+            or self.page_size_query_param in request.query_params
+        ):
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+class SearchPagination(LimitOffsetPagination):
+    """
+    Limit/offset pages of ranked search results. Relevance order has no
+    stable key to seek on, but result sets are small next to a user's
+    whole library.
+    """
+
+    def __init__(self):
+        self.default_limit = settings.FILE_LIST_PAGE_SIZE
+        self.max_limit = settings.FILE_LIST_MAX_PAGE_SIZE
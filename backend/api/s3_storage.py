@@ -90,4 +90,84 @@ class S3MediaStorage(S3Boto3Storage):
             del params['ACL']
         
         # Call the parent save method
-        return super()._save(name, content) 
\ No newline at end of file
+        return super()._save(name, content) 
+
+def get_s3_client(storage=None):
+    """
+    Return the low-level boto3 client behind the given (or default) storage.
+    Used for operations django-storages doesn't expose, like multipart uploads.
+    """
+    from django.core.files.storage import default_storage
+    storage = storage or default_storage
+    return storage.connection.meta.client
+
+
+def get_object_key(name, storage=None):
+    """
+    Translate a FileField name (relative to the storage location) into the
+    full S3 object key, e.g. 'user_1/abc.pdf' -> 'uploads/user_1/abc.pdf'.
+    """
+    from django.core.files.storage import default_storage
+    from storages.utils import clean_name
+    storage = storage or default_storage
+    return storage._normalize_name(clean_name(name))
+
+
+def delete_objects(names, storage=None):
+    """
+    Delete many stored files with batched DeleteObjects calls (S3 accepts at
+    most 1000 keys per call). Keys a call reports in Errors are re-submitted
+    straight away, up to FILE_DELETE_RETRIES times, without sleeping as this
+    runs in the request's on_commit; whatever still fails is logged and
+    returned, and being orphans by then, reconcile_storage deletes them later.
+    """
+    from django.core.files.storage import default_storage
+    storage = storage or default_storage
+    names = [name for name in dict.fromkeys(names) if name]
+    if not names:
+        return []
+
+    if not hasattr(storage, 'bucket_name'):
+        # Not S3 (e.g. local files in development); delete one by one
+        failed = []
+        for name in names:
+            try:
+                storage.delete(name)
+            except Exception as e:
+                logger.error(f"Error deleting {name} from storage: {str(e)}")
+                failed.append(name)
+        return failed
+
+    client = get_s3_client(storage)
+    batch_size = settings.FILE_DELETE_BATCH_SIZE
+    failed = []
+    for start in range(0, len(names), batch_size):
+        keys = {get_object_key(name, storage): name for name in names[start:start + batch_size]}
+        pending = list(keys)
+        for attempt in range(settings.FILE_DELETE_RETRIES + 1):
+            try:
+                response = client.delete_objects(
+                    Bucket=storage.bucket_name,
+                    Delete={'Objects': [{'Key': key} for key in pending], 'Quiet': True},
+                )
+                pending = [error['Key'] for error in response.get('Errors', [])]
+            except Exception as e:
+                logger.error(f"Error deleting {len(pending)} objects from storage: {str(e)}")
+            if not pending:
+                break
+        if pending:
+            logger.error(f"Failed to delete {len(pending)} objects from storage, e.g. {pending[0]}; "
+                         f"left for reconcile_storage")
+            failed.extend(keys[key] for key in pending)
+    return failed
+
+
+def delete_objects_on_commit(names, storage=None):
+    """
+    Delete stored files once the current transaction commits, so a rollback
+    never leaves rows pointing at deleted objects.
+    """
+    from django.db import transaction
+    names = list(names)
+    if names:
+        transaction.on_commit(lambda: delete_objects(names, storage))
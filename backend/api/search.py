@@ -0,0 +1,197 @@
+"""
+Full-text search over the content of uploaded text, Word and PDF files.
+
+Text is extracted after upload in the background (see api/workers.py) and
+stored as FileText rows. The database keeps its full-text index in step
+with those rows (see migration 0013): FTS5 on SQLite, a tsvector column
+with a GIN index on PostgreSQL. Other databases fall back to a scan.
+"""
+import re
+import logging
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from django.db import IntegrityError, connection
+from . import extraction, workers
+from .downloads import ContentMissing, open_content
+from .models import FileText, UploadedFile
+
+logger = logging.getLogger(__name__)
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+def _extension(uploaded_file):
+    if uploaded_file.extension is not None:
+        return uploaded_file.extension
+    return UploadedFile.extension_for(uploaded_file.filename)
+
+def wants_text(uploaded_file):
+    return (settings.SEARCH_INDEX_ENABLED
+            and bool(uploaded_file.file)
+            and _extension(uploaded_file) in extraction.SEARCHABLE_EXTENSIONS
+            and uploaded_file.file_size <= settings.SEARCH_MAX_SOURCE_SIZE)
+
+def schedule(uploaded_files):
+    """
+    Index whichever of these new files have text, in the background once
+    the current transaction commits. Deletes need nothing: FileText rows
+    cascade and the database drops them from its index.
+    """
+    ids = [uploaded_file.pk for uploaded_file in uploaded_files if wants_text(uploaded_file)]
+    if ids:
+        workers.run_after_commit(index_files, ids)
+
+def index_files(ids, force=False):
+    """
+    Extract and store the text of the UploadedFile rows with these ids,
+    skipping rows already indexed unless force. Rows sharing content (the
+    same blob) are extracted once. Returns the number of files extracted.
+    """
+    rows = UploadedFile.objects.filter(pk__in=ids).only('id', 'file', 'blob', 'filename', 'extension', 'file_size')
+    if not force:
+        rows = rows.filter(text__isnull=True)
+    sources = {}
+    blob_names = {}
+    for row in rows:
+        if wants_text(row):
+            sources.setdefault(row.file.name, (_extension(row), []))[1].append(row.pk)
+            if row.blob_id:
+                blob_names[row.blob_id] = row.file.name
+    if not sources:
+        return 0
+
+    if not force and blob_names:
+        # Another row with the same content (blob) may have been indexed
+        # already; both lookups go through indexed ids
+        siblings = dict(UploadedFile.objects.filter(blob_id__in=list(blob_names)).values_list('id', 'blob_id'))
+        existing = FileText.objects.filter(uploaded_file_id__in=list(siblings)).values_list('uploaded_file_id', 'content')
+        for pk, content in existing:
+            source = sources.pop(blob_names[siblings[pk]], None)
+            if source is not None:
+                _store(source[1], content)
+
+    pool = workers.process_pool()
+    pending = {}
+    extracted = 0
+    try:
+        for name, (extension, pks) in sources.items():
+            # Keep every worker busy without holding every source in memory
+            if len(pending) >= settings.BACKGROUND_WORKERS * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                extracted += _finish(done, pending)
+            data = _read_source(name)
+            if data is None:
+                continue
+            future = pool.submit(extraction.extract_text, data, extension, settings.SEARCH_MAX_TEXT_LENGTH)
+            pending[future] = (name, pks)
+        extracted += _finish(list(pending), pending)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory); start a fresh pool next time
+        workers.reset_process_pool(pool)
+        raise
+    return extracted
+
+def _read_source(name):
+    try:
+        return b''.join(open_content(name))
+    except ContentMissing as e:
+        logger.error(f"Can't index {name}: {str(e)}")
+        return None
+
+def _finish(futures, pending):
+    stored = 0
+    for future in futures:
+        name, pks = pending.pop(future)
+        try:
+            content = future.result()
+        except BrokenProcessPool:
+            raise
+        except Exception as e:
+            # Recorded as empty so it isn't retried on every rebuild
+            logger.error(f"Error extracting text from {name}: {str(e)}")
+            content = ''
+        _store(pks, content)
+        stored += 1
+    return stored
+
+def _store(pks, content):
+    for pk in pks:
+        try:
+            FileText.objects.update_or_create(uploaded_file_id=pk, defaults={'content': content})
+        except IntegrityError:
+            # The file was deleted while we extracted its text
+            pass
+
+def optimize_index():
+    """
+    Merge the index's segments after a large rebuild (SQLite only;
+    PostgreSQL maintains its GIN index itself).
+    """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO api_filetext_fts(api_filetext_fts) VALUES ('optimize')")
+
+class SearchResults:
+    """
+    A user's files whose text matches query, best first, as
+    {'id', 'rank', 'snippet'} dicts. Sliced and counted lazily, like a
+    queryset, so a paginator only runs the page it needs.
+    """
+
+    def __init__(self, user, query):
+        self.user_id = user.pk
+        self.query = query
+        self.terms = TERM_RE.findall(query)
+
+    def count(self):
+        if not self.terms:
+            return 0
+        sql, params = self._sql('SELECT COUNT(*)', '')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0]
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        if not self.terms:
+            return []
+        offset = index.start or 0
+        stop = index.stop if index.stop is not None else self.count()
+        sql, params = self._sql(self._select(), ' ORDER BY rank, f.id DESC LIMIT %s OFFSET %s')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + [max(stop - offset, 0), offset])
+            return [{'id': pk, 'rank': rank, 'snippet': snippet} for pk, rank, snippet in cursor.fetchall()]
+
+    def _select(self):
+        length = settings.SEARCH_SNIPPET_WORDS
+        if connection.vendor == 'sqlite':
+            # bm25() is negative, lower is better
+            return (f"SELECT f.id, bm25(api_filetext_fts) AS rank, "
+                    f"snippet(api_filetext_fts, 0, '', '', '...', {length}) AS snippet")
+        if connection.vendor == 'postgresql':
+            return (f"SELECT f.id, -ts_rank_cd(t.search_vector, query) AS rank, "
+                    f"ts_headline('english', t.content, query, "
+                    f"'StartSel=\"\",StopSel=\"\",MaxWords={length},MinWords={length // 2}') AS snippet")
+        return "SELECT f.id, 0 AS rank, '' AS snippet"
+
+    def _sql(self, select, tail):
+        if connection.vendor == 'sqlite':
+            # Each term quoted so FTS5 syntax in the query is taken literally;
+            # the last one as a prefix, for search-as-you-type
+            match = ' '.join('"%s"' % term for term in self.terms) + '*'
+            return (f"{select} FROM api_filetext_fts "
+                    f"JOIN api_uploadedfile f ON f.id = api_filetext_fts.rowid "
+                    f"WHERE api_filetext_fts MATCH %s AND f.user_id = %s{tail}"), [match, self.user_id]
+        if connection.vendor == 'postgresql':
+            return (f"{select} FROM api_filetext t "
+                    f"JOIN api_uploadedfile f ON f.id = t.uploaded_file_id, "
+                    f"websearch_to_tsquery('english', %s) query "
+                    f"WHERE t.search_vector @@ query AND f.user_id = %s{tail}"), [self.query, self.user_id]
+        conditions = ' AND '.join(['t.content LIKE %s'] * len(self.terms))
+        return (f"{select} FROM api_filetext t "
+                f"JOIN api_uploadedfile f ON f.id = t.uploaded_file_id "
+                f"WHERE {conditions} AND f.user_id = %s{tail}"), [f'%{term}%' for term in self.terms] + [self.user_id]
@@ -1,7 +1,8 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import Address, UploadedFile, User
+from .models import Address, UploadedFile, User, UploadSession, UploadSessionPart
 from django.contrib.auth.password_validation import validate_password
+from .url_cache import get_urls
 
 User = get_user_model()
 
@@ -17,17 +18,173 @@ class AddressSerializer(serializers.ModelSerializer):
         fields = ['id', 'street', 'city', 'state', 'postal_code', 'country', 'is_default', 'user']
         read_only_fields = ['user']
 
-class UploadedFileSerializer(serializers.ModelSerializer):
+def requested_fields(request):
+    """
+    Field names asked for with ?fields=a,b,c, or None for the full shape.
+    """
+    if request is None:
+        return None
+    # DRF requests have query_params; plain Django (async) views pass GET
+    value = getattr(request, 'query_params', request.GET).get('fields')
+    if not value:
+        return None
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+class SparseFieldsetMixin:
+    """
+    Lets clients trim a serializer's output with ?fields=a,b,c.
+    Unknown names are ignored.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = requested_fields(self.context.get('request'))
+        if fields:
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
+
+class FileURLField(serializers.FileField):
+    """
+    Accepts an upload like a FileField, but reads back as the file's URL
+    through UploadedFile.url, the one place URLs are derived.
+    """
+    def get_attribute(self, instance):
+        return instance
+
+    def to_representation(self, value):
+        return value.url
+
+class UploadedFileListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        # Resolve every row's URLs in one batch instead of one cache lookup each
+        instances = list(data.all() if hasattr(data, 'all') else data)
+        urls = get_urls([instance.file.name for instance in instances if instance.file]
+                        + [instance.thumbnail for instance in instances if instance.thumbnail])
+        for instance in instances:
+            if instance.file:
+                instance.url = urls[instance.file.name]
+            if instance.thumbnail:
+                instance.thumbnail_url = urls[instance.thumbnail]
+        return super().to_representation(instances)
+
+class UploadedFileSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
-    file_url = serializers.URLField(read_only=True)
+    file = FileURLField()
+    file_url = FileURLField(read_only=True)
     file_size = serializers.IntegerField(read_only=True, required=False)
     file_type = serializers.CharField(required=False)  # Make file_type optional
     filename = serializers.CharField(required=False)  # Make filename optional
+    thumbnail_url = serializers.CharField(read_only=True)
     
     class Meta:
         model = UploadedFile
-        fields = ['id', 'user', 'file', 'filename', 'file_type', 'file_size', 'file_url', 'upload_date']
-        read_only_fields = ['id', 'user', 'file_url', 'upload_date']
+        fields = ['id', 'user', 'file', 'filename', 'file_type', 'file_size', 'file_url', 'thumbnail_url',
+                  'upload_date']
+        read_only_fields = ['id', 'user', 'file_url', 'thumbnail_url', 'upload_date']
+        list_serializer_class = UploadedFileListSerializer
+
+class UploadedFileValuesSerializer:
+    """
+    Compact list representation built straight from .values() rows, skipping
+    model instances and per-field DRF overhead. The owner is referenced by
+    id instead of a nested user. Honours ?fields= like the full serializer.
+    """
+    FIELDS = ['id', 'user', 'file', 'filename', 'file_type', 'file_size', 'file_url', 'thumbnail_url',
+              'upload_date']
+    COLUMNS = {
+        'id': ['id'],
+        'user': ['user_id'],
+        'file': ['file', 'file_url'],
+        'filename': ['filename'],
+        'file_type': ['file_type'],
+        'file_size': ['file_size'],
+        'file_url': ['file', 'file_url'],
+        'thumbnail_url': ['thumbnail'],
+        'upload_date': ['upload_date'],
+    }
+    # Cursor pagination reads its position from these
+    CURSOR_COLUMNS = ['id', 'upload_date']
+
+    def __init__(self, fields=None):
+        self.fields = [name for name in self.FIELDS if not fields or name in fields]
+        self._date_field = serializers.DateTimeField()
+
+    def columns(self):
+        columns = set(self.CURSOR_COLUMNS)
+        for name in self.fields:
+            columns.update(self.COLUMNS[name])
+        return sorted(columns)
+
+    def to_representation(self, rows):
+        rows = list(rows)
+        names = []
+        if 'file' in self.fields or 'file_url' in self.fields:
+            names += [row['file'] for row in rows if row['file']]
+        if 'thumbnail_url' in self.fields:
+            names += [row['thumbnail'] for row in rows if row['thumbnail']]
+        urls = get_urls(names) if names else {}
+
+        data = []
+        for row in rows:
+            item = {}
+            for name in self.fields:
+                if name == 'user':
+                    item['user'] = row['user_id']
+                elif name in ('file', 'file_url'):
+                    # Same fallback as UploadedFile.url for legacy rows
+                    item[name] = urls.get(row['file']) or row['file_url']
+                elif name == 'thumbnail_url':
+                    item['thumbnail_url'] = urls.get(row['thumbnail']) if row['thumbnail'] else None
+                elif name == 'upload_date':
+                    item['upload_date'] = self._date_field.to_representation(row['upload_date'])
+                else:
+                    item[name] = row[name]
+            data.append(item)
+        return data
+
+class UploadSessionPartSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSessionPart
+        fields = ['part_number', 'size', 'etag', 'uploaded_at']
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    parts = UploadSessionPartSerializer(many=True, read_only=True)
+    uploaded_file = UploadedFileSerializer(read_only=True)
+    uploaded_size = serializers.SerializerMethodField()
+    next_part_number = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'mode', 'filename', 'total_size', 'content_type', 'checksum_sha256', 'status', 'parts',
+                  'uploaded_size', 'next_part_number', 'uploaded_file', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'mode', 'checksum_sha256', 'status', 'uploaded_file', 'created_at', 'updated_at']
+
+    def get_uploaded_size(self, obj):
+        return sum(part.size for part in obj.parts.all())
+
+    def get_next_part_number(self, obj):
+        # First gap in the acknowledged parts, so clients can resume from there
+        numbers = {part.part_number for part in obj.parts.all()}
+        next_number = 1
+        while next_number in numbers:
+            next_number += 1
+        return next_number
+
+class DirectUploadSerializer(serializers.Serializer):
+    filename = serializers.CharField(max_length=255)
+    total_size = serializers.IntegerField(min_value=1)
+    content_type = serializers.CharField(max_length=255, required=False)
+    # Base64-encoded SHA-256 of the whole file, as S3 expects it
+    checksum_sha256 = serializers.CharField(max_length=64, required=False)
+
+class CompletedPartSerializer(serializers.Serializer):
+    part_number = serializers.IntegerField(min_value=1)
+    # As S3 returned it in the part's ETag response header
+    etag = serializers.CharField(max_length=255)
+    checksum_sha256 = serializers.CharField(max_length=64, required=False)
+
+class CompleteUploadSerializer(serializers.Serializer):
+    # Required for direct multipart uploads, ignored otherwise
+    parts = CompletedPartSerializer(many=True, required=False)
 
 class UserRegisterSerializer(serializers.ModelSerializer):
     password2 = serializers.CharField(write_only=True)
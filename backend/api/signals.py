@@ -1,13 +1,86 @@
-from django.db.models.signals import pre_delete
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from .models import UploadedFile
-import os
+from rest_framework.authtoken.models import Token
+from .models import User, Blob, UploadedFile, UserFileStats, UserQuota
+from .authentication import invalidate_token
+from .s3_storage import delete_objects_on_commit
+from . import activity, search, thumbnails
 
-@receiver(pre_delete, sender=UploadedFile)
-def delete_file_on_model_delete(sender, instance, **kwargs):
+_deleting = threading.local()
+
+@contextmanager
+def batched_file_deletes(request=None):
+    """
+    Collect the UploadedFile rows deleted inside the block and release them
+    together when it exits, instead of one row at a time as they're deleted:
+    blobs and stored objects in batches, stats and quota once per user.
+    Their activity events carry the request's client IP.
+    """
+    _deleting.files = files = []
+    _deleting.request = request
+    try:
+        yield
+    finally:
+        del _deleting.files, _deleting.request
+    release_files(files)
+
+def release_files(files):
+    """
+    Everything deleting UploadedFile rows entails besides the rows and the
+    activity log: the stored content (storage only touched once the
+    transaction commits) and the owners' stats and quota.
+    """
+    Blob.release_many(Counter(f.blob_id for f in files if f.blob_id))
+    # Deduplicated content is shared; Blob.release_many removes it with the
+    # last reference
+    delete_objects_on_commit([f.file.name for f in files if not f.blob_id and f.file]
+                             + [f.thumbnail for f in files if not f.blob_id and f.thumbnail])
+    by_user = defaultdict(list)
+    for f in files:
+        by_user[f.user_id].append(f)
+    for user_id, user_files in by_user.items():
+        UserFileStats.record_deletes(user_id, user_files)
+        UserQuota.release(user_id, sum(f.file_size or 0 for f in user_files), len(user_files))
+
+@receiver(post_delete, sender=UploadedFile)
+def release_deleted_file(sender, instance, **kwargs):
+    """
+    Release what an UploadedFile held however it was deleted (instance,
+    queryset or cascade), or leave it to the enclosing batched_file_deletes.
+    The activity event is built here, while the instance still has its pk.
+    """
+    activity.log_file(activity.DELETE, instance, getattr(_deleting, 'request', None))
+    files = getattr(_deleting, 'files', None)
+    if files is not None:
+        files.append(instance)
+    else:
+        release_files([instance])
+
+@receiver(post_save, sender=UploadedFile)
+def record_upload_in_stats(sender, instance, created, **kwargs):
+    """
+    Count a new file in the owner's UserFileStats. bulk_create doesn't send
+    this signal, so bulk inserts record their files themselves.
+    """
+    if created:
+        UserFileStats.record_uploads(instance.user_id, [instance])
+        activity.log_file(activity.UPLOAD, instance)
+        thumbnails.schedule([instance])
+        search.schedule([instance])
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(sender, instance, created, **kwargs):
     """
-    Delete the file from the filesystem when the UploadedFile instance is deleted.
+    Cached tokens carry a copy of the user, so any change to the user
+    (deactivation included) drops their token from the cache.
     """
-    if instance.file:
-        if os.path.isfile(instance.file.path):
-            os.remove(instance.file.path) 
\ No newline at end of file
+    if not created:
+        for key in Token.objects.filter(user=instance).values_list('key', flat=True):
+            invalidate_token(key)
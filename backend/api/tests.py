@@ -1,3 +1,1060 @@
-from django.test import TestCase
+import io
+import os
+import time
+import shutil
+import asyncio
+import hashlib
+import datetime
+import tempfile
+import zipfile
+from concurrent.futures import Future
+from unittest import mock, skipUnless
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import QueryDict
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from . import accounts, activity, async_s3, authentication, downloads, filters, firebase_auth, imaging
+from . import s3_storage, search, thumbnails, workers
+from .models import Blob, FileText, User, UploadedFile, UploadSession, UserQuota
+from .s3_storage import get_object_key
 
-# Create your tests here.
+TEST_MEDIA_ROOT = tempfile.mkdtemp(prefix='api-tests-')
+
+def tearDownModule():
+    shutil.rmtree(TEST_MEDIA_ROOT, ignore_errors=True)
+
+# No Mongo and no background work in tests; uploads go straight to storage
+test_settings = override_settings(
+    FILE_UPLOAD_STREAM_TO_S3=False,
+    ACTIVITY_LOG_ENABLED=False,
+    THUMBNAIL_ENABLED=False,
+    SEARCH_INDEX_ENABLED=False,
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+)
+
+# Local files instead of S3, for tests that store content
+local_storage = override_settings(STORAGES={
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+        'OPTIONS': {'location': TEST_MEDIA_ROOT},
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+})
+
+class APITestCase(TestCase):
+    """
+    Test case with a user and an API client authenticated as them.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = self.create_user('alice')
+        self.client = self.client_for(self.user)
+
+    def create_user(self, username):
+        return User.objects.create_user(username=username, email=f'{username}@example.com', password='password')
+
+    def client_for(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+        return client
+
+@test_settings
+class UploadSessionTests(APITestCase):
+    """
+    Proxied sessions against a stand-in for the S3 client.
+    """
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('api.uploads.get_s3_client')
+        self.s3 = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        self.s3.upload_part.side_effect = lambda PartNumber, Body, **params: {'ETag': f'"etag-{PartNumber}-{len(Body)}"'}
+
+    def start(self, **data):
+        response = self.client.post('/api/uploads/', {'filename': 'report.pdf', **data})
+        self.assertEqual(response.status_code, 201)
+        return response.data['id']
+
+    def put_part(self, session_id, part_number, data):
+        return self.client.generic('PUT', f'/api/uploads/{session_id}/parts/{part_number}/', data,
+                                   content_type='application/octet-stream')
+
+    def test_upload_and_complete(self):
+        session_id = self.start(total_size=11)
+        self.assertEqual(self.put_part(session_id, 1, b'hello ').status_code, 200)
+        self.assertEqual(self.put_part(session_id, 2, b'world').status_code, 200)
+
+        response = self.client.post(f'/api/uploads/{session_id}/complete/')
+        self.assertEqual(response.status_code, 201)
+        uploaded_file = UploadedFile.objects.get(pk=response.data['id'])
+        self.assertEqual((uploaded_file.filename, uploaded_file.file_size, uploaded_file.file_type),
+                         ('report.pdf', 11, 'pdf'))
+        session = UploadSession.objects.get(pk=session_id)
+        self.assertEqual((session.status, session.uploaded_file_id), ('completed', uploaded_file.pk))
+        self.assertEqual(self.s3.complete_multipart_upload.call_args.kwargs['MultipartUpload'], {'Parts': [
+            {'PartNumber': 1, 'ETag': '"etag-1-6"'},
+            {'PartNumber': 2, 'ETag': '"etag-2-5"'},
+        ]})
+
+        # A session completes once
+        self.assertEqual(self.client.post(f'/api/uploads/{session_id}/complete/').status_code, 400)
+        self.assertEqual(UploadedFile.objects.count(), 1)
+
+    def test_resent_part_replaces_the_earlier_attempt(self):
+        session_id = self.start()
+        self.put_part(session_id, 1, b'first try')
+        self.put_part(session_id, 1, b'retry')
+        response = self.client.get(f'/api/uploads/{session_id}/')
+        self.assertEqual(response.data['uploaded_size'], 5)
+        self.assertEqual(response.data['next_part_number'], 2)
+
+    def test_complete_rejects_missing_parts_and_wrong_size(self):
+        session_id = self.start(total_size=100)
+        self.put_part(session_id, 1, b'a' * 10)
+        self.put_part(session_id, 3, b'c' * 10)
+        self.assertEqual(self.client.post(f'/api/uploads/{session_id}/complete/').status_code, 400)
+
+        self.put_part(session_id, 2, b'b' * 10)
+        self.assertEqual(self.client.post(f'/api/uploads/{session_id}/complete/').status_code, 400)
+
+        self.s3.complete_multipart_upload.assert_not_called()
+        self.assertEqual(UploadSession.objects.get(pk=session_id).status, 'active')
+        self.assertFalse(UploadedFile.objects.exists())
+
+    def test_abort(self):
+        session_id = self.start()
+        self.put_part(session_id, 1, b'data')
+        self.assertEqual(self.client.delete(f'/api/uploads/{session_id}/').status_code, 204)
+        self.s3.abort_multipart_upload.assert_called_once()
+        self.assertEqual(UploadSession.objects.get(pk=session_id).status, 'aborted')
+        self.assertEqual(self.put_part(session_id, 2, b'more').status_code, 400)
+        self.assertEqual(self.client.post(f'/api/uploads/{session_id}/complete/').status_code, 400)
+
+    def test_sessions_are_private(self):
+        session_id = self.start()
+        other = self.client_for(self.create_user('bob'))
+        self.assertEqual(other.get(f'/api/uploads/{session_id}/').status_code, 404)
+        self.assertEqual(other.post(f'/api/uploads/{session_id}/complete/').status_code, 404)
+
+@test_settings
+@override_settings(UPLOAD_PRESIGN_SINGLE_PUT_MAX=10, UPLOAD_PRESIGN_PART_SIZE=10)
+class DirectUploadTests(APITestCase):
+    """
+    Direct multipart uploads: 25 bytes presigned as parts of 10, 10 and 5.
+    """
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('api.uploads.get_s3_client')
+        self.s3 = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        self.s3.generate_presigned_url.return_value = 'https://s3.example.com/signed'
+        self.received = [
+            {'PartNumber': 1, 'ETag': '"e1"', 'Size': 10},
+            {'PartNumber': 2, 'ETag': '"e2"', 'Size': 10},
+            {'PartNumber': 3, 'ETag': '"e3"', 'Size': 5},
+        ]
+        self.s3.list_parts.side_effect = lambda **params: {'Parts': self.received, 'IsTruncated': False}
+
+        response = self.client.post('/api/uploads/presign/', {'filename': 'video.mp4', 'total_size': 25})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['upload']['parts']), 3)
+        self.session_id = response.data['id']
+
+    def complete(self, parts):
+        return self.client.post(f'/api/uploads/{self.session_id}/complete/', {'parts': parts}, format='json')
+
+    def reported(self):
+        return [{'part_number': part['PartNumber'], 'etag': part['ETag']} for part in self.received]
+
+    def assertNotCompleted(self, response):
+        self.assertEqual(response.status_code, 400)
+        self.s3.complete_multipart_upload.assert_not_called()
+        self.assertEqual(UploadSession.objects.get(pk=self.session_id).status, 'active')
+
+    def test_complete(self):
+        response = self.complete(self.reported())
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(UploadedFile.objects.get(pk=response.data['id']).file_size, 25)
+        self.assertEqual(self.s3.complete_multipart_upload.call_args.kwargs['MultipartUpload'], {'Parts': [
+            {'PartNumber': 1, 'ETag': '"e1"'},
+            {'PartNumber': 2, 'ETag': '"e2"'},
+            {'PartNumber': 3, 'ETag': '"e3"'},
+        ]})
+
+    def test_parts_must_be_reported(self):
+        self.assertNotCompleted(self.client.post(f'/api/uploads/{self.session_id}/complete/'))
+
+    def test_etag_mismatch(self):
+        parts = self.reported()
+        parts[1]['etag'] = '"something-else"'
+        self.assertNotCompleted(self.complete(parts))
+
+    def test_missing_part(self):
+        self.assertNotCompleted(self.complete(self.reported()[:2]))
+
+    def test_truncated_part(self):
+        # Same total, but not the layout the URLs were presigned for
+        self.received[1] = {'PartNumber': 2, 'ETag': '"e2"', 'Size': 8}
+        self.received[2] = {'PartNumber': 3, 'ETag': '"e3"', 'Size': 7}
+        self.assertNotCompleted(self.complete(self.reported()))
+
+    def test_checksums(self):
+        for part in self.received:
+            part['ChecksumSHA256'] = f"sum-{part['PartNumber']}"
+        parts = self.reported()
+        parts[2]['checksum_sha256'] = 'wrong'
+        self.assertNotCompleted(self.complete(parts))
+
+        parts[2]['checksum_sha256'] = 'sum-3'
+        self.assertEqual(self.complete(parts).status_code, 201)
+        self.assertEqual(self.s3.complete_multipart_upload.call_args.kwargs['MultipartUpload']['Parts'][2],
+                         {'PartNumber': 3, 'ETag': '"e3"', 'ChecksumSHA256': 'sum-3'})
+
+@test_settings
+@local_storage
+@override_settings(FILE_DEDUP_ENABLED=True)
+class DeduplicationTests(APITestCase):
+
+    def upload(self, name, content):
+        response = self.client.post('/api/files/', {'file': SimpleUploadedFile(name, content)})
+        self.assertEqual(response.status_code, 201)
+        return UploadedFile.objects.get(pk=response.data['id'])
+
+    def delete(self, uploaded_file):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.delete(f'/api/files/{uploaded_file.pk}/').status_code, 204)
+
+    def test_identical_content_is_stored_once(self):
+        first = self.upload('a.txt', b'same content')
+        second = self.upload('b.txt', b'same content')
+        other = self.upload('c.txt', b'other content')
+
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertNotEqual(first.blob_id, other.blob_id)
+        self.assertEqual(Blob.objects.get(pk=first.blob_id).ref_count, 2)
+        self.assertEqual(Blob.objects.get(pk=other.blob_id).ref_count, 1)
+        self.assertEqual(second.filename, 'b.txt')
+
+    def test_content_goes_with_the_last_reference(self):
+        first = self.upload('a.txt', b'same content')
+        second = self.upload('b.txt', b'same content')
+        name = first.file.name
+
+        self.delete(first)
+        self.assertEqual(Blob.objects.get(pk=second.blob_id).ref_count, 1)
+        self.assertTrue(default_storage.exists(name))
+
+        self.delete(second)
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(default_storage.exists(name))
+
+    def test_failed_upload_leaves_nothing_stored(self):
+        with mock.patch.object(UploadedFile, 'save', side_effect=RuntimeError('database is down')), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/files/', {'file': SimpleUploadedFile('a.txt', b'content')})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Blob.objects.exists())
+        digest = hashlib.sha256(b'content').hexdigest()
+        self.assertEqual(default_storage.listdir(f'blobs/{digest[:2]}')[1], [])
+
+    def test_bulk_upload_counts_every_reference(self):
+        existing = self.upload('a.txt', b'one')
+        response = self.client.post('/api/files/bulk/', {'files': [
+            SimpleUploadedFile('b.txt', b'one'),
+            SimpleUploadedFile('c.txt', b'two'),
+            SimpleUploadedFile('d.txt', b'two'),
+        ]})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Blob.objects.count(), 2)
+        self.assertEqual(Blob.objects.get(pk=existing.blob_id).ref_count, 2)
+        third, fourth = UploadedFile.objects.filter(filename__in=['c.txt', 'd.txt'])
+        self.assertEqual((third.blob_id, third.file.name), (fourth.blob_id, fourth.file.name))
+        self.assertEqual(third.blob.ref_count, 2)
+
+    def test_bulk_delete_releases_shared_blobs(self):
+        files = [self.upload(name, b'shared') for name in ('a.txt', 'b.txt', 'c.txt')]
+        name = files[0].file.name
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/files/bulk-delete/', {'ids': [files[0].pk, files[1].pk]}, format='json')
+        self.assertEqual(response.data['deleted'], 2)
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+        self.assertTrue(default_storage.exists(name))
+
+        self.delete(files[2])
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(default_storage.exists(name))
+
+@test_settings
+@local_storage
+@override_settings(FILE_LIST_COMPAT_MODE=True)
+class FileListPaginationTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Several files share an upload time, so only the id breaks ties
+        now = timezone.now()
+        self.files = []
+        for i in range(7):
+            uploaded_file = UploadedFile.objects.create(user=self.user, file=f'user_{self.user.pk}/{i}.txt',
+                                                        filename=f'{i}.txt', file_size=i + 1)
+            UploadedFile.objects.filter(pk=uploaded_file.pk).update(upload_date=now - datetime.timedelta(minutes=i // 3))
+            self.files.append(uploaded_file.pk)
+
+    def pages(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def expected(self):
+        return list(UploadedFile.objects.filter(user=self.user).order_by('-upload_date', '-id').values_list('id', flat=True))
+
+    def test_pages_cover_every_file_once_in_order(self):
+        ids = self.pages('/api/files/?page_size=2')
+        self.assertEqual(ids, self.expected())
+        self.assertEqual(len(ids), 7)
+
+    def test_new_uploads_dont_shift_later_pages(self):
+        response = self.client.get('/api/files/?page_size=3')
+        seen = [item['id'] for item in response.data['results']]
+        UploadedFile.objects.create(user=self.user, file=f'user_{self.user.pk}/new.txt', filename='new.txt', file_size=1)
+        seen.extend(self.pages(response.data['next']))
+        self.assertEqual(seen, self.expected()[1:])
+
+    def test_only_own_files(self):
+        other = self.create_user('bob')
+        UploadedFile.objects.create(user=other, file=f'user_{other.pk}/x.txt', filename='x.txt', file_size=1)
+        self.assertEqual(sorted(self.pages('/api/files/?page_size=5')), sorted(self.files))
+
+    def test_compat_mode_returns_the_whole_list(self):
+        response = self.client.get('/api/files/')
+        self.assertEqual([item['id'] for item in response.data], self.expected())
+
+@test_settings
+@mock.patch.object(firebase_auth, 'firebase_app', mock.Mock(project_id='test-project'))
+@mock.patch.object(firebase_auth.auth, 'get_user')
+@mock.patch.object(firebase_auth.auth, 'verify_id_token')
+class FirebaseAuthTests(TestCase):
+    """
+    The backend against a stand-in for the Firebase Admin SDK.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.backend = firebase_auth.FirebaseAuthBackend()
+
+    def claims(self, **claims):
+        return {'uid': 'firebase-uid', 'email': 'carol@example.com', 'name': 'Carol Jones',
+                'exp': time.time() + 3600, **claims}
+
+    def test_repeat_login_is_served_from_the_cache(self, verify_id_token, get_user):
+        verify_id_token.return_value = self.claims()
+        user = self.backend.authenticate(None, token='id-token')
+        self.assertEqual((user.username, user.email, user.first_name, user.last_name),
+                         ('carol', 'carol@example.com', 'Carol', 'Jones'))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.authenticate(None, token='id-token').pk, user.pk)
+        verify_id_token.assert_called_once_with('id-token', app=firebase_auth.firebase_app)
+        get_user.assert_not_called()
+
+    def test_profile_comes_from_firebase_when_the_token_has_no_email(self, verify_id_token, get_user):
+        verify_id_token.return_value = self.claims(email=None)
+        get_user.return_value = mock.Mock(email='dave@example.com', display_name='Dave', phone_number='+15550100')
+        user = self.backend.authenticate(None, token='id-token')
+        self.assertEqual((user.email, user.first_name, user.phone_number), ('dave@example.com', 'Dave', '+15550100'))
+        get_user.assert_called_once_with('firebase-uid')
+
+    def test_invalid_tokens_are_rejected_and_not_cached(self, verify_id_token, get_user):
+        verify_id_token.side_effect = ValueError('bad token')
+        self.assertIsNone(self.backend.authenticate(None, token='id-token'))
+        self.assertIsNone(self.backend.authenticate(None, token='id-token'))
+        self.assertEqual(verify_id_token.call_count, 2)
+        self.assertFalse(User.objects.exists())
+
+@test_settings
+class CachedTokenAuthenticationTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        authentication._local.clear()
+        self.key = Token.objects.get(user=self.user).key
+
+    def test_repeated_lookups_are_cached(self):
+        backend = authentication.CachedTokenAuthentication()
+        before = authentication.cache_stats()
+        backend.authenticate_credentials(self.key)
+        with self.assertNumQueries(0):
+            user, token = backend.authenticate_credentials(self.key)
+        after = authentication.cache_stats()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['local_hits'] - before['local_hits'], 1)
+        self.assertEqual((user.pk, token.key), (self.user.pk, self.key))
+
+    def test_each_request_gets_its_own_user(self):
+        backend = authentication.CachedTokenAuthentication()
+        backend.authenticate_credentials(self.key)
+        first, token = backend.authenticate_credentials(self.key)
+        first.first_name = 'Changed'
+        second, token = backend.authenticate_credentials(self.key)
+        self.assertIsNot(first, second)
+        self.assertEqual(second.first_name, '')
+
+    def test_password_hash_is_not_cached(self):
+        backend = authentication.CachedTokenAuthentication()
+        backend.authenticate_credentials(self.key)
+        snapshot = cache.get(authentication._cache_key(self.key))
+        self.assertNotIn('password', dict(snapshot[2]))
+        user, token = backend.authenticate_credentials(self.key)
+        self.assertTrue(user.check_password('password'))
+
+    def test_changing_the_user_invalidates(self):
+        self.assertEqual(self.client.get('/api/profile/').status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/profile/').status_code, 401)
+
+    def test_profile_edits_are_seen_by_the_next_request(self):
+        self.client.get('/api/profile/')
+        self.client.patch('/api/profile/', {'first_name': 'Alice'})
+        self.assertEqual(self.client.get('/api/profile/').data['first_name'], 'Alice')
+
+    def test_deleting_the_token_invalidates(self):
+        self.assertEqual(self.client.get('/api/profile/').status_code, 200)
+        Token.objects.filter(key=self.key).delete()
+        self.assertEqual(self.client.get('/api/profile/').status_code, 401)
+
+    def test_logout_invalidates(self):
+        self.assertEqual(self.client.get('/api/profile/').status_code, 200)
+        self.assertIsNotNone(authentication._local.get(self.key, time.time()))
+        self.client.post('/api/logout/')
+        self.assertIsNone(authentication._local.get(self.key, time.time()))
+
+    def test_stats_are_for_staff(self):
+        self.assertEqual(self.client.get('/api/stats/').status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get('/api/stats/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hit_rate', response.data['token_auth_cache'])
+
+@test_settings
+class UsernameProvisioningTests(TestCase):
+
+    def test_unique_username(self):
+        self.assertEqual(accounts.unique_username('john'), 'john')
+        for username in ('john', 'john_1', 'john_9', 'john_x', 'johnny', 'johnny_12', 'john.doe_40'):
+            User.objects.create(username=username)
+        self.assertEqual(accounts.unique_username('john'), 'john_10')
+        self.assertEqual(accounts.unique_username('john.doe'), 'john.doe')
+        self.assertEqual(accounts.unique_username('johnny'), 'johnny_13')
+
+    def test_provision_user(self):
+        User.objects.create(username='mary', email='mary@other.example.com')
+        user = accounts.get_or_provision_user('mary@example.com')
+        self.assertEqual((user.username, user.email), ('mary_1', 'mary@example.com'))
+        self.assertFalse(user.has_usable_password())
+        self.assertEqual(accounts.get_or_provision_user('mary@example.com').pk, user.pk)
+
+@test_settings
+class AsyncS3Tests(TestCase):
+
+    @mock.patch('api.async_s3.get_session', None)
+    @mock.patch('api.async_s3.get_s3_client')
+    def test_client_is_reused_within_an_event_loop(self, get_s3_client):
+        s3 = get_s3_client.return_value
+
+        async def upload_twice():
+            await async_s3.upload_file('user_1/a.txt', SimpleUploadedFile('a.txt', b'first'))
+            await async_s3.upload_file('user_1/b.txt', SimpleUploadedFile('b.txt', b'second'))
+            await async_s3.delete_file('user_1/a.txt')
+
+        asyncio.run(upload_twice())
+        get_s3_client.assert_called_once()
+        self.assertEqual([c.kwargs['Body'] for c in s3.put_object.call_args_list], [b'first', b'second'])
+        self.assertEqual(s3.put_object.call_args.kwargs['Key'], 'uploads/user_1/b.txt')
+        s3.delete_object.assert_called_once()
+
+@test_settings
+@local_storage
+@override_settings(FILE_DEDUP_ENABLED=False)
+class BulkDeleteTests(APITestCase):
+
+    def upload(self, name, content, client=None):
+        response = (client or self.client).post('/api/files/', {'file': SimpleUploadedFile(name, content)})
+        self.assertEqual(response.status_code, 201)
+        return UploadedFile.objects.get(pk=response.data['id'])
+
+    def bulk_delete(self, ids):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/files/bulk-delete/', {'ids': ids}, format='json')
+
+    def test_deletes_rows_objects_and_usage(self):
+        files = [self.upload(f'{i}.txt', b'x' * (i + 1)) for i in range(3)]
+        names = [f.file.name for f in files]
+
+        response = self.bulk_delete([files[0].pk, files[1].pk])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'deleted': 2, 'not_found': []})
+        self.assertEqual(list(UploadedFile.objects.values_list('pk', flat=True)), [files[2].pk])
+        self.assertEqual([default_storage.exists(name) for name in names], [False, False, True])
+        self.user.file_stats.refresh_from_db()
+        self.assertEqual((self.user.file_stats.total_files, self.user.file_stats.total_bytes), (1, 3))
+        self.user.quota.refresh_from_db()
+        self.assertEqual((self.user.quota.used_files, self.user.quota.used_bytes), (1, 3))
+
+    def test_reports_missing_and_foreign_ids_as_not_found(self):
+        mine = self.upload('mine.txt', b'mine')
+        theirs = self.upload('theirs.txt', b'theirs', self.client_for(self.create_user('bob')))
+
+        response = self.bulk_delete([mine.pk, theirs.pk, theirs.pk + 1000])
+        self.assertEqual(response.data, {'deleted': 1, 'not_found': sorted([theirs.pk, theirs.pk + 1000])})
+        self.assertTrue(UploadedFile.objects.filter(pk=theirs.pk).exists())
+        self.assertTrue(default_storage.exists(theirs.file.name))
+
+    @override_settings(ACTIVITY_LOG_ENABLED=True)
+    @mock.patch.object(activity.writer, 'log')
+    def test_delete_events_keep_file_ids_and_client_ip(self, log):
+        files = [self.upload(f'{i}.txt', b'x') for i in range(3)]
+        log.reset_mock()
+
+        self.bulk_delete([files[0].pk, files[1].pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/files/{files[2].pk}/', REMOTE_ADDR='10.0.0.2')
+        events = [call.args[0] for call in log.call_args_list]
+        self.assertEqual(sorted((e['action'], e['file_id'], e['ip']) for e in events), [
+            (activity.DELETE, files[0].pk, '127.0.0.1'),
+            (activity.DELETE, files[1].pk, '127.0.0.1'),
+            (activity.DELETE, files[2].pk, '10.0.0.2'),
+        ])
+
+    @override_settings(FILE_DELETE_RETRIES=2)
+    @mock.patch('api.s3_storage.get_object_key', lambda name, storage: name)
+    @mock.patch('api.s3_storage.get_s3_client')
+    def test_failed_keys_are_resubmitted(self, get_s3_client):
+        s3 = get_s3_client.return_value
+        s3.delete_objects.side_effect = [
+            {'Errors': [{'Key': 'b'}, {'Key': 'c'}]},
+            {'Errors': [{'Key': 'c'}]},
+            {'Errors': [{'Key': 'c'}]},
+        ]
+        failed = s3_storage.delete_objects(['a', 'b', 'c'], storage=mock.Mock(bucket_name='bucket'))
+        self.assertEqual(failed, ['c'])
+        self.assertEqual([[o['Key'] for o in c.kwargs['Delete']['Objects']] for c in s3.delete_objects.call_args_list],
+                         [['a', 'b', 'c'], ['b', 'c'], ['c']])
+
+    def test_nothing_found(self):
+        response = self.bulk_delete([12345])
+        self.assertEqual(response.data, {'deleted': 0, 'not_found': [12345]})
+
+    def test_rejects_bad_ids(self):
+        for ids in ([], ['a'], 'nope'):
+            self.assertEqual(self.bulk_delete(ids).status_code, 400)
+
+class FakePaginator:
+    """
+    list_objects_v2 over a dict of key -> LastModified, two keys a page.
+    """
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        if Delimiter:
+            prefixes = sorted({Prefix + key[len(Prefix):].split(Delimiter)[0] + Delimiter for key in keys})
+            yield {'CommonPrefixes': [{'Prefix': prefix} for prefix in prefixes]}
+            return
+        for start in range(0, len(keys), 2):
+            yield {'Contents': [{'Key': key, 'LastModified': self.objects[key]} for key in keys[start:start + 2]]}
+
+# The command checks prefixes in worker threads, which can only see
+# committed rows
+@test_settings
+class ReconcileStorageTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='password')
+        self.old = timezone.now() - datetime.timedelta(days=2)
+        self.young = timezone.now()
+        self.objects = {}
+        client = mock.Mock()
+        client.get_paginator.return_value = FakePaginator(self.objects)
+        self.delete_objects = mock.Mock(return_value=[])
+        for patcher in (
+            mock.patch('api.management.commands.reconcile_storage.get_s3_client', return_value=client),
+            mock.patch('api.management.commands.reconcile_storage.delete_objects', self.delete_objects),
+            # Deleting a row releases its object after commit
+            mock.patch('api.s3_storage.delete_objects', return_value=[]),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        prefix = f'user_{self.user.pk}/'
+        self.store(prefix + 'kept.txt', self.old)
+        self.store(prefix + 'orphan.txt', self.old)
+        self.store(prefix + 'recent-orphan.txt', self.young)
+        self.store(prefix + 'in-progress.bin', self.old)
+        UploadSession.objects.create(user=self.user, filename='in-progress.bin', key=prefix + 'in-progress.bin')
+        self.row(prefix + 'kept.txt', self.old)
+        self.missing = self.row(prefix + 'lost.txt', self.old)
+        self.row(prefix + 'recent-upload.txt', self.young)
+
+        blob = Blob.objects.create(sha256='ab' * 32, key='blobs/ab/shared.txt', ref_count=2)
+        Blob.objects.filter(pk=blob.pk).update(created_at=self.old)
+        self.store(blob.key, self.old)
+        self.store('blobs/ab/zz-orphan.txt', self.old)
+        self.row(blob.key, self.old, blob=blob)
+        self.row(blob.key, self.old, blob=blob)
+
+    def store(self, name, last_modified):
+        self.objects[get_object_key(name)] = last_modified
+
+    def row(self, name, upload_date, **fields):
+        uploaded_file = UploadedFile.objects.create(user=self.user, file=name, filename=name.split('/')[-1],
+                                                    file_size=1, **fields)
+        UploadedFile.objects.filter(pk=uploaded_file.pk).update(upload_date=upload_date)
+        return uploaded_file
+
+    def reconcile(self, *args):
+        output = io.StringIO()
+        call_command('reconcile_storage', '--workers', '1', *args, stdout=output)
+        return output.getvalue()
+
+    def test_reports_orphans_and_missing_objects(self):
+        output = self.reconcile()
+        reported = sorted(line for line in output.splitlines() if line.startswith(('orphan', 'missing')))
+        self.assertEqual(reported, [
+            f'missing object: user_{self.user.pk}/lost.txt',
+            'orphan object: blobs/ab/zz-orphan.txt',
+            f'orphan object: user_{self.user.pk}/orphan.txt',
+        ])
+        self.assertIn('6 objects, 4 rows: 2 orphan objects, 1 rows missing their object', output)
+        self.delete_objects.assert_not_called()
+        self.assertTrue(UploadedFile.objects.filter(pk=self.missing.pk).exists())
+
+    def test_min_age(self):
+        output = self.reconcile('--min-age', '0', '--prefix', f'user_{self.user.pk}/')
+        self.assertIn(f'orphan object: user_{self.user.pk}/recent-orphan.txt', output)
+        self.assertIn(f'missing object: user_{self.user.pk}/recent-upload.txt', output)
+        self.assertNotIn('in-progress.bin', output)
+
+    def test_delete_orphans_and_missing(self):
+        self.reconcile('--delete-orphans', '--delete-missing')
+        deleted = sorted(name for call in self.delete_objects.call_args_list for name in call.args[0])
+        self.assertEqual(deleted, ['blobs/ab/zz-orphan.txt', f'user_{self.user.pk}/orphan.txt'])
+        self.assertFalse(UploadedFile.objects.filter(pk=self.missing.pk).exists())
+        self.assertEqual(UploadedFile.objects.count(), 4)
+
+# Over test_settings, which turns the log off
+@override_settings(ACTIVITY_LOG_ENABLED=True)
+@test_settings
+@local_storage
+@mock.patch.object(activity.writer, 'log')
+class ActivityLogTests(APITestCase):
+
+    def create_file(self, name):
+        return UploadedFile.objects.create(user=self.user, file=f'user_{self.user.pk}/{name}', filename=name,
+                                           file_size=1)
+
+    def test_events_are_queued_on_commit(self, log):
+        with self.captureOnCommitCallbacks(execute=True):
+            uploaded_file = self.create_file('a.txt')
+            log.assert_not_called()
+        event = log.call_args.args[0]
+        self.assertEqual((event['action'], event['file_id']), (activity.UPLOAD, uploaded_file.pk))
+
+    def test_rolled_back_changes_are_not_logged(self, log):
+        uploaded_file = self.create_file('a.txt')
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.create_file('b.txt')
+                    uploaded_file.delete()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        log.assert_not_called()
+
+@test_settings
+@local_storage
+class RangeDownloadTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        response = self.client.post('/api/files/', {'file': SimpleUploadedFile('a.txt', b'0123456789')})
+        self.url = f"/api/files/{response.data['id']}/download/"
+
+    def download(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+    def test_parse_range(self):
+        self.assertEqual(downloads.parse_range('bytes=0-3', 10), (0, 3))
+        self.assertEqual(downloads.parse_range('bytes=5-', 10), (5, 9))
+        self.assertEqual(downloads.parse_range('bytes=-3', 10), (7, 9))
+        self.assertEqual(downloads.parse_range('bytes=-30', 10), (0, 9))
+        self.assertEqual(downloads.parse_range('bytes=8-100', 10), (8, 9))
+        for header in (None, '', 'bytes=-', 'bytes=0-1,4-5', 'items=0-1'):
+            self.assertIsNone(downloads.parse_range(header, 10))
+        for header in ('bytes=10-', 'bytes=4-2', 'bytes=-0'):
+            with self.assertRaises(downloads.RangeNotSatisfiable):
+                downloads.parse_range(header, 10)
+
+    def test_whole_file(self):
+        response, content = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(content, b'0123456789')
+        self.assertEqual((response['Accept-Ranges'], response['Content-Length']), ('bytes', '10'))
+
+    def test_partial_content(self):
+        response, content = self.download(Range='bytes=2-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(content, b'2345')
+        self.assertEqual((response['Content-Range'], response['Content-Length']), ('bytes 2-5/10', '4'))
+
+        response, content = self.download(Range='bytes=-2')
+        self.assertEqual((response.status_code, content), (206, b'89'))
+
+    def test_unsatisfiable_range(self):
+        response, content = self.download(Range='bytes=10-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    def test_if_range(self):
+        etag = self.download()[0]['ETag']
+        response, content = self.download(Range='bytes=0-0', **{'If-Range': etag})
+        self.assertEqual((response.status_code, content), (206, b'0'))
+        response, content = self.download(Range='bytes=0-0', **{'If-Range': '"stale"'})
+        self.assertEqual((response.status_code, content), (200, b'0123456789'))
+        self.assertEqual(self.download(**{'If-None-Match': etag})[0].status_code, 304)
+
+@test_settings
+@local_storage
+class ArchiveTests(APITestCase):
+
+    def create_file(self, filename, content, user=None, **fields):
+        user = user or self.user
+        name = default_storage.save(f'user_{user.pk}/{filename}', ContentFile(content))
+        return UploadedFile.objects.create(user=user, file=name, filename=filename, file_size=len(content), **fields)
+
+    def archive(self, **params):
+        return self.client.get('/api/files/archive/', params)
+
+    def unzip(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+    def test_archive_by_ids(self):
+        text = self.create_file('a.txt', b'hello ' * 1000)
+        same_name = self.create_file('A.txt', b'second')
+        photo = self.create_file('photo.jpg', b'\xff\xd8 not really a jpeg')
+        missing = self.create_file('gone.txt', b'gone')
+        default_storage.delete(missing.file.name)
+        self.create_file('not-asked-for.txt', b'no')
+
+        archive = self.unzip(self.archive(ids=f'{text.pk},{same_name.pk},{photo.pk},{missing.pk}'))
+        self.assertEqual(archive.namelist(), ['a.txt', 'A (1).txt', 'photo.jpg'])
+        self.assertEqual(archive.read('a.txt'), b'hello ' * 1000)
+        self.assertEqual(archive.read('A (1).txt'), b'second')
+        self.assertEqual(archive.read('photo.jpg'), b'\xff\xd8 not really a jpeg')
+        self.assertEqual(archive.getinfo('a.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.getinfo('photo.jpg').compress_type, zipfile.ZIP_STORED)
+        self.assertIsNone(archive.testzip())
+
+    def test_archive_since(self):
+        old = self.create_file('old.txt', b'old')
+        UploadedFile.objects.filter(pk=old.pk).update(upload_date=timezone.now() - datetime.timedelta(days=10))
+        self.create_file('new.txt', b'new')
+        since = (timezone.now() - datetime.timedelta(days=1)).isoformat()
+        self.assertEqual(self.unzip(self.archive(since=since)).namelist(), ['new.txt'])
+
+    def test_bad_requests(self):
+        theirs = self.create_file('theirs.txt', b'theirs', user=self.create_user('bob'))
+        self.assertEqual(self.archive().status_code, 400)
+        self.assertEqual(self.archive(ids='1,x').status_code, 400)
+        self.assertEqual(self.archive(since='last week').status_code, 400)
+        self.assertEqual(self.archive(ids=str(theirs.pk)).status_code, 404)
+
+        ids = ','.join(str(self.create_file(f'{i}.txt', b'x').pk) for i in range(3))
+        with override_settings(FILE_ARCHIVE_MAX_FILES=2):
+            self.assertEqual(self.archive(ids=ids).status_code, 400)
+
+class InlinePool:
+    """
+    Stand-in for the process pool that runs each job as it's submitted.
+    """
+
+    def __init__(self):
+        self.submitted = 0
+
+    def submit(self, func, *args):
+        self.submitted += 1
+        future = Future()
+        future.set_result(func(*args))
+        return future
+
+# Over test_settings, which turns thumbnails off
+@override_settings(THUMBNAIL_ENABLED=True, THUMBNAIL_SIZE=64)
+@test_settings
+@local_storage
+@skipUnless(imaging.Image, 'Pillow is not installed')
+class ThumbnailTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.pool = InlinePool()
+        patcher = mock.patch.object(workers, 'process_pool', return_value=self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def png(self, width=300, height=150):
+        output = io.BytesIO()
+        imaging.Image.new('RGB', (width, height), 'red').save(output, 'PNG')
+        return output.getvalue()
+
+    def create_file(self, filename, blob=None):
+        content = self.png()
+        name = blob.key if blob else default_storage.save(f'user_{self.user.pk}/{filename}', ContentFile(content))
+        return UploadedFile.objects.create(user=self.user, file=name, blob=blob, filename=filename,
+                                           file_size=len(content))
+
+    def create_blob(self, references):
+        name = default_storage.save('blobs/ab/shared.png', ContentFile(self.png()))
+        return Blob.objects.create(sha256='ab' * 32, key=name, size=1, ref_count=references)
+
+    def stored_thumbnail(self, uploaded_file):
+        uploaded_file.refresh_from_db()
+        self.assertEqual(uploaded_file.thumbnail, UploadedFile.thumbnail_name_for(uploaded_file.file.name))
+        with default_storage.open(uploaded_file.thumbnail) as f:
+            return imaging.Image.open(io.BytesIO(f.read()))
+
+    def delete(self, uploaded_file):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.delete(f'/api/files/{uploaded_file.pk}/').status_code, 204)
+
+    def test_generate_renders_and_stores_a_jpeg(self):
+        photo = self.create_file('photo.png')
+        self.assertEqual(thumbnails.generate([photo.pk]), 1)
+        thumbnail = self.stored_thumbnail(photo)
+        self.assertEqual((thumbnail.format, thumbnail.size), ('JPEG', (64, 32)))
+
+        # Done already, unless forced
+        self.assertEqual(thumbnails.generate([photo.pk]), 0)
+        self.assertEqual(thumbnails.generate([photo.pk], force=True), 1)
+        self.assertEqual(self.pool.submitted, 2)
+
+        name = photo.thumbnail
+        self.delete(photo)
+        self.assertFalse(default_storage.exists(name))
+
+    def test_rows_sharing_a_blob_share_its_thumbnail(self):
+        blob = self.create_blob(references=2)
+        first = self.create_file('a.png', blob)
+        self.assertEqual(thumbnails.generate([first.pk]), 1)
+        self.stored_thumbnail(first)
+        name = first.thumbnail
+
+        # A later row for the same content reuses it without rendering
+        second = self.create_file('b.png', blob)
+        self.assertEqual(thumbnails.generate([second.pk]), 0)
+        second.refresh_from_db()
+        self.assertEqual(second.thumbnail, name)
+        self.assertEqual(self.pool.submitted, 1)
+
+        # The thumbnail goes with the blob's last reference
+        self.delete(first)
+        self.assertTrue(default_storage.exists(name))
+        self.delete(second)
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(default_storage.exists(blob.key))
+
+    def test_regenerate_thumbnails_command(self):
+        done = self.create_file('done.png')
+        thumbnails.generate([done.pk])
+        missing = [self.create_file(f'{i}.png') for i in range(3)]
+        self.create_file('notes.txt')
+
+        output = io.StringIO()
+        call_command('regenerate_thumbnails', '--missing', '--batch-size', '2', stdout=output)
+        self.assertIn('Rendered 3 thumbnails', output.getvalue())
+        for uploaded_file in missing:
+            self.stored_thumbnail(uploaded_file)
+
+        call_command('regenerate_thumbnails', stdout=output)
+        self.assertIn('Rendered 4 thumbnails', output.getvalue())
+        self.assertEqual(self.pool.submitted, 8)
+
+@test_settings
+class SearchTests(APITestCase):
+
+    def create_file(self, name, text, user=None, blob=None):
+        uploaded_file = UploadedFile.objects.create(user=user or self.user, filename=name, file_size=1, blob=blob,
+                                                    file=blob.key if blob else f'user_1/{name}')
+        if text is not None:
+            FileText.objects.create(uploaded_file=uploaded_file, content=text)
+        return uploaded_file
+
+    def search(self, query):
+        response = self.client.get('/api/files/search/', {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [item['filename'] for item in response.data['results']]
+
+    def test_best_matches_first(self):
+        self.create_file('once.txt', 'the quarterly numbers and a lot of other words about nothing in particular')
+        self.create_file('often.txt', 'quarterly report: quarterly revenue, quarterly costs')
+        self.create_file('never.txt', 'annual report')
+        self.create_file('theirs.txt', 'quarterly quarterly quarterly', user=self.create_user('bob'))
+
+        self.assertEqual(self.search('quarterly'), ['often.txt', 'once.txt'])
+        self.assertEqual(self.search('quarterly report'), ['often.txt'])
+        # The last term matches as a prefix, for search-as-you-type
+        self.assertEqual(self.search('quart'), ['often.txt', 'once.txt'])
+
+    def test_results_carry_score_and_snippet(self):
+        self.create_file('a.txt', 'quarterly report')
+        item = self.client.get('/api/files/search/', {'q': 'report'}).data['results'][0]
+        self.assertIn('report', item['snippet'])
+        self.assertIsInstance(item['score'], float)
+
+    def test_query_syntax_is_taken_literally(self):
+        self.create_file('a.txt', 'near the end')
+        self.assertEqual(self.search('NEAR("end"'), ['a.txt'])
+        self.assertEqual(self.client.get('/api/files/search/').status_code, 400)
+
+    @override_settings(SEARCH_INDEX_ENABLED=True)
+    def test_shared_content_reuses_text(self):
+        blob = Blob.objects.create(sha256='0' * 64, key='blobs/00/shared.txt', size=1, ref_count=2)
+        self.create_file('a.txt', 'shared words', blob=blob)
+        copy = self.create_file('b.txt', None, blob=blob)
+        with mock.patch.object(search, '_read_source') as read_source:
+            self.assertEqual(search.index_files([copy.pk]), 0)
+        read_source.assert_not_called()
+        self.assertEqual(FileText.objects.get(uploaded_file=copy).content, 'shared words')
+
+@test_settings
+class FileFilterTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name in ('Invoice-March.pdf', 'invoice_april.pdf', 'INVOICE.txt', 'inv.txt', 'report.pdf', 'Ünïcode.txt'):
+            UploadedFile.objects.create(user=self.user, file=f'user_1/{name}', filename=name, file_size=1)
+
+    def names(self, query):
+        queryset = filters.filter_files(UploadedFile.objects.filter(user=self.user), QueryDict(query))
+        return sorted(queryset.values_list('filename', flat=True))
+
+    def test_name_prefix_ignores_case(self):
+        self.assertEqual(self.names('name_prefix=invoice'), ['INVOICE.txt', 'Invoice-March.pdf', 'invoice_april.pdf'])
+        self.assertEqual(self.names('name_prefix=INVOICE_'), ['invoice_april.pdf'])
+        self.assertEqual(self.names('name_prefix=%C3%9C'), ['Ünïcode.txt'])
+        self.assertEqual(self.names('name_prefix=invoice&name_contains=MAR'), ['Invoice-March.pdf'])
+
+    @skipUnless(connection.vendor == 'sqlite', 'PostgreSQL uses its trigram index')
+    def test_name_prefix_uses_the_filename_index(self):
+        queryset = filters.filter_files(UploadedFile.objects.filter(user=self.user), QueryDict('name_prefix=inv'))
+        self.assertIn('api_file_user_name_idx', queryset.explain())
+
+@test_settings
+@local_storage
+class QuotaTests(APITestCase):
+
+    def set_limit(self, max_bytes):
+        UserQuota.for_user(self.user.pk)
+        UserQuota.objects.filter(user=self.user).update(max_bytes=max_bytes)
+
+    def usage(self):
+        quota = UserQuota.objects.get(user=self.user)
+        return quota.used_files, quota.used_bytes
+
+    def stored_names(self):
+        return {os.path.join(root, name) for root, dirs, names in os.walk(TEST_MEDIA_ROOT) for name in names}
+
+    def bulk_upload(self, *contents):
+        files = [SimpleUploadedFile(f'{i}.txt', content) for i, content in enumerate(contents)]
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/files/bulk/', {'files': files})
+
+    def test_uploads_and_deletes_are_counted(self):
+        self.assertEqual(self.bulk_upload(b'abc', b'defg').status_code, 201)
+        self.assertEqual(self.usage(), (2, 7))
+        response = self.client.post('/api/files/', {'file': SimpleUploadedFile('a.txt', b'hello')})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.usage(), (3, 12))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/api/files/{response.data['id']}/")
+        self.assertEqual(self.usage(), (2, 7))
+
+    def test_over_quota_uploads_are_rejected_before_storing(self):
+        self.set_limit(5)
+        before = self.stored_names()
+        self.assertEqual(self.bulk_upload(b'abc', b'defg').status_code, 507)
+        self.assertEqual(self.client.post('/api/files/', {'file': SimpleUploadedFile('a.txt', b'toolong')}).status_code,
+                         507)
+        self.assertEqual(self.stored_names(), before)
+        self.assertEqual(self.usage(), (0, 0))
+        self.assertFalse(UploadedFile.objects.exists())
+
+    def test_bulk_upload_filled_up_meanwhile_deletes_what_it_stored(self):
+        self.set_limit(5)
+        before = self.stored_names()
+        # As if concurrent uploads used up the quota after the check
+        with mock.patch.object(UserQuota, 'check_upload'):
+            self.assertEqual(self.bulk_upload(b'abc', b'defg').status_code, 507)
+        self.assertEqual(self.stored_names(), before)
+        self.assertEqual(self.usage(), (0, 0))
+        self.assertFalse(UploadedFile.objects.exists())
+        self.assertFalse(Blob.objects.exists())
+
+@test_settings
+class UploadSessionQuotaTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('api.uploads.get_s3_client')
+        self.s3 = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        self.s3.upload_part.side_effect = lambda PartNumber, Body, **params: {'ETag': f'"etag-{PartNumber}"'}
+
+        response = self.client.post('/api/uploads/', {'filename': 'report.pdf', 'total_size': 11})
+        self.session_id = response.data['id']
+        self.client.generic('PUT', f'/api/uploads/{self.session_id}/parts/1/', b'hello world',
+                            content_type='application/octet-stream')
+        UserQuota.objects.filter(user=self.user).update(max_bytes=5)
+
+    def test_complete_checks_the_quota_first(self):
+        self.assertEqual(self.client.post(f'/api/uploads/{self.session_id}/complete/').status_code, 507)
+        self.s3.complete_multipart_upload.assert_not_called()
+        self.assertEqual(UploadSession.objects.get(pk=self.session_id).status, 'active')
+
+    @mock.patch('api.uploads.delete_objects_on_commit')
+    def test_session_fails_when_the_charge_does(self, delete_objects_on_commit):
+        with mock.patch.object(UserQuota, 'check_upload'):
+            self.assertEqual(self.client.post(f'/api/uploads/{self.session_id}/complete/').status_code, 507)
+        self.s3.complete_multipart_upload.assert_called_once()
+        session = UploadSession.objects.get(pk=self.session_id)
+        self.assertEqual((session.status, session.uploaded_file), ('failed', None))
+        delete_objects_on_commit.assert_called_once_with([session.key])
+        self.assertFalse(UploadedFile.objects.exists())
@@ -0,0 +1,130 @@
+"""
+Thumbnails for uploaded images and PDFs.
+
+Uploads only schedule work: once the upload's transaction commits, a
+background thread (see api/workers.py) reads the content and hands it to
+the process pool to render, then stores the JPEG next to the original and
+records its name on the rows.
+"""
+import logging
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from . import imaging, workers
+from .downloads import ContentMissing, open_content
+from .models import UploadedFile
+from .s3_storage import get_s3_client, get_object_key
+
+logger = logging.getLogger(__name__)
+
+def _extension(uploaded_file):
+    if uploaded_file.extension is not None:
+        return uploaded_file.extension
+    return UploadedFile.extension_for(uploaded_file.filename)
+
+def wants_thumbnail(uploaded_file):
+    return (settings.THUMBNAIL_ENABLED
+            and bool(uploaded_file.file)
+            and _extension(uploaded_file) in imaging.THUMBNAIL_EXTENSIONS
+            and uploaded_file.file_size <= settings.THUMBNAIL_MAX_SOURCE_SIZE)
+
+def schedule(uploaded_files):
+    """
+    Make thumbnails for whichever of these new files can have one, in the
+    background once the current transaction commits.
+    """
+    ids = [uploaded_file.pk for uploaded_file in uploaded_files if wants_thumbnail(uploaded_file)]
+    if ids:
+        workers.run_after_commit(generate, ids)
+
+def generate(ids, force=False):
+    """
+    Render and store thumbnails for the UploadedFile rows with these ids,
+    skipping rows that have one unless force. Rows sharing content (the
+    same blob) share one thumbnail. Returns the number rendered.
+    """
+    rows = UploadedFile.objects.filter(pk__in=ids).only('id', 'file', 'blob', 'filename', 'extension', 'file_size',
+                                                         'thumbnail')
+    # Storage name -> (extension, the rows it's for): every row sharing a
+    # blob, or just the row itself. Rows are matched on indexed columns.
+    sources = {}
+    for row in rows:
+        if wants_thumbnail(row) and (force or not row.thumbnail):
+            owner = {'blob_id': row.blob_id} if row.blob_id else {'pk': row.pk}
+            sources[row.file.name] = (_extension(row), owner)
+    if not sources:
+        return 0
+
+    if not force:
+        # Another row with the same content may already have one
+        blob_names = {owner['blob_id']: name for name, (extension, owner) in sources.items() if 'blob_id' in owner}
+        existing = (UploadedFile.objects.filter(blob_id__in=list(blob_names)).exclude(thumbnail='')
+                    .values_list('blob_id', 'thumbnail'))
+        for blob_id, thumbnail in existing:
+            if sources.pop(blob_names[blob_id], None) is not None:
+                UploadedFile.objects.filter(blob_id=blob_id, thumbnail='').update(thumbnail=thumbnail)
+
+    pool = workers.process_pool()
+    pending = {}
+    rendered = 0
+    try:
+        for name, (extension, owner) in sources.items():
+            # Keep every worker busy without holding every source in memory
+            if len(pending) >= settings.BACKGROUND_WORKERS * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                rendered += _finish(done, pending)
+            data = _read_source(name)
+            if data is None:
+                continue
+            pending[pool.submit(imaging.render_thumbnail, data, extension,
+                                settings.THUMBNAIL_SIZE, settings.THUMBNAIL_QUALITY)] = name, owner
+        rendered += _finish(list(pending), pending)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory); start a fresh pool next time
+        workers.reset_process_pool(pool)
+        raise
+    return rendered
+
+def _read_source(name):
+    try:
+        return b''.join(open_content(name))
+    except ContentMissing as e:
+        logger.error(f"Can't make a thumbnail for {name}: {str(e)}")
+        return None
+
+def _finish(futures, pending):
+    """
+    Store the thumbnails of finished renders and point their rows at them.
+    """
+    stored = 0
+    for future in futures:
+        name, owner = pending.pop(future)
+        try:
+            data = future.result()
+        except BrokenProcessPool:
+            raise
+        except Exception as e:
+            logger.error(f"Error rendering thumbnail for {name}: {str(e)}")
+            continue
+        thumbnail = UploadedFile.thumbnail_name_for(name)
+        store_thumbnail(thumbnail, data)
+        if not UploadedFile.objects.filter(**owner).update(thumbnail=thumbnail):
+            # The file was deleted while we rendered; its delete didn't know about this
+            default_storage.delete(thumbnail)
+            continue
+        stored += 1
+    return stored
+
+def store_thumbnail(name, data):
+    """
+    Write a thumbnail under exactly this name, replacing any earlier one.
+    S3 storage would otherwise make the name unique.
+    """
+    if hasattr(default_storage, 'bucket_name'):
+        get_s3_client().put_object(Bucket=default_storage.bucket_name, Key=get_object_key(name),
+                                   Body=data, ContentType='image/jpeg')
+    else:
+        default_storage.delete(name)
+        default_storage.save(name, ContentFile(data))
@@ -0,0 +1,156 @@
+import hashlib
+import logging
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import (
+    FileUploadHandler, MemoryFileUploadHandler, StopFutureHandlers, TemporaryFileUploadHandler
+)
+from .s3_storage import get_s3_client, get_object_key
+
+logger = logging.getLogger(__name__)
+
+class HashingMixin:
+    """
+    Computes a SHA-256 of the chunks this handler consumes while the upload
+    streams in, and attaches the hex digest to the finished file as `sha256`.
+    Saves re-reading the file afterwards just to hash it.
+    """
+
+    def new_file(self, *args, **kwargs):
+        # Set up the hasher first: the memory handler raises StopFutureHandlers
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        data = super().receive_data_chunk(raw_data, start)
+        if data is None:
+            # This handler kept the chunk, so it's the one that hashes it
+            self.sha256.update(raw_data)
+        return data
+
+    def file_complete(self, file_size):
+        file_obj = super().file_complete(file_size)
+        if file_obj is not None:
+            file_obj.sha256 = self.sha256.hexdigest()
+        return file_obj
+
+class HashingMemoryFileUploadHandler(HashingMixin, MemoryFileUploadHandler):
+    pass
+
+class HashingTemporaryFileUploadHandler(HashingMixin, TemporaryFileUploadHandler):
+    pass
+
+class StoredUploadedFile(UploadedFile):
+    """
+    An upload whose bytes are already in storage. Carries the storage name
+    and digest instead of file contents, so nothing has to be written again.
+    """
+
+    def __init__(self, storage_name, sha256, name, content_type, size, charset, content_type_extra=None):
+        super().__init__(None, name, content_type, size, charset, content_type_extra)
+        self.storage_name = storage_name
+        self.sha256 = sha256
+
+    def open(self, mode='rb'):
+        return default_storage.open(self.storage_name, mode)
+
+    def chunks(self, chunk_size=None):
+        with default_storage.open(self.storage_name) as f:
+            yield from f.chunks(chunk_size)
+
+class S3StreamingUploadHandler(FileUploadHandler):
+    """
+    Forwards uploaded chunks straight into S3 as they arrive instead of
+    spooling them to memory or a temp file first. Data is buffered only up
+    to one part (FILE_UPLOAD_STREAM_PART_SIZE); files that never fill a part
+    are sent with a single PUT, larger ones as a multipart upload.
+
+    Needs the authenticated user for the storage prefix, so views install it
+    themselves once authentication has run.
+    """
+
+    def __init__(self, request=None, user=None):
+        super().__init__(request)
+        self.user = user
+        self.part_size = settings.FILE_UPLOAD_STREAM_PART_SIZE
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        from .uploads import new_file_name
+        self.storage_name = new_file_name(self.user, self.file_name)
+        self.key = get_object_key(self.storage_name)
+        self.sha256 = hashlib.sha256()
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        # We keep every chunk, so the default handlers never see this file
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        self.buffer.extend(raw_data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return None
+
+    def _upload_part(self, data):
+        client = get_s3_client()
+        if self.upload_id is None:
+            params = {'Bucket': default_storage.bucket_name, 'Key': self.key}
+            if self.content_type:
+                params['ContentType'] = self.content_type
+            self.upload_id = client.create_multipart_upload(**params)['UploadId']
+            logger.info(f"Streaming {self.file_name} to S3 as {self.key}")
+
+        part_number = len(self.parts) + 1
+        response = client.upload_part(
+            Bucket=default_storage.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def file_complete(self, file_size):
+        client = get_s3_client()
+        if self.upload_id is None:
+            # Never filled a part: one PUT is cheaper than a multipart upload
+            params = {'Bucket': default_storage.bucket_name, 'Key': self.key, 'Body': bytes(self.buffer)}
+            if self.content_type:
+                params['ContentType'] = self.content_type
+            client.put_object(**params)
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            client.complete_multipart_upload(
+                Bucket=default_storage.bucket_name,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts},
+            )
+        self.buffer = bytearray()
+
+        logger.info(f"Streamed {self.file_name} ({file_size} bytes) to {self.key}")
+        return StoredUploadedFile(
+            storage_name=self.storage_name,
+            sha256=self.sha256.hexdigest(),
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+        )
+
+    def upload_interrupted(self):
+        # The client went away mid-file; don't leave the parts behind in S3
+        if getattr(self, 'upload_id', None):
+            try:
+                get_s3_client().abort_multipart_upload(
+                    Bucket=default_storage.bucket_name, Key=self.key, UploadId=self.upload_id
+                )
+            except ClientError as e:
+                logger.error(f"Error aborting interrupted upload {self.key}: {str(e)}")
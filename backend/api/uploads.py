@@ -0,0 +1,613 @@
+import os
+import math
+import uuid
+import hashlib
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, models, transaction
+from .models import Blob, QuotaExceeded, UploadedFile, UploadSession, UploadSessionPart, UserQuota
+from .s3_storage import delete_objects, delete_objects_on_commit, get_s3_client, get_object_key
+
+logger = logging.getLogger(__name__)
+
+# S3 only accepts part numbers between 1 and 10000
+MAX_PART_NUMBER = 10000
+
+class UploadSessionError(Exception):
+    """
+    Raised when an upload session operation can't be carried out,
+    e.g. the session is no longer active or S3 rejected the request.
+    """
+    pass
+
+def new_file_name(user, original_name):
+    """
+    Build a unique storage name under the user's prefix, keeping the
+    original extension. Unique names let us skip the S3 exists() check.
+    """
+    extension = os.path.splitext(original_name)[1].lower() if '.' in original_name else ''
+    return f"user_{user.id}/{uuid.uuid4()}{extension}"
+
+def blob_file_name(digest, original_name):
+    """
+    Storage name for deduplicated content. The random part keeps a blob
+    that is being deleted from clashing with a fresh copy of the same content.
+    """
+    extension = os.path.splitext(original_name)[1].lower() if '.' in original_name else ''
+    return f"blobs/{digest[:2]}/{digest}-{uuid.uuid4().hex[:8]}{extension}"
+
+def file_sha256(file_obj):
+    """
+    SHA-256 hex digest of an uploaded file. The hashing upload handlers
+    compute it while the upload streams in; otherwise hash it here.
+    """
+    digest = getattr(file_obj, 'sha256', None)
+    if digest:
+        return digest
+    hasher = hashlib.sha256()
+    for chunk in file_obj.chunks():
+        hasher.update(chunk)
+    file_obj.seek(0)
+    return hasher.hexdigest()
+
+def _save_file(name, file_obj):
+    """
+    Write an upload to storage under name, unless an upload handler has
+    already streamed it there. Returns the storage name actually used.
+    """
+    storage_name = getattr(file_obj, 'storage_name', None)
+    if storage_name:
+        return storage_name
+    return default_storage.save(name, file_obj)
+
+def _discard_file(file_obj, name):
+    """
+    Drop a stored copy we turned out not to need.
+    """
+    try:
+        default_storage.delete(name)
+    except Exception as e:
+        logger.error(f"Error deleting unneeded copy of {file_obj.name}: {str(e)}")
+
+def reference_blob(digest, file_obj=None):
+    """
+    Take one more reference on the stored Blob for this content and return
+    it, or None if the content isn't stored yet.
+    """
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(sha256=digest).first()
+        if blob is None:
+            return None
+        Blob.objects.filter(pk=blob.pk).update(ref_count=models.F('ref_count') + 1)
+    if file_obj is not None:
+        logger.info(f"Reusing stored blob {digest} for {file_obj.name}")
+        if getattr(file_obj, 'storage_name', None):
+            # Streamed before we could know it was a duplicate
+            _discard_file(file_obj, file_obj.storage_name)
+    return blob
+
+def register_blob(file_obj, digest, name):
+    """
+    Record content just written to storage under name as a new Blob with one
+    reference. If the same content was stored concurrently, use that Blob
+    and drop our copy.
+    """
+    try:
+        with transaction.atomic():
+            return Blob.objects.create(sha256=digest, key=name, size=file_obj.size, ref_count=1)
+    except IntegrityError:
+        # Someone stored the same content concurrently; use theirs and drop ours
+        _discard_file(file_obj, name)
+        blob = reference_blob(digest)
+        if blob is None:
+            raise Blob.DoesNotExist(f"Blob {digest} was released while storing {file_obj.name}")
+        return blob
+
+def acquire_blob(file_obj, digest):
+    """
+    Return the Blob for this content with one more reference, writing the
+    content to storage only when it isn't stored yet.
+    """
+    blob = reference_blob(digest, file_obj)
+    if blob is not None:
+        return blob
+
+    name = _save_file(blob_file_name(digest, file_obj.name), file_obj)
+    return register_blob(file_obj, digest, name)
+
+def store_file(user, file_obj):
+    """
+    Write an uploaded file to storage and return (storage name, blob).
+    With FILE_DEDUP_ENABLED the content is stored once per SHA-256 and
+    blob is the shared Blob; otherwise blob is None.
+    """
+    if settings.FILE_DEDUP_ENABLED:
+        blob = acquire_blob(file_obj, file_sha256(file_obj))
+        return blob.key, blob
+
+    return _save_file(new_file_name(user, file_obj.name), file_obj), None
+
+def discard_stored_file(name, blob):
+    """
+    Give back what store_file() took, when the row for it wasn't created:
+    the blob reference, or the object written for it.
+    """
+    if blob is not None:
+        Blob.release(blob.pk)
+        return
+    try:
+        default_storage.delete(name)
+    except Exception as e:
+        logger.error(f"Error deleting {name} of a failed upload: {str(e)}")
+
+def write_files(user, file_objs):
+    """
+    First half of a bulk upload: write the uploads to storage concurrently
+    through a bounded thread pool. Run it outside any transaction, so no
+    locks are held while storage is written to. Returns one (storage name,
+    digest, error) tuple per file, in order; error is the exception when
+    that file couldn't be stored, and digest is None without
+    FILE_DEDUP_ENABLED.
+
+    With deduplication only the first file for each digest not stored yet
+    is written; the other files get a name only if an upload handler
+    already streamed them. Pass the result to reference_files() in the
+    transaction that creates the rows, or to discard_files() if that fails.
+    """
+    def save_all(names_and_files):
+        with ThreadPoolExecutor(max_workers=settings.FILE_BULK_UPLOAD_WORKERS) as pool:
+            futures = [pool.submit(_save_file, name, file_obj) for name, file_obj in names_and_files]
+        results = []
+        for future in futures:
+            try:
+                results.append((future.result(), None))
+            except Exception as e:
+                logger.error(f"Error storing file in bulk upload: {str(e)}")
+                results.append((None, e))
+        return results
+
+    if not settings.FILE_DEDUP_ENABLED:
+        saved = save_all([(new_file_name(user, file_obj.name), file_obj) for file_obj in file_objs])
+        return [(name, None, error) for name, error in saved]
+
+    digests = [file_sha256(file_obj) for file_obj in file_objs]
+    stored = set(Blob.objects.filter(sha256__in=set(digests)).values_list('sha256', flat=True))
+    to_write = {}
+    for index, (file_obj, digest) in enumerate(zip(file_objs, digests)):
+        if digest not in stored and digest not in to_write:
+            to_write[digest] = index
+    saved = save_all([(blob_file_name(digest, file_objs[index].name), file_objs[index])
+                      for digest, index in to_write.items()])
+
+    staged = [(getattr(file_obj, 'storage_name', None), digest, None) for file_obj, digest in zip(file_objs, digests)]
+    for index, (name, error) in zip(to_write.values(), saved):
+        staged[index] = (name, digests[index], error)
+    return staged
+
+def reference_files(file_objs, staged):
+    """
+    Second half of a bulk upload, inside the transaction that creates the
+    rows: record the files write_files() staged. Returns one (storage name,
+    blob, error) tuple per file, in order; blob is None without
+    FILE_DEDUP_ENABLED.
+
+    Blobs are locked like reference_blob() does, so a concurrent release
+    can't drop one (and delete its object) before our references are
+    added. Copies that turn out to be surplus are deleted once the
+    transaction commits.
+    """
+    if not settings.FILE_DEDUP_ENABLED:
+        return [(name, None, error) for name, digest, error in staged]
+
+    digests = {digest for name, digest, error in staged if error is None}
+    blobs = {blob.sha256: blob for blob in Blob.objects.select_for_update().filter(sha256__in=digests)}
+
+    # Content that isn't stored (any more) becomes a new blob from a copy of
+    # ours. Without one, the blob was released since write_files() checked
+    # and the file fails rather than being written with locks held.
+    ours = {}
+    sizes = {}
+    for file_obj, (name, digest, error) in zip(file_objs, staged):
+        if error is None and name and digest not in blobs:
+            ours.setdefault(digest, name)
+            sizes[digest] = file_obj.size
+    if ours:
+        Blob.objects.bulk_create(
+            [Blob(sha256=digest, key=name, size=sizes[digest]) for digest, name in ours.items()],
+            ignore_conflicts=True,
+        )
+        # Someone may have stored the same content concurrently; theirs wins
+        blobs.update((blob.sha256, blob) for blob in Blob.objects.select_for_update().filter(sha256__in=ours.keys()))
+
+    results = []
+    for name, digest, error in staged:
+        if error is None and digest not in blobs:
+            error = Blob.DoesNotExist("The content was deleted while uploading; try again")
+        if error is not None:
+            results.append((None, None, error))
+        else:
+            results.append((blobs[digest].key, blobs[digest], None))
+
+    # One UPDATE adds every new reference, however many digests there are
+    references = Counter(blob.sha256 for name, blob, error in results if blob is not None)
+    if references:
+        Blob.objects.filter(sha256__in=references.keys()).update(
+            ref_count=models.F('ref_count') + models.Case(
+                *[models.When(sha256=digest, then=models.Value(count)) for digest, count in references.items()],
+                output_field=models.PositiveIntegerField(),
+            )
+        )
+
+    keys = {blob.key for blob in blobs.values()}
+    delete_objects_on_commit(name for name, digest, error in staged if name and name not in keys)
+    return results
+
+def discard_files(staged):
+    """
+    Delete what write_files() stored, when the rows for it weren't created.
+    """
+    failed = delete_objects(name for name, digest, error in staged if name)
+    if failed:
+        logger.error(f"Could not delete {len(failed)} objects of a failed bulk upload; left for reconcile_storage")
+
+def _multipart_params(session):
+    return {
+        'Bucket': default_storage.bucket_name,
+        'Key': get_object_key(session.key),
+        'UploadId': session.upload_id,
+    }
+
+def start_session(user, filename, total_size=None, content_type=None):
+    """
+    Create an S3 multipart upload and the UploadSession that tracks it.
+    """
+    name = new_file_name(user, filename)
+    params = {
+        'Bucket': default_storage.bucket_name,
+        'Key': get_object_key(name),
+    }
+    if content_type:
+        params['ContentType'] = content_type
+
+    try:
+        response = get_s3_client().create_multipart_upload(**params)
+    except ClientError as e:
+        logger.error(f"Error starting multipart upload for {name}: {str(e)}")
+        raise UploadSessionError(f"Could not start upload: {str(e)}")
+
+    logger.info(f"Started multipart upload {response['UploadId']} for {name}")
+    return UploadSession.objects.create(
+        user=user,
+        filename=filename,
+        key=name,
+        upload_id=response['UploadId'],
+        total_size=total_size,
+        content_type=content_type or '',
+    )
+
+def start_direct_session(user, filename, total_size, content_type=None, checksum_sha256=''):
+    """
+    Create a session for a client that uploads straight to S3. Small files
+    get a single presigned PUT; larger ones an S3 multipart upload whose
+    parts are presigned individually.
+    """
+    name = new_file_name(user, filename)
+    upload_id = ''
+
+    if total_size > settings.UPLOAD_PRESIGN_SINGLE_PUT_MAX:
+        part_count = math.ceil(total_size / settings.UPLOAD_PRESIGN_PART_SIZE)
+        if part_count > MAX_PART_NUMBER:
+            raise UploadSessionError("File is too large to upload")
+
+        params = {
+            'Bucket': default_storage.bucket_name,
+            'Key': get_object_key(name),
+        }
+        if content_type:
+            params['ContentType'] = content_type
+        try:
+            upload_id = get_s3_client().create_multipart_upload(**params)['UploadId']
+        except ClientError as e:
+            logger.error(f"Error starting multipart upload for {name}: {str(e)}")
+            raise UploadSessionError(f"Could not start upload: {str(e)}")
+
+    logger.info(f"Started direct upload for {name} ({total_size} bytes)")
+    return UploadSession.objects.create(
+        user=user,
+        filename=filename,
+        key=name,
+        upload_id=upload_id,
+        mode='direct',
+        total_size=total_size,
+        content_type=content_type or '',
+        checksum_sha256=checksum_sha256 or '',
+    )
+
+def presign_session(session):
+    """
+    Issue the presigned URL(s) a client needs to upload a direct session.
+    Safe to call again, e.g. when the earlier URLs expired mid-upload.
+    """
+    if session.mode != 'direct':
+        raise UploadSessionError("Only direct upload sessions can be presigned")
+    if session.status != 'active':
+        raise UploadSessionError(f"Upload session is {session.status}")
+
+    client = get_s3_client()
+    expire = settings.UPLOAD_PRESIGN_EXPIRE
+
+    if not session.upload_id:
+        # ContentLength and the checksum become signed headers, so S3 itself
+        # rejects a body that doesn't match what the client declared
+        params = {
+            'Bucket': default_storage.bucket_name,
+            'Key': get_object_key(session.key),
+            'ContentLength': session.total_size,
+        }
+        headers = {}
+        if session.content_type:
+            params['ContentType'] = session.content_type
+            headers['Content-Type'] = session.content_type
+        if session.checksum_sha256:
+            params['ChecksumSHA256'] = session.checksum_sha256
+            headers['x-amz-checksum-sha256'] = session.checksum_sha256
+        return {
+            'method': 'PUT',
+            'url': client.generate_presigned_url('put_object', Params=params, ExpiresIn=expire),
+            'headers': headers,
+            'expires_in': expire,
+        }
+
+    part_size = settings.UPLOAD_PRESIGN_PART_SIZE
+    part_count = math.ceil(session.total_size / part_size)
+    return {
+        'method': 'PUT',
+        'part_size': part_size,
+        'parts': [
+            {
+                'part_number': part_number,
+                'url': client.generate_presigned_url(
+                    'upload_part',
+                    Params={'PartNumber': part_number, **_multipart_params(session)},
+                    ExpiresIn=expire,
+                ),
+            }
+            for part_number in range(1, part_count + 1)
+        ],
+        'expires_in': expire,
+    }
+
+def _list_uploaded_parts(session):
+    """
+    Ask S3 which parts a direct multipart upload has received.
+    """
+    client = get_s3_client()
+    parts = []
+    marker = 0
+    while True:
+        response = client.list_parts(PartNumberMarker=marker, **_multipart_params(session))
+        parts.extend(response.get('Parts', []))
+        if not response.get('IsTruncated'):
+            return parts
+        marker = response['NextPartNumberMarker']
+
+def _verify_direct_object(session):
+    """
+    Check that the object a client uploaded matches what it declared.
+    Returns the verified size.
+    """
+    params = {
+        'Bucket': default_storage.bucket_name,
+        'Key': get_object_key(session.key),
+    }
+    if session.checksum_sha256:
+        params['ChecksumMode'] = 'ENABLED'
+    try:
+        head = get_s3_client().head_object(**params)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            raise UploadSessionError("The file has not been uploaded yet")
+        raise UploadSessionError(f"Could not verify upload: {str(e)}")
+
+    if head['ContentLength'] != session.total_size:
+        raise UploadSessionError(
+            f"Uploaded {head['ContentLength']} bytes but the session expects {session.total_size}"
+        )
+    # Multipart objects carry a composite checksum, so only single PUTs are compared
+    if session.checksum_sha256 and not session.upload_id:
+        if head.get('ChecksumSHA256') != session.checksum_sha256:
+            raise UploadSessionError("Uploaded file does not match the declared checksum")
+    return head['ContentLength']
+
+def upload_part(session, part_number, data):
+    """
+    Upload one chunk as an S3 part. Re-sending a part number replaces the
+    previous attempt, which is what makes retries and resumes safe.
+    """
+    if session.status != 'active':
+        raise UploadSessionError(f"Upload session is {session.status}")
+    if session.mode != 'proxy':
+        raise UploadSessionError("Direct upload sessions are uploaded straight to storage")
+    if not 1 <= part_number <= MAX_PART_NUMBER:
+        raise UploadSessionError(f"Part number must be between 1 and {MAX_PART_NUMBER}")
+
+    try:
+        response = get_s3_client().upload_part(
+            PartNumber=part_number,
+            Body=data,
+            **_multipart_params(session)
+        )
+    except ClientError as e:
+        logger.error(f"Error uploading part {part_number} of session {session.pk}: {str(e)}")
+        raise UploadSessionError(f"Part upload failed: {str(e)}")
+
+    part, created = UploadSessionPart.objects.update_or_create(
+        session=session,
+        part_number=part_number,
+        defaults={'etag': response['ETag'], 'size': len(data)},
+    )
+    return part
+
+def complete_session(session, reported_parts=None):
+    """
+    Finish the upload in S3, verify it and create the UploadedFile.
+    Direct multipart sessions need reported_parts: the part_number and etag
+    (and optionally checksum_sha256) the client got back for each part.
+
+    Raises QuotaExceeded before anything is completed in S3 when the file
+    won't fit. If concurrent uploads fill the quota while it completes, the
+    session fails and the finished object is deleted.
+    """
+    with transaction.atomic():
+        # Lock the session so two concurrent completes can't both succeed
+        session = UploadSession.objects.select_for_update().get(pk=session.pk)
+        if session.status != 'active':
+            raise UploadSessionError(f"Upload session is {session.status}")
+
+        declared_size = session.total_size
+        if declared_size is None:
+            declared_size = sum(part.size for part in session.parts.all())
+        UserQuota.check_upload(session.user_id, declared_size, 1)
+
+        if session.mode == 'direct' and not session.upload_id:
+            file_size = _verify_direct_object(session)
+        else:
+            file_size = _complete_multipart(session, reported_parts)
+
+        instance = UploadedFile(
+            user=session.user,
+            file=session.key,
+            filename=session.filename,
+            file_size=file_size,
+            file_type=UploadedFile.file_type_for_name(session.filename),
+        )
+        try:
+            instance.save()
+        except QuotaExceeded as e:
+            # save() charges the quota in a savepoint of its own, so the
+            # session can still be marked failed in this transaction
+            exceeded = e
+            session.status = 'failed'
+            session.save(update_fields=['status', 'updated_at'])
+            delete_objects_on_commit([session.key])
+        else:
+            exceeded = None
+            session.status = 'completed'
+            session.uploaded_file = instance
+            session.save(update_fields=['status', 'uploaded_file', 'updated_at'])
+
+    if exceeded is not None:
+        logger.info(f"Upload session {session.pk} failed: {str(exceeded)}")
+        raise exceeded
+    logger.info(f"Completed upload session {session.pk} as {instance.file.name}")
+    return instance
+
+def _etag(value):
+    return (value or '').strip('"')
+
+def _verified_direct_parts(session, reported_parts):
+    """
+    The parts S3 received for a direct multipart session, checked against
+    what the client says it uploaded and the layout the URLs were presigned
+    for, so a corrupted, truncated or stray part is never stitched in.
+    """
+    if not reported_parts:
+        raise UploadSessionError("List the uploaded parts (part_number and etag) to complete a direct upload")
+
+    received = {part['PartNumber']: part for part in _list_uploaded_parts(session)}
+    reported = {part['part_number']: part for part in reported_parts}
+    if sorted(received) != sorted(reported):
+        raise UploadSessionError("The uploaded parts don't match the parts listed")
+
+    part_size = settings.UPLOAD_PRESIGN_PART_SIZE
+    part_count = math.ceil(session.total_size / part_size)
+    parts = []
+    for part_number in sorted(received):
+        part = received[part_number]
+        if _etag(part['ETag']) != _etag(reported[part_number]['etag']):
+            raise UploadSessionError(f"Part {part_number} does not match the uploaded part")
+        checksum = reported[part_number].get('checksum_sha256')
+        if checksum and part.get('ChecksumSHA256') != checksum:
+            raise UploadSessionError(f"Part {part_number} does not match its checksum")
+        expected_size = part_size if part_number < part_count else session.total_size - part_size * (part_count - 1)
+        if part['Size'] != expected_size:
+            raise UploadSessionError(f"Part {part_number} is {part['Size']} bytes but should be {expected_size}")
+        parts.append({'PartNumber': part_number, 'ETag': part['ETag'], 'Size': part['Size'],
+                      'ChecksumSHA256': part.get('ChecksumSHA256')})
+    return parts
+
+def _complete_multipart(session, reported_parts=None):
+    """
+    Stitch the parts of a multipart session together. Proxied sessions use
+    the parts we acknowledged; direct sessions use what S3 received, once
+    it matches what the client reported.
+    Returns the size of the finished object.
+    """
+    if session.mode == 'direct':
+        parts = _verified_direct_parts(session, reported_parts)
+    else:
+        parts = [
+            {'PartNumber': part.part_number, 'ETag': part.etag, 'Size': part.size}
+            for part in session.parts.all()
+        ]
+
+    if not parts:
+        raise UploadSessionError("No parts have been uploaded")
+    if [part['PartNumber'] for part in parts] != list(range(1, len(parts) + 1)):
+        raise UploadSessionError("Parts must be numbered consecutively from 1")
+
+    file_size = sum(part['Size'] for part in parts)
+    if session.total_size is not None and file_size != session.total_size:
+        raise UploadSessionError(
+            f"Uploaded {file_size} bytes but the session expects {session.total_size}"
+        )
+
+    completed = []
+    for part in parts:
+        completed.append({'PartNumber': part['PartNumber'], 'ETag': part['ETag']})
+        if part.get('ChecksumSHA256'):
+            completed[-1]['ChecksumSHA256'] = part['ChecksumSHA256']
+    try:
+        get_s3_client().complete_multipart_upload(
+            MultipartUpload={'Parts': completed},
+            **_multipart_params(session)
+        )
+    except ClientError as e:
+        logger.error(f"Error completing upload session {session.pk}: {str(e)}")
+        raise UploadSessionError(f"Could not complete upload: {str(e)}")
+    return file_size
+
+def abort_session(session):
+    """
+    Abort the S3 multipart upload so the stored parts are released.
+    """
+    if session.status != 'active':
+        raise UploadSessionError(f"Upload session is {session.status}")
+
+    if not session.upload_id:
+        # A single presigned PUT has nothing to abort; drop anything already sent
+        try:
+            get_s3_client().delete_object(
+                Bucket=default_storage.bucket_name,
+                Key=get_object_key(session.key),
+            )
+        except ClientError as e:
+            logger.error(f"Error deleting object for upload session {session.pk}: {str(e)}")
+        session.status = 'aborted'
+        session.save(update_fields=['status', 'updated_at'])
+        return
+
+    try:
+        get_s3_client().abort_multipart_upload(**_multipart_params(session))
+    except ClientError as e:
+        # NoSuchUpload means S3 already dropped it, which is what we want anyway
+        if e.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+            logger.error(f"Error aborting upload session {session.pk}: {str(e)}")
+            raise UploadSessionError(f"Could not abort upload: {str(e)}")
+
+    session.status = 'aborted'
+    session.save(update_fields=['status', 'updated_at'])
@@ -0,0 +1,105 @@
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+
+logger = logging.getLogger(__name__)
+
+class _LocalURLCache:
+    """
+    Small per-process LRU in front of the shared cache, so repeated listings
+    on one worker don't even pay a cache round trip.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name, now):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            url, expires_at = entry
+            if expires_at <= now:
+                del self._entries[name]
+                return None
+            self._entries.move_to_end(name)
+            return url
+
+    def set(self, name, url, expires_at):
+        with self._lock:
+            self._entries[name] = (url, expires_at)
+            self._entries.move_to_end(name)
+            while len(self._entries) > settings.FILE_URL_CACHE_LOCAL_SIZE:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_local = _LocalURLCache()
+
+def _cache_key(name):
+    # Storage names can be long or contain characters memcached rejects
+    return 'file-url:' + hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+def _lifetime():
+    """
+    How long a freshly signed URL may be handed out. Entries expire
+    FILE_URL_CACHE_MARGIN seconds before the signature does, so every URL
+    we return stays valid for at least that long.
+    """
+    if getattr(default_storage, 'querystring_auth', False):
+        expire = getattr(default_storage, 'querystring_expire', 3600)
+        return max(expire - settings.FILE_URL_CACHE_MARGIN, 0)
+    # Unsigned URLs don't expire; just keep them around for a while
+    return settings.FILE_URL_CACHE_UNSIGNED_TTL
+
+def get_urls(names):
+    """
+    Download URLs for a batch of storage names, as a dict. Served from the
+    local LRU, then the shared cache (one get_many), and only what's left
+    is signed.
+    """
+    now = time.time()
+    urls = {}
+    missing = []
+    for name in set(names):
+        url = _local.get(name, now)
+        if url is None:
+            missing.append(name)
+        else:
+            urls[name] = url
+    if not missing:
+        return urls
+
+    keys = {_cache_key(name): name for name in missing}
+    for key, (url, expires_at) in cache.get_many(keys.keys()).items():
+        if expires_at > now:
+            name = keys.pop(key)
+            urls[name] = url
+            _local.set(name, url, expires_at)
+
+    lifetime = _lifetime()
+    fresh = {}
+    for key, name in keys.items():
+        url = default_storage.url(name)
+        urls[name] = url
+        if lifetime > 0:
+            expires_at = now + lifetime
+            fresh[key] = (url, expires_at)
+            _local.set(name, url, expires_at)
+    if fresh:
+        cache.set_many(fresh, timeout=lifetime)
+    return urls
+
+def get_url(name):
+    """
+    Download URL for a single storage name.
+    """
+    return get_urls([name])[name]
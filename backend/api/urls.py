@@ -1,12 +1,13 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from . import views
+from . import views, async_views
 from django.views.decorators.csrf import csrf_exempt
 
 router = DefaultRouter()
 router.register(r'files', views.UploadedFileViewSet, basename='files')
 router.register(r'users', views.UserViewSet, basename='user')
 router.register(r'addresses', views.AddressViewSet, basename='addresses')
+router.register(r'uploads', views.UploadSessionViewSet, basename='uploads')
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -15,6 +16,12 @@ urlpatterns = [
     path('logout/', views.logout_view, name='logout'),
     path('profile/', views.UserProfileView.as_view(), name='profile'),
     path('dashboard-stats/', views.dashboard_stats, name='dashboard-stats'),
+    path('activity/', views.activity_log, name='activity'),
+    path('quota/', views.storage_quota, name='quota'),
+    path('stats/', views.runtime_stats, name='runtime-stats'),
     path('users/me/', views.UserViewSet.as_view({'get': 'me', 'patch': 'update_me', 'put': 'update_me'}), name='user-me'),
     path('users/me/update/', views.UserViewSet.as_view({'patch': 'update_me'}), name='user-update'),
+    # Async file API, for ASGI deployments
+    path('async/files/', async_views.file_list, name='async-file-list'),
+    path('async/files/<int:pk>/', async_views.file_detail, name='async-file-detail'),
 ] 
\ No newline at end of file
@@ -1,5 +1,5 @@
 from django.shortcuts import render, get_object_or_404
-from rest_framework import generics, permissions, status, viewsets
+from rest_framework import exceptions, generics, mixins, permissions, status, viewsets
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes, action
 from django.contrib.auth import authenticate, login, logout
@@ -11,16 +11,26 @@ from django.conf import settings
 import logging
 from .serializers import (
     UserSerializer, UserRegisterSerializer, UploadedFileSerializer, 
-    AddressSerializer, FileStatsSerializer
+    AddressSerializer, FileStatsSerializer, UploadSessionSerializer,
+    UploadSessionPartSerializer, DirectUploadSerializer, CompleteUploadSerializer,
+    UploadedFileValuesSerializer, requested_fields
 )
-from .models import UploadedFile, Address
+from .models import QuotaExceeded, UploadedFile, Address, UploadSession, UserFileStats, UserQuota
+from . import uploads
+from .upload_handlers import S3StreamingUploadHandler
+from .pagination import FileCursorPagination, SearchPagination
+from .authentication import cache_stats, invalidate_token
+from . import activity, archives, downloads, filters, search, thumbnails
+from .signals import batched_file_deletes
+from .accounts import get_or_provision_user
 from django.contrib.auth import get_user_model
 from django.core.files.storage import default_storage
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.http import StreamingHttpResponse
 import datetime
 import os
-import uuid
 from rest_framework import serializers
 
 # Set up logger
@@ -28,6 +38,17 @@ logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
+class StorageQuotaExceeded(exceptions.APIException):
+    status_code = status.HTTP_507_INSUFFICIENT_STORAGE
+    default_detail = 'Storage quota exceeded'
+    default_code = 'quota_exceeded'
+
+def _declared_size(request):
+    try:
+        return max(int(request.META.get('CONTENT_LENGTH') or 0), 0)
+    except ValueError:
+        return 0
+
 @method_decorator(csrf_exempt, name='dispatch')
 class RegisterView(generics.CreateAPIView):
     queryset = User.objects.all()
@@ -85,6 +106,16 @@ class RegisterView(generics.CreateAPIView):
             'token': token.key
         }, status=status.HTTP_201_CREATED)
 
+def _token_response(request, user):
+    activity.log(user.pk, activity.LOGIN, request)
+    token, created = Token.objects.get_or_create(user=user)
+    return Response({
+        'token': token.key,
+        'user_id': user.pk,
+        'username': user.username,
+        'email': user.email
+    })
+
 @csrf_exempt
 @api_view(['POST'])
 @permission_classes([permissions.AllowAny])
@@ -98,13 +129,7 @@ def login_view(request):
         
         if user is not None:
             login(request, user)
-            token, created = Token.objects.get_or_create(user=user)
-            return Response({
-                'token': token.key,
-                'user_id': user.pk,
-                'username': user.username,
-                'email': user.email
-            })
+            return _token_response(request, user)
     
     # If traditional auth fails or wasn't attempted, try Firebase
     firebase_token = request.data.get('firebase_token')
@@ -126,35 +151,8 @@ def login_view(request):
                 # If no firebase backend, try to use a traditional user with firebase email
                 firebase_email = request.data.get('email')
                 if firebase_email:
-                    try:
-                        user = User.objects.get(email=firebase_email)
-                        # User exists, create token and return success
-                        token, created = Token.objects.get_or_create(user=user)
-                        return Response({
-                            'token': token.key,
-                            'user_id': user.pk,
-                            'username': user.username,
-                            'email': user.email
-                        })
-                    except User.DoesNotExist:
-                        # User doesn't exist, create one
-                        username = firebase_email.split('@')[0]
-                        # Make sure username is unique
-                        if User.objects.filter(username=username).exists():
-                            username = f"{username}_{User.objects.count()}"
-                        
-                        user = User.objects.create_user(
-                            username=username,
-                            email=firebase_email,
-                            password=None,  # No password for Firebase users
-                        )
-                        token, created = Token.objects.get_or_create(user=user)
-                        return Response({
-                            'token': token.key,
-                            'user_id': user.pk,
-                            'username': user.username,
-                            'email': user.email
-                        })
+                    # Existing user, or provision one for this email
+                    return _token_response(request, get_or_provision_user(firebase_email))
                         
                 return Response({'detail': 'Firebase authentication backend not available'}, 
                                status=status.HTTP_400_BAD_REQUEST)
@@ -165,46 +163,13 @@ def login_view(request):
             if user:
                 # Important: Explicitly specify the backend when logging in
                 login(request, user, backend=firebase_backend.__class__.__module__ + '.' + firebase_backend.__class__.__name__)
-                token, created = Token.objects.get_or_create(user=user)
-                return Response({
-                    'token': token.key,
-                    'user_id': user.pk,
-                    'username': user.username,
-                    'email': user.email
-                })
+                return _token_response(request, user)
                 
             # Fallback for when firebase_backend.authenticate returns None
             firebase_email = request.data.get('email')
             if firebase_email:
-                try:
-                    user = User.objects.get(email=firebase_email)
-                    # User exists, create token and return success
-                    token, created = Token.objects.get_or_create(user=user)
-                    return Response({
-                        'token': token.key,
-                        'user_id': user.pk,
-                        'username': user.username,
-                        'email': user.email
-                    })
-                except User.DoesNotExist:
-                    # User doesn't exist, create one
-                    username = firebase_email.split('@')[0]
-                    # Make sure username is unique
-                    if User.objects.filter(username=username).exists():
-                        username = f"{username}_{User.objects.count()}"
-                    
-                    user = User.objects.create_user(
-                        username=username,
-                        email=firebase_email,
-                        password=None,  # No password for Firebase users
-                    )
-                    token, created = Token.objects.get_or_create(user=user)
-                    return Response({
-                        'token': token.key,
-                        'user_id': user.pk,
-                        'username': user.username,
-                        'email': user.email
-                    })
+                # Existing user, or provision one for this email
+                return _token_response(request, get_or_provision_user(firebase_email))
             
             return Response({'detail': 'Invalid Firebase credentials'}, 
                            status=status.HTTP_401_UNAUTHORIZED)
@@ -215,35 +180,8 @@ def login_view(request):
             # Fallback - check if we have email in request
             firebase_email = request.data.get('email')
             if firebase_email:
-                try:
-                    user = User.objects.get(email=firebase_email)
-                    # User exists, create token and return success
-                    token, created = Token.objects.get_or_create(user=user)
-                    return Response({
-                        'token': token.key,
-                        'user_id': user.pk,
-                        'username': user.username,
-                        'email': user.email
-                    })
-                except User.DoesNotExist:
-                    # User doesn't exist, create one
-                    username = firebase_email.split('@')[0]
-                    # Make sure username is unique
-                    if User.objects.filter(username=username).exists():
-                        username = f"{username}_{User.objects.count()}"
-                    
-                    user = User.objects.create_user(
-                        username=username,
-                        email=firebase_email,
-                        password=None,  # No password for Firebase users
-                    )
-                    token, created = Token.objects.get_or_create(user=user)
-                    return Response({
-                        'token': token.key,
-                        'user_id': user.pk,
-                        'username': user.username,
-                        'email': user.email
-                    })
+                # Existing user, or provision one for this email
+                return _token_response(request, get_or_provision_user(firebase_email))
             
             # If no email, return error
             return Response({'detail': f'Firebase authentication error: {str(e)}'}, 
@@ -254,6 +192,8 @@ def login_view(request):
 
 @api_view(['POST'])
 def logout_view(request):
+    if request.auth is not None:
+        invalidate_token(request.auth.key)
     logout(request)
     return Response({'detail': 'Successfully logged out'})
 
@@ -261,9 +201,38 @@ def logout_view(request):
 class UploadedFileViewSet(viewsets.ModelViewSet):
     serializer_class = UploadedFileSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = FileCursorPagination
+    filter_backends = [filters.FileFilterBackend]
     
     def get_queryset(self):
-        return UploadedFile.objects.filter(user=self.request.user)
+        return UploadedFile.objects.filter(user=self.request.user).select_related('user').order_by('-upload_date', '-id')
+
+    def list(self, request, *args, **kwargs):
+        # Lean listing straight from .values(); the detail view keeps the full shape
+        values_serializer = UploadedFileValuesSerializer(requested_fields(request))
+        queryset = self.filter_queryset(self.get_queryset()).values(*values_serializer.columns())
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(values_serializer.to_representation(page))
+        return Response(values_serializer.to_representation(queryset))
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if self.action in ('create', 'bulk_upload'):
+            # Turn away uploads that can't fit before their bytes are read,
+            # let alone streamed to S3. The request's declared length
+            # includes the multipart framing, so this errs on the safe side.
+            try:
+                UserQuota.check_upload(request.user.id, _declared_size(request), 1)
+            except QuotaExceeded as e:
+                raise StorageQuotaExceeded(str(e))
+        # Authentication has run, so the streaming handler knows whose prefix
+        # to write under. This must happen before request.data is parsed.
+        if settings.FILE_UPLOAD_STREAM_TO_S3 and request.method == 'POST':
+            request._request.upload_handlers = [
+                S3StreamingUploadHandler(request._request, user=request.user)
+            ]
     
     def perform_create(self, serializer):
         file_obj = self.request.FILES.get('file')
@@ -271,56 +240,341 @@ class UploadedFileViewSet(viewsets.ModelViewSet):
             logger.info(f"Received file upload: {file_obj.name}, size: {file_obj.size} bytes")
             
             try:
-                # Create a unique filename to avoid S3 exists check
-                # This works around the permission issue with HeadObject
                 original_name = file_obj.name
-                extension = os.path.splitext(original_name)[1].lower() if '.' in original_name else ''
-                unique_filename = f"{uuid.uuid4()}{extension}"
-                file_obj.name = unique_filename
-                
-                logger.info(f"Using unique filename: {unique_filename}")
-                
-                # Extract file_type from request data or determine from extension
+
+                # Use the file_type from the request, or determine it from the extension
                 file_type = self.request.data.get('file_type', 'other')
                 if not file_type or file_type == 'other':
-                    if extension.lower() in ['.pdf']:
-                        file_type = 'pdf'
-                    elif extension.lower() in ['.xlsx', '.xls']:
-                        file_type = 'excel'
-                    elif extension.lower() in ['.txt']:
-                        file_type = 'txt'
-                    elif extension.lower() in ['.doc', '.docx']:
-                        file_type = 'docx'
-                    else:
-                        file_type = 'other'
-                
-                # Save the instance with the unique filename
-                instance = serializer.save(
-                    user=self.request.user,
-                    file=file_obj,
-                    filename=original_name,  # Keep the original name for display
-                    file_size=file_obj.size,
-                    file_type=file_type
-                )
-                
-                # Log file path and URL for debugging
-                logger.info(f"File saved as: {instance.file.name}")
-                logger.info(f"File URL: {instance.file.url}")
-                
-                # Update file_url directly
+                    file_type = UploadedFile.file_type_for_name(original_name)
+
+                # Written outside the row's transaction, so no lock is held
+                # while the content goes to storage; given back if the row fails
+                name, blob = uploads.store_file(self.request.user, file_obj)
+                logger.info(f"Stored {original_name} as {name}")
+
                 try:
-                    file_url = instance.file.url
-                    UploadedFile.objects.filter(pk=instance.pk).update(file_url=file_url)
-                    logger.info(f"Updated file_url: {file_url}")
-                except Exception as e:
-                    logger.error(f"Error getting file URL: {str(e)}")
-                    
+                    instance = serializer.save(
+                        user=self.request.user,
+                        file=name,
+                        blob=blob,
+                        filename=original_name,  # Keep the original name for display
+                        file_size=file_obj.size,
+                        file_type=file_type
+                    )
+                except Exception:
+                    uploads.discard_stored_file(name, blob)
+                    raise
+
+                logger.info(f"File saved as: {instance.file.name}")
+
+            except QuotaExceeded as e:
+                # Only when concurrent uploads filled the quota after the
+                # check in initial()
+                raise StorageQuotaExceeded(str(e))
             except Exception as e:
                 logger.error(f"Error uploading file: {str(e)}")
                 raise serializers.ValidationError(f"File upload failed: {str(e)}")
         else:
             serializer.save(user=self.request.user)
 
+    def perform_destroy(self, instance):
+        # A batch of one, so the activity event gets the request's client IP
+        with transaction.atomic(), batched_file_deletes(self.request):
+            instance.delete()
+
+    @action(detail=True, methods=['get'], content_negotiation_class=downloads.DownloadContentNegotiation)
+    def download(self, request, pk=None):
+        """
+        Stream the file's content. Supports Range requests (206) so viewers
+        can seek, and ETag/If-None-Match. Add ?inline=1 to display rather
+        than download.
+        """
+        instance = self.get_object()
+        try:
+            response = downloads.download_response(request, instance)
+        except downloads.ContentMissing as e:
+            logger.error(f"Error downloading file {instance.pk}: {str(e)}")
+            return Response({'detail': 'File content is unavailable'}, status=status.HTTP_404_NOT_FOUND)
+        if response.status_code in (200, 206):
+            activity.log_file(activity.DOWNLOAD, instance, request)
+        return response
+
+    @action(detail=False, methods=['get'], content_negotiation_class=downloads.DownloadContentNegotiation)
+    def archive(self, request):
+        """
+        Download several files as one ZIP, streamed as it's built. Select
+        them with ?ids=1,2,3 or everything uploaded since a date with
+        ?since=2024-01-31 (or a full timestamp).
+        """
+        queryset = UploadedFile.objects.filter(user=request.user)
+        if request.query_params.get('ids'):
+            try:
+                ids = {int(file_id) for file_id in request.query_params['ids'].split(',') if file_id.strip()}
+            except ValueError:
+                return Response({'detail': 'ids must be a comma-separated list of integers'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(id__in=ids)
+        elif request.query_params.get('since'):
+            try:
+                since = filters.parse_timestamp(request.query_params['since'], 'since')
+            except filters.FilterError as e:
+                return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(upload_date__gte=since)
+        else:
+            return Response({'detail': 'Pass ids or since'}, status=status.HTTP_400_BAD_REQUEST)
+
+        count = queryset.count()
+        if count == 0:
+            return Response({'detail': 'No matching files'}, status=status.HTTP_404_NOT_FOUND)
+        if count > settings.FILE_ARCHIVE_MAX_FILES:
+            return Response({'detail': f'At most {settings.FILE_ARCHIVE_MAX_FILES} files can be archived at once'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        files = queryset.order_by('upload_date', 'id').only(
+            'id', 'user', 'file', 'filename', 'extension', 'upload_date'
+        ).iterator(chunk_size=500)
+        activity.log(request.user.pk, activity.DOWNLOAD, request, archive=True, file_count=count)
+        response = StreamingHttpResponse(archives.stream_zip(files), content_type='application/zip')
+        response['Content-Disposition'] = f'attachment; filename="files-{timezone.localdate().isoformat()}.zip"'
+        return response
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Full-text search over the content of your text, Word and PDF files:
+        ?q=quarterly report. Best matches first, paged with ?limit= and
+        ?offset=. Each result carries a score and a snippet of the text.
+        """
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'detail': 'Provide a search query with q'}, status=status.HTTP_400_BAD_REQUEST)
+
+        paginator = SearchPagination()
+        hits = paginator.paginate_queryset(search.SearchResults(request.user, query), request, self)
+        values_serializer = UploadedFileValuesSerializer(requested_fields(request))
+        rows = {
+            row['id']: row
+            for row in UploadedFile.objects.filter(user=request.user, id__in=[hit['id'] for hit in hits])
+            .values(*values_serializer.columns())
+        }
+        hits = [hit for hit in hits if hit['id'] in rows]
+        results = values_serializer.to_representation([rows[hit['id']] for hit in hits])
+        for item, hit in zip(results, hits):
+            item['score'] = -hit['rank']
+            item['snippet'] = hit['snippet']
+        return paginator.get_paginated_response(results)
+
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk_upload(self, request):
+        """
+        Upload many files in one multipart request (repeat the `files` field).
+        Files are written to storage concurrently and all rows are inserted
+        with a single bulk_create. Reports success or failure per file.
+        """
+        file_objs = request.FILES.getlist('files')
+        if not file_objs:
+            return Response({'detail': 'No files provided'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(file_objs) > settings.FILE_BULK_UPLOAD_MAX_FILES:
+            return Response({'detail': f'At most {settings.FILE_BULK_UPLOAD_MAX_FILES} files can be uploaded at once'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        logger.info(f"Received bulk upload of {len(file_objs)} files")
+        try:
+            # Before anything is written to storage
+            UserQuota.check_upload(request.user.id, sum(file_obj.size for file_obj in file_objs), len(file_objs))
+        except QuotaExceeded as e:
+            return Response({'detail': str(e)}, status=status.HTTP_507_INSUFFICIENT_STORAGE)
+
+        # Storage is written outside the transaction, which then only
+        # holds its locks (blobs, quota) for a few quick queries
+        staged = uploads.write_files(request.user, file_objs)
+        results = []
+        instances = []
+        try:
+            with transaction.atomic():
+                stored = uploads.reference_files(file_objs, staged)
+                for file_obj, (name, blob, error) in zip(file_objs, stored):
+                    if error is not None:
+                        results.append({'filename': file_obj.name, 'success': False, 'error': str(error)})
+                        continue
+                    instance = UploadedFile(
+                        user=request.user,
+                        file=name,
+                        blob=blob,
+                        filename=file_obj.name,
+                        file_size=file_obj.size,
+                        file_type=UploadedFile.file_type_for_name(file_obj.name),
+                        extension=UploadedFile.extension_for(file_obj.name),
+                    )
+                    instances.append(instance)
+                    results.append({'filename': file_obj.name, 'success': True, 'instance': instance})
+                # Concurrent uploads may have used up the quota since the check
+                UserQuota.charge(request.user.id, sum(instance.file_size for instance in instances), len(instances))
+                UploadedFile.objects.bulk_create(instances)
+                # bulk_create skips post_save, so update the stats here
+                UserFileStats.record_uploads(request.user.id, instances)
+                for instance in instances:
+                    activity.log_file(activity.UPLOAD, instance, request)
+                thumbnails.schedule(instances)
+                search.schedule(instances)
+        except QuotaExceeded as e:
+            uploads.discard_files(staged)
+            return Response({'detail': str(e)}, status=status.HTTP_507_INSUFFICIENT_STORAGE)
+        except Exception as e:
+            logger.error(f"Error in bulk upload: {str(e)}")
+            uploads.discard_files(staged)
+            return Response({'detail': f'Bulk upload failed: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        for result in results:
+            if result['success']:
+                result['file'] = UploadedFileSerializer(result.pop('instance')).data
+
+        all_stored = len(instances) == len(file_objs)
+        return Response({'results': results, 'uploaded': len(instances), 'failed': len(file_objs) - len(instances)},
+                        status=status.HTTP_201_CREATED if all_stored else status.HTTP_207_MULTI_STATUS)
+
+    @action(detail=False, methods=['post'], url_path='bulk-delete')
+    def bulk_delete(self, request):
+        """
+        Delete many files in one request: {"ids": [1, 2, ...]}. The rows go
+        in one queryset delete with their side effects applied in bulk, and
+        stored objects are removed after commit with batched DeleteObjects
+        calls. Ids that don't exist (or aren't yours) are reported back as
+        not_found.
+        """
+        ids = request.data.get('ids')
+        if not isinstance(ids, list) or not ids:
+            return Response({'detail': 'Provide a non-empty list of file ids'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(ids) > settings.FILE_BULK_DELETE_MAX_FILES:
+            return Response({'detail': f'At most {settings.FILE_BULK_DELETE_MAX_FILES} files can be deleted at once'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ids = {int(file_id) for file_id in ids}
+        except (TypeError, ValueError):
+            return Response({'detail': 'File ids must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+
+        logger.info(f"Received bulk delete of {len(ids)} files")
+        with transaction.atomic(), batched_file_deletes(request):
+            files = UploadedFile.objects.filter(user=request.user, id__in=ids)
+            found = set(files.select_for_update().values_list('id', flat=True))
+            deleted = files.delete()[1].get(UploadedFile._meta.label, 0)
+
+        return Response({'deleted': deleted, 'not_found': sorted(ids - found)})
+
+class UploadSessionViewSet(mixins.CreateModelMixin,
+                          mixins.RetrieveModelMixin,
+                          mixins.ListModelMixin,
+                          mixins.DestroyModelMixin,
+                          viewsets.GenericViewSet):
+    """
+    Resumable chunked uploads. Create a session, PUT numbered chunks to
+    parts/<n>/, then POST complete/ (or DELETE the session to abort).
+
+    For direct uploads POST presign/ instead: the client PUTs to the returned
+    S3 URLs itself and complete/ only verifies the object and records it.
+    Multipart direct uploads POST {"parts": [{"part_number", "etag"}, ...]}
+    to complete/, with the ETag S3 returned for each part.
+    """
+    serializer_class = UploadSessionSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(user=self.request.user).prefetch_related('parts')
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            UserQuota.check_upload(request.user.id, serializer.validated_data.get('total_size') or 0, 1)
+        except QuotaExceeded as e:
+            return Response({'detail': str(e)}, status=status.HTTP_507_INSUFFICIENT_STORAGE)
+        try:
+            session = uploads.start_session(request.user, **serializer.validated_data)
+        except uploads.UploadSessionError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.get_serializer(session).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'], url_path='presign')
+    def presign(self, request):
+        serializer = DirectUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            UserQuota.check_upload(request.user.id, serializer.validated_data['total_size'], 1)
+        except QuotaExceeded as e:
+            return Response({'detail': str(e)}, status=status.HTTP_507_INSUFFICIENT_STORAGE)
+        try:
+            session = uploads.start_direct_session(request.user, **serializer.validated_data)
+            upload = uploads.presign_session(session)
+        except uploads.UploadSessionError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        data = self.get_serializer(session).data
+        data['upload'] = upload
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['get'], url_path='presign')
+    def presign_urls(self, request, pk=None):
+        # Re-issue URLs for a direct session, e.g. after the first ones expired
+        session = self.get_object()
+        try:
+            upload = uploads.presign_session(session)
+        except uploads.UploadSessionError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        data = self.get_serializer(session).data
+        data['upload'] = upload
+        return Response(data)
+
+    @action(detail=True, methods=['put'], url_path=r'parts/(?P<part_number>[0-9]+)')
+    def upload_part(self, request, pk=None, part_number=None):
+        session = self.get_object()
+
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        if content_length <= 0:
+            return Response({'detail': 'Part body is empty'}, status=status.HTTP_400_BAD_REQUEST)
+        if content_length > settings.UPLOAD_SESSION_MAX_PART_SIZE:
+            return Response({'detail': 'Part is larger than the maximum part size'},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        # The parts so far plus this one must still fit once the file is complete
+        uploaded = session.parts.exclude(part_number=part_number).aggregate(total=models.Sum('size'))['total'] or 0
+        try:
+            UserQuota.check_upload(request.user.id, uploaded + content_length, 1)
+        except QuotaExceeded as e:
+            return Response({'detail': str(e)}, status=status.HTTP_507_INSUFFICIENT_STORAGE)
+
+        # Read the raw body straight from the stream; request.body would
+        # apply DATA_UPLOAD_MAX_MEMORY_SIZE, which is far below S3's part size
+        data = request.stream.read(content_length)
+        try:
+            part = uploads.upload_part(session, int(part_number), data)
+        except uploads.UploadSessionError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(UploadSessionPartSerializer(part).data)
+
+    @action(detail=True, methods=['post'])
+    def complete(self, request, pk=None):
+        session = self.get_object()
+        serializer = CompleteUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            instance = uploads.complete_session(session, serializer.validated_data.get('parts'))
+        except uploads.UploadSessionError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except QuotaExceeded as e:
+            return Response({'detail': str(e)}, status=status.HTTP_507_INSUFFICIENT_STORAGE)
+        return Response(UploadedFileSerializer(instance).data, status=status.HTTP_201_CREATED)
+
+    def destroy(self, request, *args, **kwargs):
+        session = self.get_object()
+        try:
+            uploads.abort_session(session)
+        except uploads.UploadSessionError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 class UserProfileView(generics.RetrieveUpdateAPIView):
     serializer_class = UserSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -356,47 +610,76 @@ def dashboard_stats(request):
     """
     user = request.user
     
-    # Get total number of files
-    total_files = UploadedFile.objects.filter(user=user).count()
-    
-    # Get total size of all files
-    total_size = UploadedFile.objects.filter(user=user).aggregate(
-        total_size=models.Sum('file_size')
-    )['total_size'] or 0
-    
-    # Get count of recently uploaded files (last 30 days)
-    thirty_days_ago = timezone.now() - datetime.timedelta(days=30)
-    recent_files = UploadedFile.objects.filter(
-        user=user,
-        upload_date__gte=thirty_days_ago
-    ).count()
-    
-    # Get file type breakdown
-    file_types = {}
-    # Extract file extensions from filenames
-    user_files = UploadedFile.objects.filter(user=user)
-    for file in user_files:
-        if file.filename:
-            ext = file.filename.split('.')[-1].lower() if '.' in file.filename else 'unknown'
-            file_types[ext] = file_types.get(ext, 0) + 1
+    # Maintained incrementally on upload and delete, so this is one PK lookup
+    stats = UserFileStats.objects.filter(pk=user.pk).first()
+    if stats is None:
+        stats = UserFileStats.rebuild(user.pk)
     
     # Get files per user (only for the current user in this case)
     files_per_user = {
-        user.username: total_files
+        user.username: stats.total_files
     }
     
     # Prepare data for serializer
     data = {
-        'total_files': total_files,
-        'total_size': total_size,
-        'recent_files': recent_files,
-        'file_types': file_types,
+        'total_files': stats.total_files,
+        'total_size': stats.total_bytes,
+        'recent_files': stats.recent_files,
+        'file_types': stats.extension_counts,
         'files_per_user': files_per_user
     }
     
     serializer = FileStatsSerializer(data)
     return Response(serializer.data)
 
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def storage_quota(request):
+    """
+    The current user's storage limits and usage. A null limit means unlimited.
+    """
+    quota = UserQuota.for_user(request.user.id)
+    return Response({
+        'used_bytes': quota.used_bytes,
+        'used_files': quota.used_files,
+        'max_bytes': quota.byte_limit,
+        'max_files': quota.file_limit,
+    })
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def runtime_stats(request):
+    """
+    Counters of the process serving the request, for staff: how often token
+    lookups were served from the cache.
+    """
+    return Response({'token_auth_cache': cache_stats()})
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def activity_log(request):
+    """
+    The current user's recent activity, newest first. Page back with
+    ?before=<ts of the last event>; filter with ?action=upload etc.
+    """
+    try:
+        limit = min(int(request.query_params.get('limit', 50)), settings.ACTIVITY_LOG_MAX_PAGE_SIZE)
+    except ValueError:
+        return Response({'detail': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+    before = request.query_params.get('before')
+    if before:
+        before = parse_datetime(before)
+        if before is None:
+            return Response({'detail': 'before must be an ISO 8601 timestamp'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        events = activity.user_activity(request.user.pk, limit=max(limit, 1), before=before,
+                                        action=request.query_params.get('action'))
+    except Exception as e:
+        logger.error(f"Error reading activity log: {str(e)}")
+        return Response({'detail': 'Activity log unavailable'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return Response({'results': events})
+
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
@@ -0,0 +1,74 @@
+"""
+Background work for the ingest pipelines (thumbnails, search indexing):
+a thread pool that runs jobs off the request path, and a process pool for
+their CPU-bound parts so decoding and parsing don't hold the GIL. Both are
+sized by BACKGROUND_WORKERS and created on first use in each process.
+"""
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_processes = None
+_threads = None
+_pid = None
+
+def _check_pid():
+    """
+    Pools don't survive a fork: a child (e.g. a gunicorn worker) starts its
+    own on first use.
+    """
+    global _processes, _threads, _pid
+    if _pid != os.getpid():
+        _processes = None
+        _threads = None
+        _pid = os.getpid()
+
+def process_pool():
+    global _processes
+    with _lock:
+        _check_pid()
+        if _processes is None:
+            # Spawned workers start clean instead of inheriting a copy of a
+            # threaded server process; they only import what a job needs
+            _processes = ProcessPoolExecutor(max_workers=settings.BACKGROUND_WORKERS,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return _processes
+
+def reset_process_pool(broken):
+    """
+    Drop a pool that a dead worker has broken; the next call starts a new one.
+    """
+    global _processes
+    with _lock:
+        if _processes is broken:
+            _processes = None
+
+def thread_pool():
+    global _threads
+    with _lock:
+        _check_pid()
+        if _threads is None:
+            _threads = ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKERS, thread_name_prefix='background')
+        return _threads
+
+def run_after_commit(func, *args):
+    """
+    Run func(*args) in the background once the current transaction commits.
+    """
+    transaction.on_commit(lambda: thread_pool().submit(_run, func, args))
+
+def _run(func, args):
+    try:
+        func(*args)
+    except Exception as e:
+        logger.error(f"Error in background job {func.__name__}: {str(e)}")
+    finally:
+        # Pool threads outlive requests; don't leave their connections open
+        connections.close_all()
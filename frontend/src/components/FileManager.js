@@ -23,7 +23,7 @@ import { format } from 'date-fns';
 
 const FileManager = () => {
   const [files, setFiles] = useState([]);
-  const [selectedFile, setSelectedFile] = useState(null);
+  const [selectedFiles, setSelectedFiles] = useState([]);
   const [uploadProgress, setUploadProgress] = useState(0);
   const [uploading, setUploading] = useState(false);
   const [error, setError] = useState(null);
@@ -52,16 +52,23 @@ const FileManager = () => {
   };
 
   const handleFileSelect = (event) => {
-    setSelectedFile(event.target.files[0]);
+    setSelectedFiles(Array.from(event.target.files));
     setError(null);
   };
 
   const handleUpload = async () => {
-    if (!selectedFile) {
+    if (selectedFiles.length === 0) {
       setError('Please select a file to upload');
       return;
     }
 
+    // Several files go up together in one request to the bulk endpoint
+    if (selectedFiles.length > 1) {
+      await handleBulkUpload();
+      return;
+    }
+    const selectedFile = selectedFiles[0];
+
     const token = localStorage.getItem('token');
     if (!token) {
       setError('Authentication required');
@@ -101,7 +108,7 @@ const FileManager = () => {
 
       console.log('Upload successful:', response.data);
       setSuccess('File uploaded successfully!');
-      setSelectedFile(null);
+      setSelectedFiles([]);
       fetchFiles();
 
       // Clear success message after 3 seconds
@@ -129,6 +136,48 @@ const FileManager = () => {
     }
   };
 
+  const handleBulkUpload = async () => {
+    const token = localStorage.getItem('token');
+    if (!token) {
+      setError('Authentication required');
+      return;
+    }
+
+    setUploading(true);
+    setUploadProgress(0);
+
+    const formData = new FormData();
+    selectedFiles.forEach((file) => formData.append('files', file));
+
+    try {
+      const response = await axios.post(`${API_URL}/api/files/bulk/`, formData, {
+        headers: {
+          'Content-Type': 'multipart/form-data',
+          'Authorization': `Token ${token}`
+        }
+      });
+
+      const { uploaded, failed, results } = response.data;
+      if (failed > 0) {
+        const failedNames = results.filter((result) => !result.success).map((result) => result.filename);
+        setError(`${failed} file(s) failed to upload: ${failedNames.join(', ')}`);
+      }
+      if (uploaded > 0) {
+        setSuccess(`${uploaded} file(s) uploaded successfully!`);
+        setTimeout(() => {
+          setSuccess(null);
+        }, 3000);
+      }
+      setSelectedFiles([]);
+      fetchFiles();
+    } catch (err) {
+      console.error('Error uploading files:', err);
+      setError(`Failed to upload files: ${err.response?.data?.detail || err.message}`);
+    } finally {
+      setUploading(false);
+    }
+  };
+
   const handleDownload = (fileUrl, filename) => {
     // Create a temporary link element
     const link = document.createElement('a');
@@ -227,7 +276,7 @@ const FileManager = () => {
               accept="*/*"
               style={{ display: 'none' }}
               id="raised-button-file"
-              multiple={false}
+              multiple
               type="file"
               onChange={handleFileSelect}
             />
@@ -239,7 +288,7 @@ const FileManager = () => {
                 startIcon={<CloudUpload />}
                 fullWidth
               >
-                Select File
+                Select Files
               </Button>
             </label>
           </Grid>
@@ -248,7 +297,7 @@ const FileManager = () => {
             <Button
               variant="contained"
               color="primary"
-              disabled={!selectedFile || uploading}
+              disabled={selectedFiles.length === 0 || uploading}
               onClick={handleUpload}
               startIcon={<CloudUpload />}
               fullWidth
@@ -267,9 +316,9 @@ const FileManager = () => {
               </Box>
             )}
 
-            {selectedFile && !uploading && (
+            {selectedFiles.length > 0 && !uploading && (
               <Typography variant="body2" sx={{ mt: 1 }}>
-                Selected: {selectedFile.name}
+                Selected: {selectedFiles.map((file) => file.name).join(', ')}
               </Typography>
             )}
           </Grid>